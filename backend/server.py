@@ -1,9 +1,15 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Request, Response, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import DeleteMany, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+from bson import ObjectId
+from bson.errors import InvalidId
 import os
 import logging
 from pathlib import Path
@@ -15,29 +21,294 @@ import asyncio
 from telethon import TelegramClient, events
 from telethon.tl.functions.messages import GetDialogsRequest, AddChatUserRequest, ExportChatInviteRequest, ImportChatInviteRequest
 from telethon.tl.functions.channels import InviteToChannelRequest, JoinChannelRequest
+from telethon.tl.functions.updates import GetStateRequest
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from telethon.sessions import MemorySession
+from telethon.crypto import AuthKey
+from telethon import utils as telethon_utils
 from telethon.tl.types import InputPeerEmpty, UserStatusOnline, UserStatusOffline, UserStatusRecently, Channel, Chat, User as TelegramUser
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError, UserPrivacyRestrictedError, UserNotMutualContactError, ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError, ChatAdminRequiredError, UserKickedError, UserAlreadyParticipantError, InviteHashExpiredError, InviteHashInvalidError
 import random
 import json
+import base64
+import hashlib
+import bisect
+import ipaddress
+import csv
+import io
 import jwt
 from passlib.context import CryptContext
 import sqlite3
+import pandas as pd
+import time
+import warnings
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# tz_aware: datas nativas do BSON voltam como datetime UTC com timezone
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
+
+# ============== Instrumented Data Access ==============
+
+# Operações acima deste tempo são logadas com a rota que as chamou
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', '200'))
+# Limites (ms) dos buckets do histograma de latência
+DB_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Scope ASGI da requisição atual (preenchido pelo RequestContextMiddleware)
+current_request_scope: ContextVar[Optional[dict]] = ContextVar("current_request_scope", default=None)
+
+def current_route() -> str:
+    """Rota (template, ex: 'GET /api/accounts/{account_id}/groups') que originou a operação"""
+    scope = current_request_scope.get()
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path", "?")
+    return f"{scope.get('method', '')} {path}".strip()
+
+class RequestContextMiddleware:
+    """Middleware ASGI mínimo que expõe o scope da requisição para a camada de dados"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = current_request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request_scope.reset(token)
+
+class DbOperationStats:
+    """Histograma de latência e contagem de documentos por (coleção, operação)"""
+    def __init__(self):
+        self._ops: Dict[tuple, dict] = {}
+        self.slow_queries = deque(maxlen=100)
+
+    def record(self, collection: str, operation: str, elapsed_ms: float, docs: int = 0,
+               error: Optional[Exception] = None, query: Any = None):
+        stats = self._ops.get((collection, operation))
+        if stats is None:
+            stats = {"count": 0, "errors": 0, "docs": 0, "total_ms": 0.0, "max_ms": 0.0,
+                     "buckets": [0] * (len(DB_LATENCY_BUCKETS_MS) + 1)}
+            self._ops[(collection, operation)] = stats
+        stats["count"] += 1
+        stats["docs"] += docs
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if error is not None:
+            stats["errors"] += 1
+        bucket = next((i for i, limit in enumerate(DB_LATENCY_BUCKETS_MS) if elapsed_ms <= limit), len(DB_LATENCY_BUCKETS_MS))
+        stats["buckets"][bucket] += 1
+        
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            route = current_route()
+            # Só o formato do filtro (campos), nunca os valores
+            shape = sorted(query.keys()) if isinstance(query, dict) else None
+            self.slow_queries.append({
+                "collection": collection, "operation": operation, "ms": round(elapsed_ms, 1),
+                "docs": docs, "route": route, "filter": shape,
+                "at": datetime.now(timezone.utc).isoformat()
+            })
+            logging.warning(f"[DB] Lenta: {collection}.{operation} {elapsed_ms:.0f}ms docs={docs} rota={route} filtro={shape}")
+
+    @staticmethod
+    def _percentile(buckets: List[int], count: int, fraction: float, max_ms: float) -> Optional[float]:
+        """Percentil aproximado pelo limite superior do bucket (o último bucket usa o máximo observado)"""
+        if not count:
+            return None
+        target, seen = count * fraction, 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= target:
+                return DB_LATENCY_BUCKETS_MS[i] if i < len(DB_LATENCY_BUCKETS_MS) else round(max_ms, 1)
+        return None
+
+    def stats(self) -> dict:
+        operations = []
+        for (collection, operation), s in self._ops.items():
+            operations.append({
+                "collection": collection,
+                "operation": operation,
+                "count": s["count"],
+                "errors": s["errors"],
+                "docs": s["docs"],
+                "total_ms": round(s["total_ms"], 1),
+                "avg_ms": round(s["total_ms"] / s["count"], 2),
+                "max_ms": round(s["max_ms"], 1),
+                "p50_ms": self._percentile(s["buckets"], s["count"], 0.5, s["max_ms"]),
+                "p95_ms": self._percentile(s["buckets"], s["count"], 0.95, s["max_ms"]),
+                "histogram": dict(zip([f"<={b}ms" for b in DB_LATENCY_BUCKETS_MS] + [f">{DB_LATENCY_BUCKETS_MS[-1]}ms"], s["buckets"])),
+            })
+        operations.sort(key=lambda o: o["total_ms"], reverse=True)
+        return {
+            "slow_query_ms": DB_SLOW_QUERY_MS,
+            "operations": operations,
+            "slow_queries": list(self.slow_queries)
+        }
+
+db_stats = DbOperationStats()
+
+def _affected_docs(result: Any) -> int:
+    """Quantos documentos uma operação devolveu ou alterou"""
+    if isinstance(result, dict):
+        return 1
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, InsertOneResult):
+        return 1
+    if isinstance(result, InsertManyResult):
+        return len(result.inserted_ids)
+    if isinstance(result, UpdateResult):
+        return result.modified_count + (1 if result.upserted_id is not None else 0)
+    if isinstance(result, DeleteResult):
+        return result.deleted_count
+    if isinstance(result, BulkWriteResult):
+        return result.inserted_count + result.upserted_count + result.modified_count + result.deleted_count
+    return 0
+
+class InstrumentedCursor:
+    """Cursor do Motor (find/aggregate) que mede to_list e iterações completas"""
+    def __init__(self, cursor, collection: str, operation: str, query: Any):
+        self._cursor = cursor
+        self._collection = collection
+        self._operation = operation
+        self._query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # sort/limit/skip/batch_size devolvem o próprio cursor
+            return self if result is self._cursor else result
+        return chained
+
+    async def to_list(self, length=None):
+        start = time.perf_counter()
+        error, docs = None, []
+        try:
+            docs = await self._cursor.to_list(length)
+            return docs
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            db_stats.record(self._collection, self._operation, (time.perf_counter() - start) * 1000,
+                            len(docs), error, self._query)
+
+    async def __aiter__(self):
+        start = time.perf_counter()
+        error, count = None, 0
+        try:
+            async for doc in self._cursor:
+                count += 1
+                yield doc
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            db_stats.record(self._collection, self._operation, (time.perf_counter() - start) * 1000,
+                            count, error, self._query)
+
+class InstrumentedCollection:
+    """Coleção do Motor que registra latência e documentos de cada operação"""
+    TIMED_OPERATIONS = {
+        "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "count_documents", "estimated_document_count", "distinct",
+        "find_one_and_update", "find_one_and_delete", "find_one_and_replace", "bulk_write",
+        "create_index", "index_information",
+    }
+    CURSOR_OPERATIONS = {"find", "aggregate"}
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.CURSOR_OPERATIONS:
+            def cursor_op(*args, **kwargs):
+                query = args[0] if args else kwargs.get("filter", kwargs.get("pipeline"))
+                return InstrumentedCursor(attr(*args, **kwargs), self.name, name, query)
+            return cursor_op
+        if name in self.TIMED_OPERATIONS:
+            async def timed_op(*args, **kwargs):
+                start = time.perf_counter()
+                error, result = None, None
+                try:
+                    result = await attr(*args, **kwargs)
+                    return result
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    query = args[0] if args else kwargs.get("filter")
+                    docs = 0 if name in ("count_documents", "estimated_document_count", "index_information") else _affected_docs(result)
+                    db_stats.record(self.name, name, (time.perf_counter() - start) * 1000, docs, error, query)
+            return timed_op
+        return attr
+
+class InstrumentedDatabase:
+    """
+    Banco do Motor por trás de uma camada fina: todo db.<coleção>.<operação> passa
+    pelos wrappers acima, sem mudar a forma como as rotas escrevem as consultas.
+    """
+    def __init__(self, database):
+        self._database = database
+        self._collections: Dict[str, InstrumentedCollection] = {}
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = InstrumentedCollection(self._database[name])
+            self._collections[name] = collection
+        return collection
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self._database, name)
+        if name == "command":
+            async def timed_command(*args, **kwargs):
+                start = time.perf_counter()
+                error = None
+                try:
+                    return await attr(*args, **kwargs)
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    db_stats.record("$cmd", str(args[0]) if args else "command", (time.perf_counter() - start) * 1000, 0, error)
+            return timed_command
+        if isinstance(attr, AsyncIOMotorCollection):
+            return self[name]
+        return attr
+
+db = InstrumentedDatabase(client[os.environ['DB_NAME']])
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default_secret_key')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
+# Modo stateless: plano, admin e token_version assinados no token, sem leitura do usuário no Mongo
+JWT_STATELESS_CLAIMS = os.environ.get('JWT_STATELESS_CLAIMS', 'false').lower() in ('1', 'true', 'yes')
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt roda em um pool de threads dedicado para não travar o event loop
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', '2'))
+# Quantas requisições podem aguardar uma vaga antes de responder 503
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '50'))
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -48,265 +319,1083 @@ api_router = APIRouter(prefix="/api")
 # Security
 security = HTTPBearer()
 
-# Store active Telegram clients
-active_clients: Dict[str, TelegramClient] = {}
-
 # Store active WebSocket connections for broadcast monitoring
 broadcast_connections: Dict[str, List[WebSocket]] = {}
 
 # Store active broadcast tasks
 active_broadcasts: Dict[str, Dict] = {}
 
-# Locks para gerenciar acesso às sessões do Telegram (evita "database is locked")
-session_locks: Dict[str, asyncio.Lock] = {}
-# Rastrear quando cada lock foi adquirido para detectar locks presos
-lock_timestamps: Dict[str, datetime] = {}
-# Timeout máximo para operações (2 minutos)
-MAX_LOCK_TIME = 120
+# ============== Leases por Conta ==============
+# Um único agendador controla o acesso exclusivo a cada conta do Telegram (evita "database is locked"
+# e duas conexões na mesma sessão). A fila é FIFO, com prioridade para operações interativas sobre
+# jobs em segundo plano. Cada lease recebe um fencing token crescente: depois de expirado ou revogado,
+# o antigo dono tem suas escritas recusadas (LeaseLostError). A expiração vem da falta de heartbeat,
+# não de um tempo máximo de operação.
+
+# Sem heartbeat por esse tempo, o lease expira e passa para o próximo da fila
+ACCOUNT_LEASE_TTL_SECONDS = float(os.environ.get('ACCOUNT_LEASE_TTL_SECONDS', '90'))
+# Job em segundo plano esperando há mais que isso passa a concorrer como interativo (sem starvation)
+ACCOUNT_LEASE_BACKGROUND_AGING_SECONDS = float(os.environ.get('ACCOUNT_LEASE_BACKGROUND_AGING_SECONDS', '60'))
+
+LEASE_INTERACTIVE = 0
+LEASE_BACKGROUND = 1
+LEASE_PRIORITY_NAMES = {LEASE_INTERACTIVE: "interactive", LEASE_BACKGROUND: "background"}
+
+class LeaseLostError(Exception):
+    """O lease expirou ou foi revogado; a operação não pode mais escrever em nome da conta"""
+
+class AccountLease:
+    __slots__ = ("phone", "token", "priority", "owner", "acquired_at", "heartbeat_at", "_scheduler")
+    
+    def __init__(self, scheduler: "AccountLeaseScheduler", phone: str, token: int, priority: int, owner: str):
+        self._scheduler = scheduler
+        self.phone = phone
+        self.token = token
+        self.priority = priority
+        self.owner = owner
+        self.acquired_at = self.heartbeat_at = time.monotonic()
+    
+    @property
+    def valid(self) -> bool:
+        return self._scheduler.is_current(self)
+    
+    def check(self):
+        """Fencing: levanta LeaseLostError se este lease não é mais o dono da conta"""
+        if not self.valid:
+            raise LeaseLostError(f"Lease da conta {self.phone} expirou ou foi revogado; operação interrompida.")
+    
+    def heartbeat(self):
+        """Renova o lease (chamar a cada passo de operações longas)"""
+        self.check()
+        self.heartbeat_at = time.monotonic()
+    
+    async def sleep(self, seconds: float):
+        """asyncio.sleep que mantém o lease vivo (delays e FloodWait maiores que o TTL)"""
+        end = time.monotonic() + seconds
+        while True:
+            self.heartbeat()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, ACCOUNT_LEASE_TTL_SECONDS / 3))
+    
+    async def run(self, awaitable):
+        """
+        Aguarda uma chamada longa (ex: get_dialogs) renovando o lease enquanto ela roda.
+        Se o lease for perdido a chamada é cancelada; ao terminar o fencing é conferido de novo.
+        """
+        self.heartbeat()
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=ACCOUNT_LEASE_TTL_SECONDS / 3)
+                self.heartbeat()
+        except BaseException:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise
+        result = task.result()
+        self.check()
+        return result
+
+class _LeaseWaiter:
+    __slots__ = ("future", "priority", "owner", "seq", "enqueued_at")
+    
+    def __init__(self, priority: int, owner: str, seq: int):
+        self.future = asyncio.get_running_loop().create_future()
+        self.priority = priority
+        self.owner = owner
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+    
+    def rank(self, now: float) -> tuple:
+        priority = self.priority
+        if priority == LEASE_BACKGROUND and now - self.enqueued_at >= ACCOUNT_LEASE_BACKGROUND_AGING_SECONDS:
+            priority = LEASE_INTERACTIVE
+        return (priority, self.seq)
+
+class AccountLeaseScheduler:
+    """Leases exclusivos por conta: fila justa, prioridades, fencing tokens e expiração por heartbeat"""
+    
+    def __init__(self):
+        self._holders: Dict[str, AccountLease] = {}
+        self._queues: Dict[str, List[_LeaseWaiter]] = {}
+        self._last_token = 0
+        self._seq = 0
+        self._reaper: Optional[asyncio.Task] = None
+        self._stats = {
+            "granted": 0, "granted_after_wait": 0, "timeouts": 0, "expired": 0, "revoked": 0,
+            "wait_ms_total": 0.0, "wait_ms_max": 0.0
+        }
+    
+    def _next_token(self) -> int:
+        # Crescente mesmo entre reinícios do processo
+        self._last_token = max(self._last_token + 1, time.time_ns() // 1000)
+        return self._last_token
+    
+    def is_current(self, lease: AccountLease) -> bool:
+        holder = self._holders.get(lease.phone)
+        return holder is not None and holder.token == lease.token
+    
+    def is_held(self, phone: str) -> bool:
+        self._expire(phone)
+        return phone in self._holders
+    
+    def _grant(self, phone: str, priority: int, owner: str) -> AccountLease:
+        lease = AccountLease(self, phone, self._next_token(), priority, owner)
+        self._holders[phone] = lease
+        self._stats["granted"] += 1
+        return lease
+    
+    def _handoff(self, phone: str):
+        """Passa a conta livre para o próximo da fila"""
+        queue = self._queues.get(phone)
+        while queue and phone not in self._holders:
+            now = time.monotonic()
+            waiter = min(queue, key=lambda w: w.rank(now))
+            queue.remove(waiter)
+            if waiter.future.done():
+                continue
+            lease = self._grant(phone, waiter.priority, waiter.owner)
+            wait_ms = (now - waiter.enqueued_at) * 1000
+            self._stats["granted_after_wait"] += 1
+            self._stats["wait_ms_total"] += wait_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+            waiter.future.set_result(lease)
+        if not queue:
+            self._queues.pop(phone, None)
+    
+    def _expire(self, phone: str) -> bool:
+        holder = self._holders.get(phone)
+        if holder is None or time.monotonic() - holder.heartbeat_at <= ACCOUNT_LEASE_TTL_SECONDS:
+            return False
+        logging.warning(f"[Leases] Lease de {phone} ({holder.owner}) expirou sem heartbeat há {ACCOUNT_LEASE_TTL_SECONDS:.0f}s")
+        self._stats["expired"] += 1
+        del self._holders[phone]
+        self._handoff(phone)
+        return True
+    
+    def try_acquire(self, phone: str, priority: int = LEASE_INTERACTIVE, owner: str = "other") -> Optional[AccountLease]:
+        """Lease imediato se a conta está livre e ninguém espera na fila; senão None"""
+        self._expire(phone)
+        if phone in self._holders or self._queues.get(phone):
+            return None
+        return self._grant(phone, priority, owner)
+    
+    async def acquire(self, phone: str, priority: int = LEASE_INTERACTIVE, timeout: float = 30,
+                      owner: str = "other") -> Optional[AccountLease]:
+        """Espera o lease da conta na fila. Retorna None se não conseguir dentro do timeout."""
+        lease = self.try_acquire(phone, priority, owner)
+        if lease is not None:
+            return lease
+        
+        self._seq += 1
+        waiter = _LeaseWaiter(priority, owner, self._seq)
+        self._queues.setdefault(phone, []).append(waiter)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Acorda periodicamente para expirar um dono que parou de mandar heartbeat
+                try:
+                    return await asyncio.wait_for(asyncio.shield(waiter.future),
+                                                  timeout=min(remaining, ACCOUNT_LEASE_TTL_SECONDS / 3))
+                except asyncio.TimeoutError:
+                    self._expire(phone)
+                    if waiter.future.done():
+                        return waiter.future.result()
+            self._stats["timeouts"] += 1
+            logging.warning(f"[Leases] Timeout de {timeout:.0f}s esperando a conta {phone} ({owner})")
+            return None
+        except asyncio.CancelledError:
+            # O lease pode ter chegado junto com o cancelamento: devolve
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            raise
+        finally:
+            # Sai da fila
+            if not waiter.future.done():
+                waiter.future.cancel()
+            queue = self._queues.get(phone)
+            if queue and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    self._queues.pop(phone, None)
+    
+    def release(self, lease: Optional[AccountLease]):
+        """Devolve o lease; leases antigos (expirados/revogados) são ignorados"""
+        if lease is None or not self.is_current(lease):
+            return
+        del self._holders[lease.phone]
+        self._handoff(lease.phone)
+    
+    def revoke(self, phone: str) -> bool:
+        """Revoga o lease atual da conta (o dono perde o fencing token) e libera a fila"""
+        holder = self._holders.pop(phone, None)
+        if holder is None:
+            return False
+        logging.warning(f"[Leases] Lease de {phone} ({holder.owner}) revogado")
+        self._stats["revoked"] += 1
+        self._handoff(phone)
+        return True
+    
+    def revoke_all(self) -> int:
+        phones = list(self._holders.keys())
+        for phone in phones:
+            self.revoke(phone)
+        return len(phones)
+    
+    def status(self, phone: str) -> dict:
+        self._expire(phone)
+        now = time.monotonic()
+        holder = self._holders.get(phone)
+        queue = self._queues.get(phone, [])
+        return {
+            "phone": phone,
+            "is_locked": holder is not None,
+            "holder": holder.owner if holder else None,
+            "priority": LEASE_PRIORITY_NAMES[holder.priority] if holder else None,
+            "lock_duration": f"{now - holder.acquired_at:.0f}s" if holder else None,
+            "last_heartbeat_seconds": round(now - holder.heartbeat_at, 1) if holder else None,
+            "token": holder.token if holder else None,
+            "queue_depth": len(queue),
+            "queue_interactive": sum(1 for w in queue if w.priority == LEASE_INTERACTIVE),
+            "queue_background": sum(1 for w in queue if w.priority == LEASE_BACKGROUND),
+            "oldest_wait_seconds": round(max((now - w.enqueued_at for w in queue), default=0), 1)
+        }
+    
+    def stats(self) -> dict:
+        waited = self._stats["granted_after_wait"]
+        return {
+            "held": len(self._holders),
+            "waiting": sum(len(q) for q in self._queues.values()),
+            "ttl_seconds": ACCOUNT_LEASE_TTL_SECONDS,
+            **{k: v for k, v in self._stats.items() if k not in ("wait_ms_total", "wait_ms_max")},
+            "avg_wait_ms": round(self._stats["wait_ms_total"] / waited, 1) if waited else 0.0,
+            "max_wait_ms": round(self._stats["wait_ms_max"], 1)
+        }
+    
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(max(1.0, ACCOUNT_LEASE_TTL_SECONDS / 3))
+            for phone in list(self._holders.keys()):
+                self._expire(phone)
+    
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+    
+    def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+account_leases = AccountLeaseScheduler()
+
+# ============== Armazenamento de Sessões Telegram ==============
+# Antes cada conta tinha seu próprio arquivo SQLite em sessions/ e o Telethon escrevia nele direto do
+# event loop ("database is locked" sob concorrência). Agora o Telethon trabalha só em memória
+# (PersistentSession) e auth key, DC e cache de entidades são gravados de forma assíncrona no backend
+# escolhido em TELEGRAM_SESSION_BACKEND:
+#   sqlite-wal - um único SQLite em modo WAL para todas as contas, acessado por uma thread dedicada
+#   mongo      - coleções telegram_sessions / telegram_session_entities
+# Arquivos .session antigos são importados na primeira vez que a conta conecta.
+
+TELEGRAM_SESSION_BACKEND = os.environ.get('TELEGRAM_SESSION_BACKEND', 'sqlite-wal')
+SESSIONS_DB_PATH = os.environ.get('SESSIONS_DB_PATH', 'sessions/sessions.db')
+# Entidades novas são agrupadas por esse tempo antes de irem para o backend
+SESSION_ENTITY_FLUSH_SECONDS = float(os.environ.get('SESSION_ENTITY_FLUSH_SECONDS', '2'))
+
+SESSION_BUSY_DETAIL = "Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente."
+SESSION_STORE_DETAIL = "Armazenamento de sessões indisponível. Tente novamente em instantes."
+
+# save/close/delete da PersistentSession são corrotinas, aceitas pelo utils.maybe_async do
+# Telethon (testado com Telethon==1.42.0), que avisa a cada chamada que o suporte é experimental.
+# O filtro vale só para esse aviso, emitido por telethon.utils.
+warnings.filterwarnings("ignore", message="Using async sessions support is an experimental feature",
+                        category=UserWarning, module=r"telethon\.utils")
+
+class SessionStoreError(Exception):
+    """Falha ao ler ou gravar no backend de sessões - as rotas respondem 503 em vez de 400"""
+
+class SqliteWalSessionStore:
+    """Todas as sessões num único SQLite em modo WAL; uma thread dedicada serializa o acesso"""
+    name = "sqlite-wal"
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions-db")
+        self._conn: Optional[sqlite3.Connection] = None
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    phone TEXT PRIMARY KEY, dc_id INTEGER, server_address TEXT, port INTEGER,
+                    auth_key BLOB, takeout_id INTEGER, updated_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS entities (
+                    session TEXT, id INTEGER, hash INTEGER, username TEXT, phone TEXT, name TEXT,
+                    PRIMARY KEY (session, id)
+                );
+            """)
+            self._conn = conn
+        return self._conn
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _load(self, phone: str) -> Optional[dict]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions WHERE phone = ?", (phone,)
+        ).fetchone()
+        if row is None:
+            return None
+        entities = conn.execute(
+            "SELECT id, hash, username, phone, name FROM entities WHERE session = ?", (phone,)
+        ).fetchall()
+        return {"dc_id": row[0], "server_address": row[1], "port": row[2], "auth_key": row[3],
+                "takeout_id": row[4], "entities": entities}
+    
+    def _save(self, phone: str, state: Optional[dict], entities: list):
+        conn = self._connection()
+        with conn:
+            if state is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (phone, state["dc_id"], state["server_address"], state["port"], state["auth_key"],
+                     state["takeout_id"], datetime.now(timezone.utc).isoformat())
+                )
+            if entities:
+                conn.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(phone, *row) for row in entities])
+    
+    def _delete(self, phone: str):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE phone = ?", (phone,))
+            conn.execute("DELETE FROM entities WHERE session = ?", (phone,))
+    
+    async def load(self, phone: str) -> Optional[dict]:
+        return await self._run(self._load, phone)
+    
+    async def save(self, phone: str, state: Optional[dict], entities: list):
+        await self._run(self._save, phone, state, entities)
+    
+    async def delete(self, phone: str):
+        await self._run(self._delete, phone)
+    
+    def close(self):
+        if self._conn is not None:
+            self._executor.submit(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+class MongoSessionStore:
+    """Sessões no MongoDB: um documento por conta e o cache de entidades em coleção própria"""
+    name = "mongo"
+    
+    async def load(self, phone: str) -> Optional[dict]:
+        doc = await db.telegram_sessions.find_one({"_id": phone})
+        if doc is None:
+            return None
+        rows = await db.telegram_session_entities.find(
+            {"session": phone}, {"_id": 0, "id": 1, "hash": 1, "username": 1, "phone": 1, "name": 1}
+        ).to_list(None)
+        doc["entities"] = [(r["id"], r["hash"], r.get("username"), r.get("phone"), r.get("name")) for r in rows]
+        return doc
+    
+    async def save(self, phone: str, state: Optional[dict], entities: list):
+        if state is not None:
+            await db.telegram_sessions.update_one(
+                {"_id": phone},
+                {"$set": {**state, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        if entities:
+            await db.telegram_session_entities.bulk_write([
+                UpdateOne(
+                    {"session": phone, "id": row[0]},
+                    {"$set": {"hash": row[1], "username": row[2], "phone": row[3], "name": row[4]}},
+                    upsert=True
+                )
+                for row in entities
+            ], ordered=False)
+    
+    async def delete(self, phone: str):
+        await db.telegram_sessions.delete_one({"_id": phone})
+        await db.telegram_session_entities.delete_many({"session": phone})
+    
+    def close(self):
+        pass
+
+if TELEGRAM_SESSION_BACKEND == "mongo":
+    session_store = MongoSessionStore()
+elif TELEGRAM_SESSION_BACKEND == "sqlite-wal":
+    session_store = SqliteWalSessionStore(SESSIONS_DB_PATH)
+else:
+    raise RuntimeError(f"TELEGRAM_SESSION_BACKEND inválido: {TELEGRAM_SESSION_BACKEND} (use sqlite-wal ou mongo)")
+
+class PersistentSession(MemorySession):
+    """
+    Sessão Telethon que vive em memória e é persistida de forma assíncrona no session_store.
+    As consultas do Telethon nunca tocam disco; entidades ficam indexadas por id/username/telefone.
+    """
+    
+    def __init__(self, store, phone: str, data: Optional[dict] = None):
+        super().__init__()
+        self._store = store
+        self._phone = phone
+        self._rows: Dict[int, tuple] = {}
+        self._by_username: Dict[str, tuple] = {}
+        self._by_phone: Dict[str, tuple] = {}
+        self._pending_entities: Dict[int, tuple] = {}
+        self._state_dirty = False
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        # A gravação agendada ainda não começou a gravar (pode ser cancelada sem perder nada)
+        self._flush_sleeping = False
+        self._deleted = False
+        if data:
+            self._dc_id = data.get("dc_id") or 0
+            self._server_address = data.get("server_address")
+            self._port = data.get("port")
+            self._takeout_id = data.get("takeout_id")
+            if data.get("auth_key"):
+                self._auth_key = AuthKey(data=data["auth_key"])
+            for row in data.get("entities") or []:
+                self._index(tuple(row))
+    
+    def _index(self, row: tuple):
+        if row[3] is not None and not isinstance(row[3], str):
+            # Arquivos .session do Telethon guardam o telefone como inteiro
+            row = (row[0], row[1], row[2], str(row[3]), row[4])
+        previous = self._rows.get(row[0])
+        if previous is not None:
+            if previous[2] and self._by_username.get(previous[2]) is previous:
+                del self._by_username[previous[2]]
+            if previous[3] and self._by_phone.get(previous[3]) is previous:
+                del self._by_phone[previous[3]]
+        self._rows[row[0]] = row
+        if row[2]:
+            self._by_username[row[2]] = row
+        if row[3]:
+            self._by_phone[row[3]] = row
+    
+    def _state(self) -> dict:
+        return {
+            "dc_id": self._dc_id,
+            "server_address": self._server_address,
+            "port": self._port,
+            "auth_key": self._auth_key.key if self._auth_key else None,
+            "takeout_id": self._takeout_id
+        }
+    
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._state_dirty = True
+    
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._state_dirty = True
+    
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._state_dirty = True
+    
+    def clone(self, to_instance=None):
+        """Cópia só em memória (ex: cliente CDN do Telethon); não grava no backend"""
+        session = to_instance or MemorySession()
+        session.set_dc(self._dc_id, self._server_address, self._port)
+        session.auth_key = self._auth_key
+        return session
+    
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            if self._rows.get(row[0]) != row:
+                self._index(row)
+                self._pending_entities[row[0]] = row
+        if self._pending_entities:
+            self._schedule_flush()
+    
+    def get_entity_rows_by_phone(self, phone):
+        row = self._by_phone.get(phone)
+        return (row[0], row[1]) if row else None
+    
+    def get_entity_rows_by_username(self, username):
+        row = self._by_username.get(username)
+        return (row[0], row[1]) if row else None
+    
+    def get_entity_rows_by_name(self, name):
+        return next(((row[0], row[1]) for row in self._rows.values() if row[4] == name), None)
+    
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            ids = (id,)
+        else:
+            ids = (telethon_utils.get_peer_id(PeerUser(id)),
+                   telethon_utils.get_peer_id(PeerChat(id)),
+                   telethon_utils.get_peer_id(PeerChannel(id)))
+        for marked_id in ids:
+            row = self._rows.get(marked_id)
+            if row:
+                return row[0], row[1]
+        return None
+    
+    def _schedule_flush(self):
+        if self._deleted:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+                self._flush_sleeping = True
+            except RuntimeError:
+                pass
+    
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(SESSION_ENTITY_FLUSH_SECONDS)
+        finally:
+            self._flush_sleeping = False
+        await self.flush()
+    
+    async def _stop_flush_task(self):
+        """Cancela a gravação agendada só enquanto ela dorme; se já está gravando, espera terminar"""
+        task = self._flush_task
+        if task is None or task.done():
+            return
+        if self._flush_sleeping:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    async def flush(self, raise_errors: bool = False):
+        """
+        Grava no backend o que mudou desde a última gravação.
+        Falhas voltam para a fila; com raise_errors=True a exceção também chega a quem chamou.
+        """
+        async with self._flush_lock:
+            if self._deleted:
+                return
+            state = self._state() if self._state_dirty else None
+            entities = list(self._pending_entities.values())
+            if state is None and not entities:
+                return
+            self._state_dirty = False
+            self._pending_entities = {}
+            try:
+                await self._store.save(self._phone, state, entities)
+            except BaseException as e:
+                # Volta para a fila (também se a tarefa foi cancelada); a próxima gravação tenta de novo
+                if state is not None:
+                    self._state_dirty = True
+                for row in entities:
+                    self._pending_entities.setdefault(row[0], row)
+                if not isinstance(e, Exception):
+                    raise
+                logging.error(f"[Sessions] Erro ao gravar sessão de {self._phone}: {e}")
+                if raise_errors:
+                    raise SessionStoreError(f"Erro ao gravar a sessão de {self._phone}: {e}") from e
+    
+    async def save(self):
+        await self.flush()
+    
+    async def close(self):
+        await self._stop_flush_task()
+        await self.flush()
+    
+    async def delete(self):
+        await self._stop_flush_task()
+        # Sob o lock: uma gravação em andamento termina antes e nenhuma outra recria a sessão
+        async with self._flush_lock:
+            self._deleted = True
+            self._pending_entities = {}
+            self._state_dirty = False
+            await self._store.delete(self._phone)
+
+def _legacy_session_paths(phone: str) -> List[str]:
+    session_file = f"sessions/{phone}.session"
+    return [session_file, f"{session_file}-journal", f"{session_file}-wal", f"{session_file}-shm",
+            f"{session_file}.imported"]
+
+def _read_legacy_session_file(phone: str) -> Optional[dict]:
+    """Lê o arquivo .session antigo da conta (roda numa thread)"""
+    session_file = f"sessions/{phone}.session"
+    if not os.path.exists(session_file):
+        return None
+    conn = sqlite3.connect(session_file, timeout=30.0)
+    try:
+        row = conn.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions").fetchone()
+        try:
+            entities = conn.execute("SELECT id, hash, username, phone, name FROM entities").fetchall()
+        except sqlite3.OperationalError:
+            entities = []
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {"dc_id": row[0], "server_address": row[1], "port": row[2], "auth_key": row[3],
+            "takeout_id": row[4], "entities": entities}
+
+def _remove_legacy_session_files(phone: str) -> bool:
+    removed = False
+    for path in _legacy_session_paths(phone):
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    return removed
+
+async def open_telegram_session(phone: str) -> PersistentSession:
+    """Carrega a sessão da conta do backend (importando o .session antigo se for o caso)"""
+    try:
+        data = await session_store.load(phone)
+        if data is None:
+            data = await asyncio.to_thread(_read_legacy_session_file, phone)
+            if data is not None:
+                state = {k: data[k] for k in ("dc_id", "server_address", "port", "auth_key", "takeout_id")}
+                await session_store.save(phone, state, data["entities"])
+                # Só marca como importado depois de gravado no backend
+                session_file = f"sessions/{phone}.session"
+                await asyncio.to_thread(os.replace, session_file, f"{session_file}.imported")
+                logging.info(f"[Sessions] Sessão de {phone} importada do arquivo .session ({len(data['entities'])} entidades)")
+    except Exception as e:
+        raise SessionStoreError(f"Erro ao carregar a sessão de {phone} ({session_store.name}): {e}") from e
+    return PersistentSession(session_store, phone, data)
+
+async def remove_telegram_session(phone: str):
+    """Apaga a sessão da conta do backend e qualquer arquivo .session antigo, sem bloquear o loop"""
+    await session_store.delete(phone)
+    if await asyncio.to_thread(_remove_legacy_session_files, phone):
+        logging.info(f"[Sessions] Arquivos .session antigos removidos para {phone}")
 
 # ============== Gerenciador de Clientes Singleton ==============
 # Mantém uma única conexão por conta para evitar erro de IP duplicado
 
+# Máximo de clientes conectados ao mesmo tempo (todas as contas)
+MAX_CONNECTED_CLIENTS = int(os.environ.get('MAX_CONNECTED_CLIENTS', '50'))
+# Quanto tempo get_client espera por uma vaga quando o limite está cheio
+CLIENT_POOL_WAIT_SECONDS = float(os.environ.get('CLIENT_POOL_WAIT_SECONDS', '60'))
+# Cliente sem nenhum lease há mais que isso é desconectado
+CLIENT_IDLE_TIMEOUT_SECONDS = float(os.environ.get('CLIENT_IDLE_TIMEOUT_SECONDS', '600'))
+# Intervalo do keepalive / health check dos clientes ociosos
+CLIENT_KEEPALIVE_INTERVAL_SECONDS = float(os.environ.get('CLIENT_KEEPALIVE_INTERVAL_SECONDS', '60'))
+# Quanto tempo um cliente que recebeu o código (send_code) fica reservado esperando o verify_code
+CLIENT_PENDING_AUTH_SECONDS = float(os.environ.get('CLIENT_PENDING_AUTH_SECONDS', '600'))
+
+class ClientRef:
+    """
+    Referência a um cliente do pool, devolvida por get_client/lease_existing.
+    release_client(ref) devolve exatamente esta referência; devolver duas vezes não tira
+    a referência de outra operação.
+    """
+    __slots__ = ("phone", "client", "released")
+    
+    def __init__(self, phone: str, client: TelegramClient):
+        self.phone = phone
+        self.client = client
+        self.released = False
+
 class TelegramClientManager:
     """
     Gerenciador singleton de clientes Telegram.
     Mantém apenas UMA conexão ativa por número de telefone.
     Evita o erro 'authorization key was used under two different IP addresses'
+    Todas as operações (disparo, extração, grupos, login...) pegam o cliente daqui
+    e devolvem com release_client - a conexão fica aberta para a próxima operação.
+    
+    Cada get_client devolve uma ClientRef: o cliente só fica livre quando todas as
+    referências forem devolvidas. No máximo MAX_CONNECTED_CLIENTS ficam
+    conectados; ociosos saem por LRU (na falta de vaga ou após CLIENT_IDLE_TIMEOUT_SECONDS)
+    e um keepalive periódico descarta conexões mortas antes de uma requisição usá-las.
+    Clientes entre o send_code e o verify_code ficam marcados como pending-auth e não
+    passam pelo keepalive nem pelo despejo até CLIENT_PENDING_AUTH_SECONDS.
     """
-    _clients: Dict[str, TelegramClient] = {}
-    _client_locks: Dict[str, asyncio.Lock] = {}
-    _client_in_use: Dict[str, bool] = {}
+    # Ordem = LRU (o mais antigo liberado primeiro)
+    _clients: "OrderedDict[str, TelegramClient]" = OrderedDict()
+    # Referências ativas por telefone (ClientRef)
+    _refs: Dict[str, set] = {}
+    _last_used: Dict[str, float] = {}
+    # Desconectar quando o último lease for devolvido
+    _close_on_release: set = set()
+    # Clientes esperando o verify_code: telefone -> prazo (monotonic). Fora do keepalive e do LRU
+    _pending_auth: Dict[str, float] = {}
+    _connecting = 0
+    _capacity = asyncio.Condition()
+    _maintenance_task: Optional[asyncio.Task] = None
+    # operação -> {"calls", "reused", "created", "connect_ms"}
+    _stats: Dict[str, dict] = {}
+    _pool_stats = {"capacity_waits": 0, "capacity_timeouts": 0, "evicted_lru": 0,
+                   "evicted_idle": 0, "health_failures": 0, "keepalives": 0}
     
     @classmethod
-    def get_client_lock(cls, phone: str) -> asyncio.Lock:
-        """Obtém ou cria um lock para o cliente"""
-        if phone not in cls._client_locks:
-            cls._client_locks[phone] = asyncio.Lock()
-        return cls._client_locks[phone]
+    def _avg_connect_ms(cls) -> float:
+        created = sum(s["created"] for s in cls._stats.values())
+        total_ms = sum(s["connect_ms"] for s in cls._stats.values())
+        return total_ms / created if created else 0.0
     
     @classmethod
-    async def get_client(cls, phone: str, api_id: int, api_hash: str) -> TelegramClient:
+    def _record(cls, operation: str, phone: str, reused: bool, connect_ms: float = 0.0):
+        stats = cls._stats.setdefault(operation, {"calls": 0, "reused": 0, "created": 0, "connect_ms": 0.0})
+        stats["calls"] += 1
+        if reused:
+            stats["reused"] += 1
+            logging.info(f"[ClientManager] {operation} {phone}: cliente reutilizado (~{cls._avg_connect_ms():.0f}ms de conexão economizados)")
+        else:
+            stats["created"] += 1
+            stats["connect_ms"] += connect_ms
+            logging.info(f"[ClientManager] {operation} {phone}: nova conexão em {connect_ms:.0f}ms")
+    
+    @classmethod
+    def _lease(cls, phone: str, client: TelegramClient) -> ClientRef:
+        ref = ClientRef(phone, client)
+        cls._refs.setdefault(phone, set()).add(ref)
+        cls._last_used[phone] = time.monotonic()
+        cls._clients.move_to_end(phone)
+        return ref
+    
+    @classmethod
+    async def _drop(cls, phone: str):
+        """Desconecta e remove o cliente do pool (chamar com o lease da conta ou sem leases de cliente)"""
+        client = cls._clients.pop(phone, None)
+        cls._refs.pop(phone, None)
+        cls._last_used.pop(phone, None)
+        cls._close_on_release.discard(phone)
+        cls._pending_auth.pop(phone, None)
+        if client is not None:
+            try:
+                await client.disconnect()
+            except:
+                pass
+            async with cls._capacity:
+                cls._capacity.notify_all()
+    
+    @classmethod
+    def _is_pending_auth(cls, phone: str) -> bool:
+        deadline = cls._pending_auth.get(phone)
+        return deadline is not None and time.monotonic() < deadline
+    
+    @classmethod
+    def _idle_lru(cls) -> Optional[str]:
+        for phone in cls._clients:
+            if cls._is_pending_auth(phone):
+                continue
+            if not cls._refs.get(phone) and not account_leases.is_held(phone):
+                return phone
+        return None
+    
+    @classmethod
+    async def _reserve_slot(cls, phone: str):
+        """Garante uma vaga para nova conexão: usa vaga livre, despeja o ocioso LRU ou espera"""
+        deadline = time.monotonic() + CLIENT_POOL_WAIT_SECONDS
+        waited = False
+        while len(cls._clients) + cls._connecting >= MAX_CONNECTED_CLIENTS:
+            idle = cls._idle_lru()
+            if idle is not None:
+                logging.info(f"[ClientManager] Limite de {MAX_CONNECTED_CLIENTS} clientes: desconectando ocioso {idle}")
+                cls._pool_stats["evicted_lru"] += 1
+                await cls._drop(idle)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                cls._pool_stats["capacity_timeouts"] += 1
+                raise Exception("Limite de conexões simultâneas atingido. Tente novamente em instantes.")
+            if not waited:
+                cls._pool_stats["capacity_waits"] += 1
+                waited = True
+            async with cls._capacity:
+                try:
+                    await asyncio.wait_for(cls._capacity.wait(), timeout=min(remaining, 5))
+                except asyncio.TimeoutError:
+                    pass
+        cls._connecting += 1
+    
+    @classmethod
+    async def _reuse(cls, phone: str, require_auth: bool, operation: str) -> Optional[ClientRef]:
+        """Lease no cliente já conectado, se ele estiver saudável"""
+        client = cls._clients.get(phone)
+        if client is None:
+            return None
+        try:
+            if client.is_connected():
+                # Verificar se está autorizado
+                if (not require_auth or await client.is_user_authorized()) and cls._clients.get(phone) is client:
+                    cls._record(operation, phone, reused=True)
+                    return cls._lease(phone, client)
+        except Exception as e:
+            logging.warning(f"[ClientManager] Cliente existente com problema para {phone}: {e}")
+        return None
+    
+    @classmethod
+    async def get_client(cls, phone: str, api_id: int, api_hash: str, require_auth: bool = True,
+                         operation: str = "other", lease: Optional[AccountLease] = None,
+                         priority: int = LEASE_INTERACTIVE) -> ClientRef:
         """
-        Obtém ou cria um cliente para o telefone.
+        Obtém (referência) ou cria um cliente para o telefone. Usar ref.client e devolver a
+        referência com release_client(ref).
         Se já existe um cliente conectado, reutiliza.
+        require_auth=False é usado no login (send_code), quando a conta ainda não está autorizada.
+        Criar a conexão exige o lease da conta: quem já o tem passa em `lease`; senão um lease
+        curto é pego só para a conexão.
         """
-        lock = cls.get_client_lock(phone)
+        ref = await cls._reuse(phone, require_auth, operation)
+        if ref is not None:
+            return ref
         
-        async with lock:
-            # Verificar se já existe cliente conectado
-            if phone in cls._clients:
-                client = cls._clients[phone]
-                try:
-                    if client.is_connected():
-                        # Verificar se está autorizado
-                        if await client.is_user_authorized():
-                            logging.info(f"[ClientManager] Reutilizando cliente existente para {phone}")
-                            cls._client_in_use[phone] = True
-                            return client
-                except Exception as e:
-                    logging.warning(f"[ClientManager] Cliente existente com problema para {phone}: {e}")
-                
-                # Cliente existe mas não está funcionando, desconectar
-                try:
-                    await client.disconnect()
-                except:
-                    pass
-                del cls._clients[phone]
+        own_lease = None
+        if lease is None:
+            own_lease = lease = await account_leases.acquire(phone, priority, timeout=CLIENT_POOL_WAIT_SECONDS,
+                                                             owner=f"connect:{operation}")
+            if lease is None:
+                raise Exception(f"Conta {phone} ocupada. Tente novamente em instantes.")
+        
+        try:
+            lease.check()
+            # Outra operação pode ter conectado enquanto esperávamos o lease
+            ref = await cls._reuse(phone, require_auth, operation)
+            if ref is not None:
+                return ref
             
-            # Criar novo cliente
-            logging.info(f"[ClientManager] Criando novo cliente para {phone}")
-            session_name = f"sessions/{phone}"
+            if phone in cls._clients:
+                # Cliente existe mas não está funcionando; só desconecta se ninguém mais usa
+                if cls._refs.get(phone):
+                    raise Exception(f"Conta {phone} com conexão instável. Tente novamente em instantes.")
+                await cls._drop(phone)
             
-            # Configurar SQLite
+            await cls._reserve_slot(phone)
             try:
-                sqlite3.connect(f"{session_name}.session", timeout=30.0).close()
-            except:
-                pass
-            
-            client = TelegramClient(
-                session_name,
-                api_id,
-                api_hash,
-                connection_retries=3,
-                retry_delay=1,
-                timeout=30
-            )
-            
-            await client.connect()
-            
-            if not await client.is_user_authorized():
-                await client.disconnect()
-                raise Exception(f"Conta {phone} não está autenticada. Por favor, faça login novamente.")
-            
-            cls._clients[phone] = client
-            cls._client_in_use[phone] = True
+                # Criar novo cliente
+                logging.info(f"[ClientManager] Criando novo cliente para {phone}")
+                session = await open_telegram_session(phone)
+                
+                client = TelegramClient(
+                    session,
+                    api_id,
+                    api_hash,
+                    connection_retries=3,
+                    retry_delay=1,
+                    timeout=30
+                )
+                
+                started = time.perf_counter()
+                try:
+                    await client.connect()
+                    
+                    if require_auth and not await client.is_user_authorized():
+                        raise Exception(f"Conta {phone} não está autenticada. Por favor, faça login novamente.")
+                    # Fencing: um dono antigo não instala cliente no pool
+                    lease.check()
+                except Exception:
+                    try:
+                        await client.disconnect()
+                    except:
+                        pass
+                    raise
+                
+                cls._clients[phone] = client
+                cls._record(operation, phone, reused=False, connect_ms=(time.perf_counter() - started) * 1000)
+                return cls._lease(phone, client)
+            finally:
+                cls._connecting -= 1
+                async with cls._capacity:
+                    cls._capacity.notify_all()
+        finally:
+            account_leases.release(own_lease)
+    
+    @classmethod
+    def mark_pending_auth(cls, phone: str):
+        """Cliente recebeu o código: fica no pool esperando o verify_code"""
+        if phone in cls._clients:
+            cls._pending_auth[phone] = time.monotonic() + CLIENT_PENDING_AUTH_SECONDS
+    
+    @classmethod
+    def clear_pending_auth(cls, phone: str):
+        cls._pending_auth.pop(phone, None)
+    
+    @classmethod
+    def lease_existing(cls, phone: str) -> Optional[ClientRef]:
+        """Referência no cliente já conectado, sem criar conexão (ex: verify_code após send_code)"""
+        client = cls._clients.get(phone)
+        if client is not None and client.is_connected():
+            return cls._lease(phone, client)
+        return None
+    
+    @classmethod
+    def peek_client(cls, phone: str) -> Optional[TelegramClient]:
+        """Cliente já conectado para o telefone, sem criar e sem lease (ex: verify_code após send_code)"""
+        client = cls._clients.get(phone)
+        if client is not None and client.is_connected():
+            cls._last_used[phone] = time.monotonic()
             return client
+        return None
     
     @classmethod
-    async def release_client(cls, phone: str, disconnect: bool = False):
+    async def release_client(cls, ref: Optional[ClientRef], disconnect: bool = False):
         """
-        Libera o cliente para uso por outras operações.
-        Se disconnect=True, desconecta completamente.
+        Devolve uma referência obtida com get_client/lease_existing (None é ignorado).
+        Se disconnect=True, desconecta quando a última referência for devolvida.
         """
-        cls._client_in_use[phone] = False
+        if ref is None:
+            return
+        phone = ref.phone
+        if ref.released:
+            logging.warning(f"[ClientManager] release_client repetido para {phone}; ignorado")
+            return
+        ref.released = True
+        refs = cls._refs.get(phone)
+        if not refs or ref not in refs:
+            # Cliente já removido do pool (close forçado, invalidação): nada a devolver
+            return
+        refs.discard(ref)
+        cls._last_used[phone] = time.monotonic()
+        if disconnect:
+            cls._close_on_release.add(phone)
         
-        if disconnect and phone in cls._clients:
-            try:
-                await cls._clients[phone].disconnect()
-            except:
-                pass
-            del cls._clients[phone]
+        if not refs:
+            cls._refs.pop(phone, None)
+            async with cls._capacity:
+                cls._capacity.notify_all()
+            if phone in cls._close_on_release and phone in cls._clients:
+                await cls._drop(phone)
+                logging.info(f"[ClientManager] Cliente desconectado para {phone}")
+    
+    @classmethod
+    async def close_client(cls, phone: str, force: bool = False):
+        """
+        Desconecta o cliente do telefone. Sem force, clientes com lease ativo só são
+        desconectados quando o último lease for devolvido.
+        """
+        if phone not in cls._clients:
+            return
+        if force or not cls._refs.get(phone):
+            await cls._drop(phone)
             logging.info(f"[ClientManager] Cliente desconectado para {phone}")
+        else:
+            cls._close_on_release.add(phone)
     
     @classmethod
     async def disconnect_all(cls):
         """Desconecta todos os clientes"""
         for phone in list(cls._clients.keys()):
-            try:
-                await cls._clients[phone].disconnect()
-            except:
-                pass
-        cls._clients.clear()
-        cls._client_in_use.clear()
+            await cls._drop(phone)
         logging.info(f"[ClientManager] Todos os clientes desconectados")
     
     @classmethod
     def is_client_in_use(cls, phone: str) -> bool:
-        """Verifica se o cliente está em uso"""
-        return cls._client_in_use.get(phone, False)
+        """Verifica se o cliente está em uso (alguma referência ativa)"""
+        return bool(cls._refs.get(phone))
     
     @classmethod
     async def invalidate_session(cls, phone: str):
         """
         Invalida a sessão quando há erro de IP.
-        Remove o arquivo de sessão para forçar re-login.
+        Remove a sessão armazenada para forçar re-login.
         """
-        # Desconectar cliente se existir
-        if phone in cls._clients:
-            try:
-                await cls._clients[phone].disconnect()
-            except:
-                pass
-            del cls._clients[phone]
+        # Desconectar cliente se existir (a sessão não vale mais para nenhum lease)
+        await cls.close_client(phone, force=True)
         
-        # Remover arquivo de sessão
-        session_file = f"sessions/{phone}.session"
+        # Remover sessão armazenada
         try:
-            if os.path.exists(session_file):
-                os.remove(session_file)
-                logging.warning(f"[ClientManager] Sessão invalidada para {phone}")
-            journal_file = f"{session_file}-journal"
-            if os.path.exists(journal_file):
-                os.remove(journal_file)
+            await remove_telegram_session(phone)
+            logging.warning(f"[ClientManager] Sessão invalidada para {phone}")
         except Exception as e:
             logging.error(f"[ClientManager] Erro ao remover sessão {phone}: {e}")
-
-# Instância global
-client_manager = TelegramClientManager
-
-def get_session_lock(phone: str) -> asyncio.Lock:
-    """Get or create a lock for a specific phone session"""
-    if phone not in session_locks:
-        session_locks[phone] = asyncio.Lock()
-    return session_locks[phone]
-
-async def force_release_stale_lock(phone: str):
-    """Força liberação de lock que está preso há muito tempo"""
-    if phone in lock_timestamps:
-        lock_time = lock_timestamps[phone]
-        elapsed = (datetime.now(timezone.utc) - lock_time).total_seconds()
-        if elapsed > MAX_LOCK_TIME:
-            # Lock está preso há muito tempo, criar um novo
-            logging.warning(f"Forçando liberação de lock preso para {phone} (preso há {elapsed:.0f}s)")
-            session_locks[phone] = asyncio.Lock()
-            if phone in lock_timestamps:
-                del lock_timestamps[phone]
-            return True
-    return False
-
-def force_release_all_locks():
-    """Força liberação de TODOS os locks - usar com cuidado"""
-    global session_locks, lock_timestamps
-    count = len(session_locks)
-    session_locks = {}
-    lock_timestamps = {}
-    logging.warning(f"Forçada liberação de {count} locks")
-    return count
-
-async def safe_acquire_lock(phone: str, timeout_seconds: int = 30):
-    """
-    Adquire lock de forma segura com timeout e detecção de locks presos.
-    Retorna o lock ou None se não conseguir.
-    """
-    # Primeiro, verifica se há lock preso
-    await force_release_stale_lock(phone)
     
-    lock = get_session_lock(phone)
+    @classmethod
+    async def _check_idle_clients(cls):
+        """Despeja ociosos antigos e faz keepalive nos demais ociosos (em uso já estão sendo exercitados)"""
+        now = time.monotonic()
+        for phone in list(cls._clients.keys()):
+            if cls._refs.get(phone):
+                continue
+            if phone in cls._pending_auth:
+                # Sem autorização o GetState falha; só sai quando o prazo do código acabar
+                if cls._is_pending_auth(phone):
+                    continue
+                cls._pending_auth.pop(phone, None)
+                cls._close_on_release.add(phone)
+            lease = account_leases.try_acquire(phone, LEASE_BACKGROUND, owner="keepalive")
+            if lease is None:
+                continue
+            try:
+                client = cls._clients.get(phone)
+                if client is None or cls._refs.get(phone):
+                    continue
+                if phone in cls._close_on_release:
+                    # Login abandonado: o código expirou sem verify_code
+                    logging.info(f"[ClientManager] Login de {phone} não concluído, desconectando")
+                    await cls._drop(phone)
+                    continue
+                if now - cls._last_used.get(phone, now) > CLIENT_IDLE_TIMEOUT_SECONDS:
+                    cls._pool_stats["evicted_idle"] += 1
+                    logging.info(f"[ClientManager] Desconectando cliente ocioso {phone}")
+                    await cls._drop(phone)
+                    continue
+                try:
+                    if not client.is_connected():
+                        raise ConnectionError("desconectado")
+                    await asyncio.wait_for(client(GetStateRequest()), timeout=15)
+                    cls._pool_stats["keepalives"] += 1
+                except Exception as e:
+                    cls._pool_stats["health_failures"] += 1
+                    logging.warning(f"[ClientManager] Cliente {phone} falhou no health check, removendo: {e}")
+                    await cls._drop(phone)
+            finally:
+                account_leases.release(lease)
     
-    # Se lock não está ocupado, adquire imediatamente
-    if not lock.locked():
-        try:
-            await lock.acquire()
-            lock_timestamps[phone] = datetime.now(timezone.utc)
-            return lock
-        except Exception as e:
-            logging.error(f"Erro ao adquirir lock para {phone}: {e}")
-            # Cria novo lock e tenta novamente
-            session_locks[phone] = asyncio.Lock()
-            lock = session_locks[phone]
-            await lock.acquire()
-            lock_timestamps[phone] = datetime.now(timezone.utc)
-            return lock
-    
-    # Lock está ocupado, tenta com timeout
-    try:
-        acquired = await asyncio.wait_for(lock.acquire(), timeout=timeout_seconds)
-        if acquired:
-            lock_timestamps[phone] = datetime.now(timezone.utc)
-            return lock
-    except asyncio.TimeoutError:
-        logging.warning(f"Timeout ao adquirir lock para {phone} após {timeout_seconds}s")
-        # Verifica se o lock está preso há muito tempo
-        was_stale = await force_release_stale_lock(phone)
-        if was_stale:
-            # Tenta novamente após forçar liberação
-            lock = get_session_lock(phone)
+    @classmethod
+    async def _maintenance_loop(cls):
+        while True:
+            await asyncio.sleep(CLIENT_KEEPALIVE_INTERVAL_SECONDS)
             try:
-                await lock.acquire()
-                lock_timestamps[phone] = datetime.now(timezone.utc)
-                return lock
-            except:
-                pass
-        # Última tentativa: criar novo lock
-        logging.warning(f"Criando novo lock para {phone} após timeout")
-        session_locks[phone] = asyncio.Lock()
-        lock = session_locks[phone]
-        await lock.acquire()
-        lock_timestamps[phone] = datetime.now(timezone.utc)
-        return lock
-    except Exception as e:
-        logging.error(f"Erro inesperado ao adquirir lock para {phone}: {e}")
-        # Cria novo lock como fallback
-        session_locks[phone] = asyncio.Lock()
-        lock = session_locks[phone]
-        await lock.acquire()
-        lock_timestamps[phone] = datetime.now(timezone.utc)
-        return lock
+                await cls._check_idle_clients()
+            except Exception as e:
+                logging.error(f"[ClientManager] Erro na manutenção do pool: {e}")
     
-    return None
+    @classmethod
+    def start_maintenance(cls):
+        if cls._maintenance_task is None:
+            cls._maintenance_task = asyncio.create_task(cls._maintenance_loop())
+    
+    @classmethod
+    def stop_maintenance(cls):
+        if cls._maintenance_task is not None:
+            cls._maintenance_task.cancel()
+            cls._maintenance_task = None
+    
+    @classmethod
+    def stats(cls) -> dict:
+        avg_ms = cls._avg_connect_ms()
+        operations = {}
+        for operation, s in cls._stats.items():
+            operations[operation] = {
+                "calls": s["calls"],
+                "reused": s["reused"],
+                "created": s["created"],
+                "avg_connect_ms": round(s["connect_ms"] / s["created"], 1) if s["created"] else None,
+                "connect_ms_saved": round(s["reused"] * avg_ms, 1)
+            }
+        return {
+            "connected": len(cls._clients),
+            "in_use": sum(1 for refs in cls._refs.values() if refs),
+            "leases": sum(len(refs) for refs in cls._refs.values()),
+            "pending_auth": len(cls._pending_auth),
+            "max_connected": MAX_CONNECTED_CLIENTS,
+            "idle_timeout_seconds": CLIENT_IDLE_TIMEOUT_SECONDS,
+            **cls._pool_stats,
+            "avg_connect_ms": round(avg_ms, 1),
+            "connect_ms_saved": round(sum(o["connect_ms_saved"] for o in operations.values()), 1),
+            "operations": operations
+        }
 
-def release_lock(phone: str, lock: asyncio.Lock):
-    """Libera lock de forma segura"""
-    try:
-        if lock and lock.locked():
-            lock.release()
-        if phone in lock_timestamps:
-            del lock_timestamps[phone]
-    except RuntimeError as e:
-        # Lock já foi liberado
-        logging.debug(f"Lock para {phone} já estava liberado: {e}")
-    except Exception as e:
-        logging.error(f"Erro ao liberar lock para {phone}: {e}")
+# Instância global
+client_manager = TelegramClientManager
 
 # Default API credentials (fallback)
 DEFAULT_API_CREDENTIALS = [
@@ -316,6 +1405,247 @@ DEFAULT_API_CREDENTIALS = [
     {"api_id": 26975297, "api_hash": "ad9a5e7295d458a156ef5769f7c7be42"}
 ]
 
+# ============== Caches em Memória ==============
+
+class LRUTTLCache:
+    """
+    Cache em memória com TTL curto e despejo LRU.
+    Usado para evitar idas ao Mongo em leituras repetidas (ex: usuário autenticado).
+    """
+    def __init__(self, name: str, max_size: int, ttl_seconds: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+# Cache de usuários autenticados (get_current_user)
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '10000'))
+user_cache = LRUTTLCache("users", USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+# Mapa user_id -> token_version usado para revogar tokens no modo stateless
+TOKEN_VERSION_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_VERSION_CACHE_TTL_SECONDS', '10'))
+token_version_cache = LRUTTLCache("token_versions", USER_CACHE_MAX_SIZE, TOKEN_VERSION_CACHE_TTL_SECONDS)
+
+def invalidate_user_cache(user_id: str):
+    """Remove o usuário do cache - chamar após qualquer alteração em db.users"""
+    user_cache.invalidate(user_id)
+    token_version_cache.invalidate(user_id)
+
+# Catálogo de grupos por usuário (/groups, /accounts/{id}/groups, broadcast)
+GROUP_CATALOG_FIELDS = ("id", "account_id", "account_phone", "telegram_id", "title", "username",
+                        "participants_count", "is_channel", "is_megagroup", "updated_at")
+GROUP_CATALOG_MAX_ROWS = int(os.environ.get('GROUP_CATALOG_MAX_ROWS', '200000'))
+# Rede de segurança para escritas feitas por outros workers; a invalidação explícita é a regra
+GROUP_CATALOG_TTL_SECONDS = float(os.environ.get('GROUP_CATALOG_TTL_SECONDS', '300'))
+
+class GroupCatalogCache:
+    """
+    Grupos de cada usuário em memória, lidos do Mongo uma vez e servidos daqui até a
+    próxima invalidação (refresh de grupos ou exclusão de conta).
+    Cada grupo fica como tupla (_id, *GROUP_CATALOG_FIELDS) ordenada por _id, e o
+    despejo LRU é limitado pelo total de linhas, não pelo número de usuários.
+    Índices por conta e por id fazem cada requisição expandir em dict só as linhas que
+    devolve. Catálogos maiores que o cache inteiro não são carregados: são lidos do Mongo
+    página a página.
+    """
+    def __init__(self, max_rows: int, ttl_seconds: float):
+        self.max_rows = max_rows
+        self.ttl_seconds = ttl_seconds
+        # user_id -> (linhas, lista de _id para bisect, carregado_em,
+        #             account_id -> posições, id do grupo -> posição)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._rows = 0
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached_reads = 0
+
+    async def _rows_for(self, user_id: str) -> Optional[tuple]:
+        """Entrada do cache (carregando se preciso) ou None se o catálogo não cabe no cache"""
+        entry = self._data.get(user_id)
+        if entry is not None and time.monotonic() - entry[2] <= self.ttl_seconds:
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        
+        if await cached_count("groups", {"user_id": user_id}) > self.max_rows:
+            self.uncached_reads += 1
+            return None
+        
+        invalidations = self._invalidations
+        docs = await self._find({"user_id": user_id}, self.max_rows + 1)
+        if len(docs) > self.max_rows:
+            # A contagem em cache estava desatualizada
+            self.uncached_reads += 1
+            return None
+        rows = tuple((doc["_id"],) + tuple(doc.get(f) for f in GROUP_CATALOG_FIELDS) for doc in docs)
+        by_account: Dict[str, List[int]] = {}
+        by_id: Dict[str, int] = {}
+        for i, row in enumerate(rows):
+            by_account.setdefault(row[2], []).append(i)
+            by_id[row[1]] = i
+        entry = (rows, [row[0] for row in rows], time.monotonic(), by_account, by_id)
+        
+        # Não guarda se houve invalidação durante a leitura
+        if invalidations == self._invalidations:
+            self._discard(user_id)
+            self._data[user_id] = entry
+            self._rows += len(rows)
+            while self._rows > self.max_rows:
+                self._discard(next(iter(self._data)))
+                self.evictions += 1
+        return entry
+
+    def _discard(self, user_id: str):
+        entry = self._data.pop(user_id, None)
+        if entry is not None:
+            self._rows -= len(entry[0])
+
+    @staticmethod
+    def _to_doc(row: tuple, user_id: str) -> dict:
+        doc = dict(zip(GROUP_CATALOG_FIELDS, row[1:]))
+        doc["user_id"] = user_id
+        return doc
+
+    @staticmethod
+    async def _find(query: dict, limit: Optional[int]) -> List[dict]:
+        projection = {f: 1 for f in GROUP_CATALOG_FIELDS}
+        cursor = db.groups.find(query, projection).sort("_id", 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    @staticmethod
+    def _from_db(doc: dict, user_id: str) -> dict:
+        group = {f: doc.get(f) for f in GROUP_CATALOG_FIELDS}
+        group["user_id"] = user_id
+        return group
+
+    async def list(self, user_id: str, account_id: Optional[str] = None,
+                   group_ids: Optional[List[str]] = None, limit: Optional[int] = None) -> List[dict]:
+        entry = await self._rows_for(user_id)
+        if entry is None:
+            query = {"user_id": user_id}
+            if account_id is not None:
+                query["account_id"] = account_id
+            if group_ids:
+                query["id"] = {"$in": group_ids}
+            return [self._from_db(doc, user_id) for doc in await self._find(query, limit)]
+        
+        rows, _, _, by_account, by_id = entry
+        if group_ids:
+            positions = sorted({by_id[group_id] for group_id in group_ids if group_id in by_id})
+            if account_id is not None:
+                positions = [i for i in positions if rows[i][2] == account_id]
+        elif account_id is not None:
+            positions = by_account.get(account_id, [])
+        else:
+            positions = range(len(rows))
+        if limit is not None:
+            positions = positions[:limit]
+        return [self._to_doc(rows[i], user_id) for i in positions]
+
+    async def page(self, user_id: str, after_id: Optional[ObjectId], limit: int) -> tuple:
+        """Página por _id (mesma ordem do keyset do Mongo). Retorna (grupos, último _id ou None, total)"""
+        entry = await self._rows_for(user_id)
+        if entry is None:
+            query = {"user_id": user_id}
+            if after_id is not None:
+                query["_id"] = {"$gt": after_id}
+            docs = await self._find(query, limit + 1)
+            last_id = docs[limit - 1]["_id"] if len(docs) > limit else None
+            groups = [self._from_db(doc, user_id) for doc in docs[:limit]]
+            return groups, last_id, await cached_count("groups", {"user_id": user_id})
+        
+        rows, ids = entry[0], entry[1]
+        start = bisect.bisect_right(ids, after_id) if after_id is not None else 0
+        page_rows = rows[start:start + limit]
+        last_id = page_rows[-1][0] if start + limit < len(rows) and page_rows else None
+        return [self._to_doc(row, user_id) for row in page_rows], last_id, len(rows)
+
+    def invalidate(self, user_id: str):
+        self._invalidations += 1
+        self._discard(user_id)
+
+    def invalidate_object_id(self, object_id: ObjectId):
+        """Invalida o usuário que tem este _id em cache (eventos de delete não trazem o user_id)"""
+        self._invalidations += 1
+        for user_id, entry in list(self._data.items()):
+            ids = entry[1]
+            i = bisect.bisect_left(ids, object_id)
+            if i < len(ids) and ids[i] == object_id:
+                self._discard(user_id)
+
+    def clear(self):
+        self._invalidations += 1
+        self._data.clear()
+        self._rows = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._data),
+            "rows": self._rows,
+            "max_rows": self.max_rows,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "uncached_reads": self.uncached_reads,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+group_catalog = GroupCatalogCache(GROUP_CATALOG_MAX_ROWS, GROUP_CATALOG_TTL_SECONDS)
+
+# user_id -> tem compra aprovada do marketplace (invalidado ao aprovar/rejeitar)
+MARKETPLACE_ACCESS_CACHE_TTL_SECONDS = float(os.environ.get('MARKETPLACE_ACCESS_CACHE_TTL_SECONDS', '60'))
+marketplace_access_cache = LRUTTLCache("marketplace_access", USER_CACHE_MAX_SIZE, MARKETPLACE_ACCESS_CACHE_TTL_SECONDS)
+
 # ============== Pydantic Models ==============
 
 # User Models
@@ -387,65 +1717,196 @@ class DailyUsage(BaseModel):
     broadcast_groups: int = 0
     add_to_group: int = 0
 
-async def get_daily_usage(user_id: str) -> dict:
-    """Get or create daily usage record for user"""
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    usage = await db.daily_usage.find_one({"user_id": user_id, "date": today})
-    if not usage:
-        usage = {
-            "id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "date": today,
-            "extract_members": 0,
-            "send_messages": 0,
-            "broadcast_groups": 0,
-            "add_to_group": 0
+USAGE_FIELDS = ("extract_members", "send_messages", "broadcast_groups", "add_to_group")
+# Após este tempo o valor base é relido do Mongo (outros workers podem ter reservado cota)
+USAGE_RELOAD_SECONDS = float(os.environ.get('USAGE_RELOAD_SECONDS', '60'))
+USAGE_COUNTERS_MAX_ENTRIES = int(os.environ.get('USAGE_COUNTERS_MAX_ENTRIES', '50000'))
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+class UsageCounterStore:
+    """
+    Cache de leitura dos contadores de uso diário por (user_id, data).
+    check_limit responde localmente; toda escrita é atômica no Mongo (reserve_quota /
+    QuotaReservation.commit), que devolvem o valor gravado via apply_db_value.
+    A data faz parte da chave, então a virada à meia-noite UTC cria contadores novos
+    e os do dia anterior são descartados.
+    """
+    def __init__(self, reload_seconds: float, max_entries: int):
+        self.reload_seconds = reload_seconds
+        self.max_entries = max_entries
+        # (user_id, date) -> {"base": dict | None, "version": int, "loaded_at": float}
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.loads = 0
+        self.local_reads = 0
+
+    def _entry(self, key: tuple) -> dict:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {"base": None, "version": 0, "loaded_at": 0.0}
+            self._entries[key] = entry
+            self._evict()
+        self._entries.move_to_end(key)
+        return entry
+
+    async def _load(self, user_id: str, date: str, entry: dict):
+        version = entry["version"]
+        doc = await db.daily_usage.find_one({"user_id": user_id, "date": date}, {"_id": 0}) or {}
+        # Uma reserva que terminou durante a leitura já deixou um valor mais novo no cache
+        if entry["version"] != version and entry["base"] is not None:
+            self.local_reads += 1
+            return
+        entry["base"] = {f: doc.get(f, 0) for f in USAGE_FIELDS}
+        entry["loaded_at"] = time.monotonic()
+        self.loads += 1
+
+    async def get(self, user_id: str, date: str) -> dict:
+        entry = self._entry((user_id, date))
+        stale = time.monotonic() - entry["loaded_at"] > self.reload_seconds
+        if entry["base"] is None or stale:
+            await self._load(user_id, date, entry)
+        else:
+            self.local_reads += 1
+        
+        usage = {"user_id": user_id, "date": date}
+        for f in USAGE_FIELDS:
+            usage[f] = entry["base"].get(f, 0)
+        return usage
+
+    def apply_db_value(self, user_id: str, date: str, field: str, value: int):
+        """Atualiza o cache com um valor lido atomicamente do Mongo (ex: reserve_quota)"""
+        entry = self._entries.get((user_id, date))
+        if entry and entry["base"] is not None:
+            entry["base"][field] = value
+            entry["version"] += 1
+
+    def _evict(self):
+        """Descarta contadores de dias anteriores e aplica o limite LRU"""
+        today = _today()
+        for key in [k for k in self._entries if k[1] != today]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "loads": self.loads,
+            "local_reads": self.local_reads
         }
-        await db.daily_usage.insert_one(usage)
-    return usage
-
-async def increment_usage(user_id: str, field: str, amount: int = 1):
-    """Increment a usage counter"""
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    await db.daily_usage.update_one(
-        {"user_id": user_id, "date": today},
-        {"$inc": {field: amount}},
-        upsert=True
-    )
+
+usage_counters = UsageCounterStore(USAGE_RELOAD_SECONDS, USAGE_COUNTERS_MAX_ENTRIES)
+
+async def get_daily_usage(user_id: str) -> dict:
+    """Get daily usage for user from the in-memory read cache"""
+    return await usage_counters.get(user_id, _today())
+
+# action -> (chave do limite no plano, campo de uso diário)
+QUOTA_ACTIONS = {
+    "extract_members": ("daily_extract_members", "extract_members"),
+    "send_messages": ("daily_send_messages", "send_messages"),
+    "broadcast_groups": ("daily_broadcast_groups", "broadcast_groups"),
+    "add_to_group": ("daily_add_to_group", "add_to_group"),
+}
+
+def _limit_exhausted_message(plan: str, max_limit: int) -> str:
+    if max_limit == 0:
+        if plan == "free":
+            return f"❌ Esta função não está disponível no plano FREE. Faça upgrade para o plano BÁSICO ou PREMIUM!"
+        return f"❌ Limite atingido para hoje. Volte amanhã!"
+    return f"❌ Limite diário atingido ({max_limit}). Volte amanhã ou faça upgrade do plano!"
 
 async def check_limit(user_id: str, plan: str, action: str, requested_amount: int = 1) -> tuple:
     """Check if user can perform action. Returns (can_do, remaining, message)"""
     limits = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
     usage = await get_daily_usage(user_id)
     
-    limit_map = {
-        "extract_members": ("daily_extract_members", "extract_members"),
-        "send_messages": ("daily_send_messages", "send_messages"),
-        "broadcast_groups": ("daily_broadcast_groups", "broadcast_groups"),
-        "add_to_group": ("daily_add_to_group", "add_to_group"),
-    }
-    
-    if action not in limit_map:
+    if action not in QUOTA_ACTIONS:
         return True, 999999, ""
     
-    limit_key, usage_key = limit_map[action]
+    limit_key, usage_key = QUOTA_ACTIONS[action]
     max_limit = limits[limit_key]
     current_usage = usage.get(usage_key, 0)
     remaining = max_limit - current_usage
     
-    if max_limit == 0:
-        if plan == "free":
-            return False, 0, f"❌ Esta função não está disponível no plano FREE. Faça upgrade para o plano BÁSICO ou PREMIUM!"
-        return False, 0, f"❌ Limite atingido para hoje. Volte amanhã!"
-    
-    if remaining <= 0:
-        return False, 0, f"❌ Limite diário atingido ({max_limit}). Volte amanhã ou faça upgrade do plano!"
+    if max_limit == 0 or remaining <= 0:
+        return False, 0, _limit_exhausted_message(plan, max_limit)
     
     if requested_amount > remaining:
         return False, remaining, f"⚠️ Você só pode fazer mais {remaining} hoje. Limite diário: {max_limit}"
     
     return True, remaining, ""
 
+class QuotaReservation:
+    """
+    Cota reservada atomicamente por reserve_quota.
+    commit(usado) devolve a parte não utilizada; refund() devolve tudo.
+    """
+    def __init__(self, user_id: str, date: str, field: str, granted: int, remaining: int, message: str = ""):
+        self.user_id = user_id
+        self.date = date
+        self.field = field
+        self.granted = granted
+        self.remaining = remaining  # Cota restante no dia após a reserva
+        self.message = message
+        self._settled = granted == 0
+
+    async def commit(self, used: int):
+        if self._settled:
+            return
+        self._settled = True
+        unused = self.granted - max(0, min(used, self.granted))
+        self.granted -= unused
+        if unused > 0:
+            doc = await db.daily_usage.find_one_and_update(
+                {"user_id": self.user_id, "date": self.date},
+                {"$inc": {self.field: -unused}},
+                projection={"_id": 0, self.field: 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if doc:
+                usage_counters.apply_db_value(self.user_id, self.date, self.field, doc.get(self.field, 0))
+            self.remaining += unused
+
+    async def refund(self):
+        await self.commit(0)
+
+async def reserve_quota(user: dict, action: str, amount: int) -> QuotaReservation:
+    """
+    Reserva até `amount` unidades da cota diária com um único find_one_and_update
+    condicional (upsert + pipeline). Retorna a quantidade concedida - pode ser menor
+    que a pedida, ou zero com a mensagem de limite, sem risco de ultrapassar o limite
+    com requisições concorrentes.
+    """
+    plan = user.get('plan', 'free')
+    limits = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
+    limit_key, usage_key = QUOTA_ACTIONS[action]
+    max_limit = limits[limit_key]
+    date = _today()
+    
+    if max_limit == 0 or amount <= 0:
+        return QuotaReservation(user['id'], date, usage_key, 0, 0, _limit_exhausted_message(plan, max_limit))
+    
+    current = {"$ifNull": [f"${usage_key}", 0]}
+    before = await db.daily_usage.find_one_and_update(
+        {"user_id": user['id'], "date": date},
+        [{"$set": {
+            "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+            usage_key: {"$max": [current, {"$min": [max_limit, {"$add": [current, amount]}]}]}
+        }}],
+        projection={"_id": 0, usage_key: 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    used_before = (before or {}).get(usage_key, 0)
+    granted = max(0, min(max_limit, used_before + amount) - used_before)
+    usage_counters.apply_db_value(user['id'], date, usage_key, used_before + granted)
+    
+    remaining = max(0, max_limit - used_before - granted)
+    message = "" if granted else _limit_exhausted_message(plan, max_limit)
+    return QuotaReservation(user['id'], date, usage_key, granted, remaining, message)
+
 # Account Models
 class Account(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -536,6 +1997,110 @@ class ActionLog(BaseModel):
     details: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+ACTION_LOG_QUEUE_SIZE = int(os.environ.get('ACTION_LOG_QUEUE_SIZE', '10000'))
+ACTION_LOG_BATCH_SIZE = int(os.environ.get('ACTION_LOG_BATCH_SIZE', '500'))
+ACTION_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get('ACTION_LOG_FLUSH_INTERVAL_SECONDS', '2'))
+# Logs mais antigos que isso são apagados pelo índice TTL (0 = guardar para sempre).
+# Desligado por padrão: ligar apaga o histórico antigo já existente
+ACTION_LOG_RETENTION_DAYS = int(os.environ.get('ACTION_LOG_RETENTION_DAYS', '0'))
+
+class ActionLogSink:
+    """
+    Gravação diferida dos ActionLogs: as rotas só enfileiram (sem await no Mongo) e
+    uma task em segundo plano grava com insert_many quando o lote enche, quando
+    passa ACTION_LOG_FLUSH_INTERVAL_SECONDS ou no shutdown.
+    Com a fila cheia o log é descartado (e contado) em vez de segurar a requisição.
+    """
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        # insert_many em andamento; o shutdown espera em vez de gravar o lote de novo
+        self._inflight: Optional[asyncio.Future] = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def log(self, log: ActionLog):
+        try:
+            self._queue.put_nowait(log.model_dump())
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning(f"[ActionLogSink] Fila cheia, log descartado: {log.action_type} de {log.user_id}")
+
+    async def _write(self, batch: List[dict]):
+        try:
+            await db.action_logs.insert_many(batch, ordered=False)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logging.error(f"[ActionLogSink] Erro ao gravar {len(batch)} logs: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch: List[dict] = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # O lote passa para a gravação antes do await: um cancelamento no meio do
+                # insert_many não grava os mesmos logs duas vezes
+                self._inflight = asyncio.ensure_future(self._write(batch))
+                batch = []
+                await asyncio.shield(self._inflight)
+        except asyncio.CancelledError:
+            # Shutdown: não perde o lote que já saiu da fila
+            if batch:
+                await self._write(batch)
+            raise
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight is not None:
+            await asyncio.gather(self._inflight, return_exceptions=True)
+            self._inflight = None
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "retention_days": ACTION_LOG_RETENTION_DAYS
+        }
+
+action_log_sink = ActionLogSink(ACTION_LOG_QUEUE_SIZE, ACTION_LOG_BATCH_SIZE, ACTION_LOG_FLUSH_INTERVAL_SECONDS)
+
 # Public Groups Marketplace Models
 class PublicGroup(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -574,84 +2139,405 @@ class AddToGroupRequest(BaseModel):
     delay_min: int = 30
     delay_max: int = 60
 
+# ============== Limite de Tentativas de Login ==============
+
+class LoginRateLimiter:
+    """
+    Token bucket em memória por chave (email ou IP).
+    O balde recarrega continuamente ao longo da janela, funcionando como uma
+    janela deslizante; o número de chaves é limitado com despejo LRU.
+    """
+    def __init__(self, name: str, attempts: int, window_seconds: float, max_keys: int):
+        self.name = name
+        self.capacity = float(attempts)
+        self.refill_per_second = attempts / window_seconds
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    def _current_tokens(self, key: str, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, updated_at = bucket
+        return min(self.capacity, tokens + (now - updated_at) * self.refill_per_second)
+
+    def retry_after(self, key: str) -> float:
+        """Segundos até a próxima tentativa permitida (0 = pode tentar agora)"""
+        tokens = self._current_tokens(key, time.monotonic())
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.refill_per_second
+
+    def consume(self, key: str):
+        now = time.monotonic()
+        tokens = self._current_tokens(key, now)
+        self._buckets[key] = (max(tokens - 1, 0.0), now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def reset(self, key: str):
+        self._buckets.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._buckets),
+            "max_keys": self.max_keys,
+            "allowed": self.allowed,
+            "rejected": self.rejected
+        }
+
+LOGIN_RATE_WINDOW_SECONDS = float(os.environ.get('LOGIN_RATE_WINDOW_SECONDS', '300'))
+LOGIN_RATE_EMAIL_ATTEMPTS = int(os.environ.get('LOGIN_RATE_EMAIL_ATTEMPTS', '5'))
+LOGIN_RATE_IP_ATTEMPTS = int(os.environ.get('LOGIN_RATE_IP_ATTEMPTS', '20'))
+LOGIN_RATE_MAX_KEYS = int(os.environ.get('LOGIN_RATE_MAX_KEYS', '50000'))
+login_email_limiter = LoginRateLimiter("email", LOGIN_RATE_EMAIL_ATTEMPTS, LOGIN_RATE_WINDOW_SECONDS, LOGIN_RATE_MAX_KEYS)
+login_ip_limiter = LoginRateLimiter("ip", LOGIN_RATE_IP_ATTEMPTS, LOGIN_RATE_WINDOW_SECONDS, LOGIN_RATE_MAX_KEYS)
+
+# Proxies reversos cujo X-Forwarded-For é confiável (IPs ou redes CIDR, separados por vírgula)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if item.strip()
+]
+
+def _is_trusted_proxy(host: Optional[str]) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def get_client_ip(request: Request) -> str:
+    """
+    IP do cliente. X-Forwarded-For só é considerado quando a conexão vem de um proxy confiável;
+    nesse caso o cliente é o primeiro endereço, da direita para a esquerda, que não é proxy
+    confiável (entradas à esquerda podem ser forjadas pelo cliente).
+    """
+    host = request.client.host if request.client else None
+    if not host:
+        return "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded or not _is_trusted_proxy(host):
+        return host
+    for hop in reversed([h.strip() for h in forwarded.split(",") if h.strip()]):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return host
+
+def check_login_rate_limit(email: str, request: Request):
+    """
+    Consome uma tentativa dos baldes de email e IP.
+    Responde 429 antes de qualquer consulta ao banco ou verificação bcrypt.
+    """
+    ip = get_client_ip(request)
+    email_retry = login_email_limiter.retry_after(email)
+    ip_retry = login_ip_limiter.retry_after(ip)
+    retry_after = max(email_retry, ip_retry)
+    if retry_after > 0:
+        if email_retry > 0:
+            login_email_limiter.rejected += 1
+        if ip_retry > 0:
+            login_ip_limiter.rejected += 1
+        raise HTTPException(
+            status_code=429,
+            detail=f"Muitas tentativas de login. Tente novamente em {int(retry_after) + 1}s.",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+    login_email_limiter.consume(email)
+    login_ip_limiter.consume(ip)
+    login_email_limiter.allowed += 1
+    login_ip_limiter.allowed += 1
+
 # ============== Authentication Helpers ==============
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+_password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_CONCURRENCY,
+    thread_name_prefix="bcrypt"
+)
+_password_semaphore = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
+password_hash_stats = {
+    "calls": 0,
+    "rejected": 0,
+    "waiting": 0,
+    "total_wait_ms": 0.0,
+    "max_wait_ms": 0.0,
+    "total_run_ms": 0.0
+}
+
+async def _run_password_op(func, *args):
+    """
+    Executa uma operação bcrypt no pool dedicado.
+    Limita a concorrência e mede quanto tempo cada requisição esperou por uma vaga.
+    """
+    if password_hash_stats["waiting"] >= PASSWORD_HASH_MAX_QUEUE:
+        password_hash_stats["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Servidor ocupado. Tente novamente em alguns segundos.")
+    
+    queued_at = time.perf_counter()
+    password_hash_stats["waiting"] += 1
+    try:
+        await _password_semaphore.acquire()
+    finally:
+        password_hash_stats["waiting"] -= 1
+    
+    started_at = time.perf_counter()
+    wait_ms = (started_at - queued_at) * 1000
+    password_hash_stats["calls"] += 1
+    password_hash_stats["total_wait_ms"] += wait_ms
+    password_hash_stats["max_wait_ms"] = max(password_hash_stats["max_wait_ms"], wait_ms)
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        password_hash_stats["total_run_ms"] += (time.perf_counter() - started_at) * 1000
+        _password_semaphore.release()
+
+def get_password_hash_stats() -> dict:
+    calls = password_hash_stats["calls"]
+    return {
+        **password_hash_stats,
+        "concurrency": PASSWORD_HASH_CONCURRENCY,
+        "max_queue": PASSWORD_HASH_MAX_QUEUE,
+        "avg_wait_ms": round(password_hash_stats["total_wait_ms"] / calls, 2) if calls else 0.0,
+        "avg_run_ms": round(password_hash_stats["total_run_ms"] / calls, 2) if calls else 0.0
+    }
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def hash_password(password: str) -> str:
+    return await _run_password_op(pwd_context.hash, password)
 
-def create_access_token(user_id: str) -> str:
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_op(pwd_context.verify, plain_password, hashed_password)
+
+def create_access_token(user: dict) -> str:
+    """
+    Gera o token de sessão. Além do 'sub', assina os dados usados na autorização
+    (plano, admin e token_version) para que as rotas não precisem recarregar o usuário.
+    """
     expire = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+    plan_expires_at = user.get('plan_expires_at')
+    if isinstance(plan_expires_at, datetime):
+        plan_expires_at = plan_expires_at.isoformat()
     payload = {
-        "sub": user_id,
+        "sub": user['id'],
+        "email": user['email'],
+        "name": user['name'],
+        "plan": user.get('plan', 'free'),
+        "plan_expires_at": plan_expires_at,
+        "is_admin": user.get('is_admin', False),
+        "tv": user.get('token_version', 0),
         "exp": expire
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+async def get_token_version(user_id: str) -> Optional[int]:
+    """Versão atual dos tokens do usuário (None se o usuário não existe)"""
+    version = token_version_cache.get(user_id)
+    if version is not None:
+        return version
+    
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "token_version": 1, "id": 1})
+        if not user:
+            return None
+    version = user.get('token_version', 0)
+    token_version_cache.set(user_id, version)
+    return version
+
+async def revoke_user_sessions(user_id: str):
+    """Invalida todos os tokens emitidos para o usuário incrementando token_version"""
+    await db.users.update_one({"id": user_id}, {"$inc": {"token_version": 1}})
+    invalidate_user_cache(user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     try:
         token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("sub")
+        # Tokens antigos do admin_login usavam 'user_id' no lugar de 'sub'
+        user_id = payload.get("sub") or payload.get("user_id")
         if not user_id:
             raise HTTPException(status_code=401, detail="Token inválido")
         
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="Usuário não encontrado")
+        token_version = payload.get("tv", 0)
+        
+        # Caminho rápido: autoriza pelas claims assinadas, conferindo apenas a versão
+        if JWT_STATELESS_CLAIMS and "tv" in payload:
+            current_version = await get_token_version(user_id)
+            if current_version is None:
+                raise HTTPException(status_code=401, detail="Usuário não encontrado")
+            if token_version != current_version:
+                raise HTTPException(status_code=401, detail="Sessão revogada. Faça login novamente.")
+            return {
+                "id": user_id,
+                "email": payload.get("email"),
+                "name": payload.get("name"),
+                "plan": payload.get("plan", "free"),
+                "plan_expires_at": payload.get("plan_expires_at"),
+                "is_admin": payload.get("is_admin", False),
+                "token_version": token_version
+            }
         
-        return user
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="Usuário não encontrado")
+            user_cache.set(user_id, user)
+        
+        if token_version != user.get('token_version', 0):
+            raise HTTPException(status_code=401, detail="Sessão revogada. Faça login novamente.")
+        
+        # Cópia rasa para que as rotas não alterem a entrada do cache
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
+# ============== Pagination ==============
+
+# Contagens totais (include_total) são caras em coleções grandes - ficam em cache por pouco tempo
+COUNT_CACHE_TTL_SECONDS = float(os.environ.get('COUNT_CACHE_TTL_SECONDS', '30'))
+count_cache = LRUTTLCache("counts", 10000, COUNT_CACHE_TTL_SECONDS)
+
+def encode_cursor(sort_value: Any, last_id: ObjectId) -> str:
+    """Cursor opaco com o valor de ordenação e o _id do último item da página"""
+    if isinstance(sort_value, datetime):
+        sort_value = {"$date": sort_value.isoformat()}
+    raw = json.dumps([sort_value, str(last_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if isinstance(sort_value, dict) and "$date" in sort_value:
+            sort_value = datetime.fromisoformat(sort_value["$date"])
+        return sort_value, ObjectId(last_id)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+# Ordem dos tipos BSON na ordenação do Mongo (os que aparecem em cursores). $gt/$lt só comparam
+# valores do mesmo tipo, então a condição do cursor precisa incluir os tipos que vêm depois (ou antes).
+# Nulo e campo ausente ordenam juntos, antes de tudo.
+BSON_SORT_TYPES = [
+    ["double", "int", "long", "decimal"],
+    ["string", "symbol"],
+    ["object"],
+    ["array"],
+    ["binData"],
+    ["objectId"],
+    ["bool"],
+    ["date"],
+    ["timestamp"],
+    ["regex"],
+]
+
+def _bson_sort_rank(value: Any) -> Optional[int]:
+    """Posição do valor em BSON_SORT_TYPES (-1 = nulo/ausente; None = tipo não suportado no cursor)"""
+    if value is None:
+        return -1
+    if isinstance(value, bool):
+        return 6
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, str):
+        return 1
+    if isinstance(value, datetime):
+        return 7
+    return None
+
+def _after_value_condition(field: str, value: Any, direction: int) -> list:
+    """Cláusulas de 'valor de ordenação estritamente depois de value', atravessando tipos"""
+    rank = _bson_sort_rank(value)
+    op = "$gt" if direction == 1 else "$lt"
+    if rank is None:
+        return [{field: {op: value}}]
+    clauses = []
+    if rank >= 0:
+        clauses.append({field: {op: value}})
+    if direction == 1:
+        later = [t for group in BSON_SORT_TYPES[rank + 1:] for t in group]
+        if later:
+            clauses.append({field: {"$type": later}})
+    else:
+        earlier = [t for group in BSON_SORT_TYPES[:max(rank, 0)] for t in group]
+        if earlier:
+            clauses.append({field: {"$type": earlier}})
+        if rank >= 0:
+            # Nulos/ausentes vêm antes de qualquer valor
+            clauses.append({field: None})
+    return clauses
+
+def keyset_query(query: dict, after: Optional[str], sort_field: str = "_id", direction: int = 1) -> dict:
+    """
+    Acrescenta à consulta a condição 'depois do cursor' para a ordenação (sort_field, _id).
+    Valores nulos/ausentes e campos com tipos mistos (ex: created_at ainda string) seguem a
+    ordem de tipos do BSON, então nenhuma linha é pulada.
+    """
+    if not after:
+        return query
+    sort_value, last_id = decode_cursor(after)
+    op = "$gt" if direction == 1 else "$lt"
+    if sort_field == "_id":
+        condition = {"_id": {op: last_id}}
+    else:
+        condition = {"$or": _after_value_condition(sort_field, sort_value, direction) + [
+            {sort_field: sort_value, "_id": {op: last_id}}
+        ]}
+    return {"$and": [query, condition]} if query else condition
+
+async def fetch_page(collection: str, query: dict, after: Optional[str], limit: int,
+                     projection: Optional[dict] = None, sort_field: str = "_id", direction: int = 1) -> tuple:
+    """
+    Busca uma página por keyset (sem skip), ordenada de forma estável por (sort_field, _id).
+    Retorna (documentos sem _id, próximo cursor ou None).
+    """
+    sort = [("_id", direction)] if sort_field == "_id" else [(sort_field, direction), ("_id", direction)]
+    projection = {k: v for k, v in (projection or {}).items() if k != "_id"} or None
+    docs = await db[collection].find(
+        keyset_query(query, after, sort_field, direction), projection
+    ).sort(sort).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor(last.get(sort_field) if sort_field != "_id" else None, last["_id"])
+    for doc in docs:
+        doc.pop("_id", None)
+    return docs, next_cursor
+
+async def cached_count(collection: str, query: dict) -> int:
+    key = (collection, json.dumps(query, sort_keys=True, default=str))
+    total = count_cache.get(key)
+    if total is None:
+        total = await db[collection].count_documents(query)
+        count_cache.set(key, total)
+    return total
+
+def set_page_headers(response: Response, next_cursor: Optional[str], total: Optional[int] = None):
+    """Endpoints que retornam lista informam a paginação por headers (corpo continua sendo a lista)"""
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+
 # ============== Telegram Helpers ==============
 
 async def get_available_account(user_id: str):
+    # Conta usada há mais tempo primeiro (last_used nulo ordena antes)
     accounts = await db.accounts.find({
         "user_id": user_id,
         "is_active": True,
         "session_string": {"$ne": None, "$ne": "", "$exists": True}
-    }, {"_id": 0}).to_list(100)
+    }, {"_id": 0}).sort("last_used", 1).limit(1).to_list(1)
     if not accounts:
         return None
-    
-    accounts.sort(key=lambda x: x.get('last_used', datetime.min.replace(tzinfo=timezone.utc)))
     return accounts[0]
 
-async def create_telegram_client(phone: str, api_id: int, api_hash: str, session_string: str = None, check_auth: bool = True):
-    session_name = f"sessions/{phone}"
-    
-    # Configure SQLite to wait longer for locks
-    sqlite3.connect(f"{session_name}.session", timeout=30.0).close()
-    
-    client = TelegramClient(
-        session_name, 
-        api_id, 
-        api_hash,
-        connection_retries=3,
-        retry_delay=1,
-        timeout=30
-    )
-    
-    try:
-        await client.connect()
-        
-        if check_auth and not await client.is_user_authorized():
-            await client.disconnect()
-            raise Exception(f"Conta {phone} não está autenticada. Por favor, faça login novamente.")
-        
-        return client
-    except Exception as e:
-        try:
-            await client.disconnect()
-        except:
-            pass
-        raise e
-
 async def send_broadcast_update(user_id: str, data: dict):
     """Send update to all WebSocket connections for this user"""
     if user_id in broadcast_connections:
@@ -677,16 +2563,15 @@ async def register(input: UserCreate):
     # Create user
     user = User(
         email=input.email.lower(),
-        password_hash=hash_password(input.password),
+        password_hash=await hash_password(input.password),
         name=input.name
     )
     
     doc = user.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.users.insert_one(doc)
     
     # Create token
-    token = create_access_token(user.id)
+    token = create_access_token(doc)
     
     return {
         "token": token,
@@ -698,15 +2583,19 @@ async def register(input: UserCreate):
     }
 
 @api_router.post("/auth/login")
-async def login(input: UserLogin):
-    user = await db.users.find_one({"email": input.email.lower()}, {"_id": 0})
+async def login(input: UserLogin, request: Request):
+    email = input.email.lower()
+    check_login_rate_limit(email, request)
+    
+    user = await db.users.find_one({"email": email}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="Email ou senha incorretos")
     
-    if not verify_password(input.password, user['password_hash']):
+    if not await verify_password(input.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Email ou senha incorretos")
     
-    token = create_access_token(user['id'])
+    login_email_limiter.reset(email)
+    token = create_access_token(user)
     
     return {
         "token": token,
@@ -721,7 +2610,7 @@ async def login(input: UserLogin):
 
 @api_router.get("/auth/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
-    # Get daily usage
+    # Usuário e uso diário vêm da memória - zero ou uma consulta ao Mongo
     usage = await get_daily_usage(current_user['id'])
     plan = current_user.get('plan', 'free')
     limits = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
@@ -742,39 +2631,85 @@ async def get_me(current_user: dict = Depends(get_current_user)):
         }
     }
 
+@api_router.post("/auth/logout-all")
+async def logout_all(current_user: dict = Depends(get_current_user)):
+    """Encerra todas as sessões do usuário (revoga todos os tokens emitidos)"""
+    await revoke_user_sessions(current_user['id'])
+    return {"message": "Todas as sessões foram encerradas"}
+
 # ============== Admin Routes ==============
 
 ADMIN_SECRET = os.environ.get('ADMIN_SECRET', 'admin_super_secret_2024')
 
 @api_router.post("/admin/login")
-async def admin_login(email: str = "", password: str = ""):
+async def admin_login(request: Request, email: str = "", password: str = ""):
     """Admin login - special route for admin panel"""
+    email = email.lower()
+    check_login_rate_limit(email, request)
+    
     user = await db.users.find_one({"email": email}, {"_id": 0})
-    if not user or not pwd_context.verify(password, user['password_hash']):
+    if not user or not await verify_password(password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
+    login_email_limiter.reset(email)
     if not user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso não autorizado")
     
-    token = jwt.encode({
-        "user_id": user['id'],
-        "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
-    }, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    token = create_access_token(user)
     
     return {"token": token, "user": {"id": user['id'], "email": user['email'], "name": user['name'], "is_admin": True}}
 
+# Campos aceitos para ordenação server-side na listagem de usuários do admin
+ADMIN_USER_SORT_FIELDS = {"created_at", "email", "name", "plan"}
+
 @api_router.get("/admin/users")
-async def admin_get_users(current_user: dict = Depends(get_current_user)):
-    """Get all users (admin only)"""
+async def admin_get_users(
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    include_total: bool = False,
+    plan: Optional[str] = Query(None, pattern="^(free|basic|premium)$"),
+    sort: Optional[str] = None,
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get all users with their account counts (admin only) in a single aggregation.
+    Optional plan filter and sort (created_at, email, name, plan); paginated by cursor (X-Next-Cursor header).
+    Every sort field has a (field, _id) index; nulls and mixed types are paged by keyset_query.
+    """
     if not current_user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso não autorizado")
     
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+    if sort is not None and sort not in ADMIN_USER_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Campo de ordenação inválido")
+    sort_field = sort or "_id"
+    direction = 1 if order == "asc" else -1
+    
+    match = {}
+    if plan:
+        # Usuários antigos sem o campo plan são FREE
+        match["plan"] = {"$in": ["free", None]} if plan == "free" else plan
+    
+    sort_spec = {"_id": direction} if sort_field == "_id" else {sort_field: direction, "_id": direction}
+    pipeline = [
+        {"$match": keyset_query(match, after, sort_field, direction)},
+        {"$sort": sort_spec},
+        {"$limit": limit + 1},
+        {"$lookup": {"from": "accounts", "localField": "id", "foreignField": "user_id", "as": "_accounts"}},
+        {"$addFields": {"accounts_count": {"$size": "$_accounts"}}},
+        {"$project": {"password_hash": 0, "_accounts": 0}},
+    ]
+    users = await db.users.aggregate(pipeline).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        next_cursor = encode_cursor(last.get(sort_field) if sort_field != "_id" else None, last["_id"])
     for user in users:
-        if isinstance(user.get('created_at'), str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-        # Count accounts for each user
-        accounts_count = await db.accounts.count_documents({"user_id": user['id']})
-        user['accounts_count'] = accounts_count
+        user.pop("_id", None)
+    
+    set_page_headers(response, next_cursor, await cached_count("users", match) if include_total else None)
     return users
 
 @api_router.put("/admin/users/{user_id}/plan")
@@ -788,7 +2723,7 @@ async def admin_update_plan(user_id: str, plan: str, days: int = 30, current_use
     
     expires_at = None
     if plan != "free":
-        expires_at = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
+        expires_at = datetime.now(timezone.utc) + timedelta(days=days)
     
     result = await db.users.update_one(
         {"id": user_id},
@@ -798,6 +2733,12 @@ async def admin_update_plan(user_id: str, plan: str, days: int = 30, current_use
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     
+    if JWT_STATELESS_CLAIMS:
+        # O plano está assinado nos tokens - revoga para forçar novas claims
+        await revoke_user_sessions(user_id)
+    else:
+        invalidate_user_cache(user_id)
+    
     return {"message": f"Plano atualizado para {plan}", "expires_at": expires_at}
 
 @api_router.post("/admin/make-admin")
@@ -806,16 +2747,51 @@ async def make_admin(email: str, secret: str):
     if secret != ADMIN_SECRET:
         raise HTTPException(status_code=403, detail="Secret inválido")
     
-    result = await db.users.update_one(
+    user = await db.users.find_one_and_update(
         {"email": email},
-        {"$set": {"is_admin": True}}
+        {"$set": {"is_admin": True}},
+        projection={"_id": 0, "id": 1}
     )
     
-    if result.modified_count == 0:
+    if not user:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     
+    if JWT_STATELESS_CLAIMS:
+        await revoke_user_sessions(user['id'])
+    else:
+        invalidate_user_cache(user['id'])
+    
     return {"message": f"{email} agora é admin"}
 
+@api_router.get("/admin/metrics")
+async def admin_get_metrics(current_user: dict = Depends(get_current_user)):
+    """Métricas internas de cache e desempenho (admin only)"""
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso não autorizado")
+    
+    return {
+        "caches": {
+            "users": user_cache.stats(),
+            "token_versions": token_version_cache.stats(),
+            "counts": count_cache.stats(),
+            "group_catalog": group_catalog.stats(),
+            "marketplace_access": marketplace_access_cache.stats(),
+            "marketplace_snapshot": marketplace_snapshot.stats()
+        },
+        "usage_counters": usage_counters.stats(),
+        "telegram_clients": client_manager.stats(),
+        "account_leases": account_leases.stats(),
+        "action_logs": action_log_sink.stats(),
+        "database": db_stats.stats(),
+        "cache_invalidation": cache_invalidation_bus.stats(),
+        "date_migration": date_migration_report,
+        "password_hashing": get_password_hash_stats(),
+        "login_rate_limit": {
+            "email": login_email_limiter.stats(),
+            "ip": login_ip_limiter.stats()
+        }
+    }
+
 @api_router.get("/plans")
 async def get_plans():
     """Get available plans with prices"""
@@ -875,26 +2851,18 @@ async def get_plans():
 
 @api_router.post("/sessions/reset-locks")
 async def reset_session_locks(current_user: dict = Depends(get_current_user)):
-    """Reset all session locks for the current user's accounts"""
+    """Revoke the account leases held for the current user's accounts"""
     # Get user's accounts
     accounts = await db.accounts.find({"user_id": current_user['id']}, {"_id": 0}).to_list(100)
     
     reset_count = 0
     for account in accounts:
         phone = account.get('phone')
-        if phone:
-            # Force reset the lock for this phone
-            if phone in session_locks:
-                session_locks[phone] = asyncio.Lock()
-                if phone in lock_timestamps:
-                    del lock_timestamps[phone]
-                reset_count += 1
-            else:
-                # Criar lock novo mesmo se não existia
-                session_locks[phone] = asyncio.Lock()
-                reset_count += 1
+        # O dono atual perde o fencing token e a fila segue
+        if phone and account_leases.revoke(phone):
+            reset_count += 1
     
-    logging.info(f"Locks resetados para {reset_count} contas do usuário {current_user['email']}")
+    logging.info(f"Leases revogados para {reset_count} contas do usuário {current_user['email']}")
     
     return {
         "message": f"Locks resetados para {reset_count} contas",
@@ -904,11 +2872,11 @@ async def reset_session_locks(current_user: dict = Depends(get_current_user)):
 
 @api_router.post("/sessions/reset-all-locks")
 async def reset_all_locks(current_user: dict = Depends(get_current_user)):
-    """Reset ALL session locks - Admin only or user's own locks"""
+    """Revoke ALL account leases - Admin only or user's own leases"""
     if current_user.get('is_admin', False):
         # Admin pode resetar todos
-        count = force_release_all_locks()
-        logging.warning(f"Admin {current_user['email']} forçou reset de TODOS os {count} locks")
+        count = account_leases.revoke_all()
+        logging.warning(f"Admin {current_user['email']} revogou TODOS os {count} leases")
         return {
             "message": f"TODOS os {count} locks foram resetados",
             "reset_count": count,
@@ -920,29 +2888,12 @@ async def reset_all_locks(current_user: dict = Depends(get_current_user)):
 
 @api_router.get("/sessions/status")
 async def get_sessions_status(current_user: dict = Depends(get_current_user)):
-    """Get status of all session locks for the current user"""
+    """Get lease status (holder, queue depth, wait) of the current user's accounts"""
     accounts = await db.accounts.find({"user_id": current_user['id']}, {"_id": 0}).to_list(100)
     
-    status = []
-    for account in accounts:
-        phone = account.get('phone')
-        if phone:
-            lock = session_locks.get(phone)
-            lock_time = lock_timestamps.get(phone)
-            
-            lock_status = {
-                "phone": phone,
-                "is_locked": lock.locked() if lock else False,
-                "lock_duration": None
-            }
-            
-            if lock_time:
-                elapsed = (datetime.now(timezone.utc) - lock_time).total_seconds()
-                lock_status["lock_duration"] = f"{elapsed:.0f}s"
-            
-            status.append(lock_status)
+    status = [account_leases.status(account['phone']) for account in accounts if account.get('phone')]
     
-    return {"sessions": status}
+    return {"sessions": status, "scheduler": account_leases.stats()}
 
 @api_router.post("/sessions/invalidate/{phone}")
 async def invalidate_session(phone: str, current_user: dict = Depends(get_current_user)):
@@ -985,7 +2936,7 @@ async def disconnect_all_clients(current_user: dict = Depends(get_current_user))
     for account in accounts:
         phone = account.get('phone')
         if phone:
-            await client_manager.release_client(phone, disconnect=True)
+            await client_manager.close_client(phone)
             disconnected += 1
     
     return {
@@ -995,32 +2946,103 @@ async def disconnect_all_clients(current_user: dict = Depends(get_current_user))
 
 # ============== Public Groups Marketplace Routes ==============
 
+MARKETPLACE_PRICE = 14.99
+# Rede de segurança para alterações feitas por outros workers; a invalidação explícita é a regra
+MARKETPLACE_SNAPSHOT_TTL_SECONDS = float(os.environ.get('MARKETPLACE_SNAPSHOT_TTL_SECONDS', '300'))
+
+class MarketplaceSnapshot:
+    """
+    Catálogo global do marketplace pronto para servir: as duas variantes (completa e
+    sem invite_link/username) já serializadas, cada uma com seu ETag.
+    Só é reconstruído depois de invalidate() (sync do admin / refresh de grupos).
+    """
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.version = 0
+        self._snapshot: Optional[dict] = None
+        self._lock = asyncio.Lock()
+        self.builds = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def _variant(groups: List[dict], has_access: bool) -> tuple:
+        body = json.dumps(jsonable_encoder({
+            "groups": groups,
+            "has_access": has_access,
+            "price": MARKETPLACE_PRICE,
+            "total_groups": len(groups)
+        }), separators=(",", ":")).encode()
+        return body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+    async def get(self) -> dict:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot["version"] == self.version and time.monotonic() - snapshot["built_at"] <= self.ttl_seconds:
+            return snapshot
+        async with self._lock:
+            # Outra requisição pode ter reconstruído enquanto esperávamos o lock
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot["version"] == self.version and time.monotonic() - snapshot["built_at"] <= self.ttl_seconds:
+                return snapshot
+            version = self.version
+            groups = await db.public_groups.find({}, {"_id": 0}).to_list(1000)
+            redacted = [{**group, "invite_link": None, "username": None} for group in groups]
+            snapshot = {
+                "version": version,
+                "built_at": time.monotonic(),
+                "full": self._variant(groups, True),
+                "redacted": self._variant(redacted, False),
+                "total_groups": len(groups)
+            }
+            self._snapshot = snapshot
+            self.builds += 1
+            return snapshot
+
+    def invalidate(self):
+        self.version += 1
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "version": self.version,
+            "built_version": snapshot["version"] if snapshot else None,
+            "total_groups": snapshot["total_groups"] if snapshot else None,
+            "builds": self.builds,
+            "not_modified": self.not_modified
+        }
+
+marketplace_snapshot = MarketplaceSnapshot(MARKETPLACE_SNAPSHOT_TTL_SECONDS)
+
+async def has_marketplace_access(user: dict) -> bool:
+    """Admin ou compra aprovada (cacheado por usuário)"""
+    if user.get('is_admin', False):
+        return True
+    has_access = marketplace_access_cache.get(user['id'])
+    if has_access is None:
+        purchase = await db.group_purchases.find_one({"user_id": user['id'], "status": "approved"}, {"_id": 1})
+        has_access = purchase is not None
+        marketplace_access_cache.set(user['id'], has_access)
+    return has_access
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
 @api_router.get("/marketplace/groups")
-async def get_marketplace_groups(current_user: dict = Depends(get_current_user)):
-    """Get all public groups available in the marketplace"""
-    # Check if user has purchased access
-    purchase = await db.group_purchases.find_one({
-        "user_id": current_user['id'],
-        "status": "approved"
-    }, {"_id": 0})
+async def get_marketplace_groups(request: Request, current_user: dict = Depends(get_current_user)):
+    """Get all public groups available in the marketplace (ETag / 304 Not Modified)"""
+    has_access = await has_marketplace_access(current_user)
     
-    has_access = purchase is not None or current_user.get('is_admin', False)
+    # Without access, the prebuilt variant has invite links and usernames hidden
+    snapshot = await marketplace_snapshot.get()
+    body, etag = snapshot["full" if has_access else "redacted"]
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
     
-    # Get all public groups
-    groups = await db.public_groups.find({}, {"_id": 0}).to_list(1000)
-    
-    # If user doesn't have access, hide invite links
-    if not has_access:
-        for group in groups:
-            group['invite_link'] = None
-            group['username'] = None
-    
-    return {
-        "groups": groups,
-        "has_access": has_access,
-        "price": 14.99,
-        "total_groups": len(groups)
-    }
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        marketplace_snapshot.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @api_router.post("/marketplace/purchase")
 async def request_marketplace_purchase(current_user: dict = Depends(get_current_user)):
@@ -1051,13 +3073,12 @@ async def request_marketplace_purchase(current_user: dict = Depends(get_current_
     )
     
     doc = purchase.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.group_purchases.insert_one(doc)
     
     return {
         "message": "Solicitação enviada! Após o pagamento via PIX, o admin irá liberar seu acesso.",
         "purchase_id": purchase.id,
-        "price": 14.99,
+        "price": MARKETPLACE_PRICE,
         "pix_key": "08053511597"
     }
 
@@ -1074,12 +3095,7 @@ async def get_my_purchase(current_user: dict = Depends(get_current_user)):
 async def join_marketplace_group(group_id: str, current_user: dict = Depends(get_current_user)):
     """Join a group from the marketplace"""
     # Check if user has access
-    purchase = await db.group_purchases.find_one({
-        "user_id": current_user['id'],
-        "status": "approved"
-    })
-    
-    if not purchase and not current_user.get('is_admin', False):
+    if not await has_marketplace_access(current_user):
         raise HTTPException(status_code=403, detail="Você precisa comprar acesso aos grupos primeiro!")
     
     # Get the group
@@ -1095,14 +3111,16 @@ async def join_marketplace_group(group_id: str, current_user: dict = Depends(get
     phone = account['phone']
     
     # Try to join the group
-    lock = await safe_acquire_lock(phone, timeout_seconds=30)
-    if not lock:
-        raise HTTPException(status_code=503, detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente.")
+    lease = await account_leases.acquire(phone, LEASE_INTERACTIVE, timeout=30, owner="join")
+    if not lease:
+        raise HTTPException(status_code=503, detail=SESSION_BUSY_DETAIL)
     
+    client_ref = None
     client = None
     try:
         creds = random.choice(DEFAULT_API_CREDENTIALS)
-        client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
+        client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="join", lease=lease)
+        client = client_ref.client
         
         # Try to join by username or invite link
         if group.get('username'):
@@ -1121,12 +3139,8 @@ async def join_marketplace_group(group_id: str, current_user: dict = Depends(get
             return {"message": f"Você já está no grupo '{group['title']}'!"}
         raise HTTPException(status_code=400, detail=f"Erro ao entrar no grupo: {error_msg}")
     finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
-        release_lock(phone, lock)
+        await client_manager.release_client(client_ref)
+        account_leases.release(lease)
 
 # Store for bulk join operations
 active_bulk_joins = {}
@@ -1139,12 +3153,7 @@ class BulkJoinRequest(BaseModel):
 async def start_bulk_join(request: BulkJoinRequest, current_user: dict = Depends(get_current_user)):
     """Start joining multiple groups from the marketplace"""
     # Check if user has access
-    purchase = await db.group_purchases.find_one({
-        "user_id": current_user['id'],
-        "status": "approved"
-    })
-    
-    if not purchase and not current_user.get('is_admin', False):
+    if not await has_marketplace_access(current_user):
         raise HTTPException(status_code=403, detail="Você precisa comprar acesso aos grupos primeiro!")
     
     # Get the specified account
@@ -1197,21 +3206,24 @@ async def run_bulk_join(operation_id: str, user_id: str, account: dict, groups:
     
     logging.info(f"[BULK JOIN {operation_id}][{phone}] Iniciando para {len(groups)} grupos")
     
-    lock = await safe_acquire_lock(phone, timeout_seconds=180)
-    if not lock:
+    lease = await account_leases.acquire(phone, LEASE_BACKGROUND, timeout=180, owner="bulk_join")
+    if not lease:
         active_bulk_joins[operation_id]['status'] = 'error'
         active_bulk_joins[operation_id]['error'] = "Sessão ocupada"
-        logging.error(f"[BULK JOIN {operation_id}][{phone}] Não conseguiu lock")
+        logging.error(f"[BULK JOIN {operation_id}][{phone}] Não conseguiu o lease da conta")
         return
     
+    client_ref = None
     client = None
     try:
         creds = random.choice(DEFAULT_API_CREDENTIALS)
-        client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
+        client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="bulk_join", lease=lease)
+        client = client_ref.client
         
         active_bulk_joins[operation_id]['status'] = 'joining'
         
         for idx, group in enumerate(groups):
+            lease.heartbeat()
             # Check if cancelled
             if active_bulk_joins.get(operation_id, {}).get('status') == 'cancelled':
                 logging.info(f"[BULK JOIN {operation_id}][{phone}] Cancelado")
@@ -1270,7 +3282,7 @@ async def run_bulk_join(operation_id: str, user_id: str, account: dict, groups:
                 active_bulk_joins[operation_id]['flood_wait'] = wait_seconds
                 
                 # Wait for flood to pass
-                await asyncio.sleep(wait_seconds)
+                await lease.sleep(wait_seconds)
                 
                 active_bulk_joins[operation_id]['flood_wait'] = None
                 active_bulk_joins[operation_id]['status'] = 'joining'
@@ -1339,12 +3351,8 @@ async def run_bulk_join(operation_id: str, user_id: str, account: dict, groups:
         active_bulk_joins[operation_id]['status'] = 'error'
         active_bulk_joins[operation_id]['error'] = error_msg
     finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
-        release_lock(phone, lock)
+        await client_manager.release_client(client_ref)
+        account_leases.release(lease)
 
 @api_router.get("/marketplace/join-bulk/{operation_id}/status")
 async def get_bulk_join_status(operation_id: str, current_user: dict = Depends(get_current_user)):
@@ -1373,17 +3381,47 @@ async def cancel_bulk_join(operation_id: str, current_user: dict = Depends(get_c
 
 # Admin endpoints for marketplace
 @api_router.get("/admin/purchases")
-async def get_all_purchases(current_user: dict = Depends(get_current_user)):
-    """Get all purchase requests (admin only)"""
+async def get_all_purchases(
+    after: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get all purchase requests (admin only) - pending first, then by creation order"""
     if not current_user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    purchases = await db.group_purchases.find({}, {"_id": 0}).to_list(1000)
+    # Duas fases (pendentes, depois as demais), cada uma por keyset em (status, _id).
+    # O cursor guarda a fase como valor de ordenação.
+    phases = [(0, {"status": "pending"}), (1, {"status": {"$ne": "pending"}})]
+    after_phase, after_id = decode_cursor(after) if after else (0, None)
     
-    # Sort by status (pending first) and then by date
-    purchases.sort(key=lambda x: (0 if x.get('status') == 'pending' else 1, x.get('created_at', '')), reverse=False)
-    
-    return {"purchases": purchases}
+    page = []
+    for phase, status_query in phases:
+        if phase < after_phase:
+            continue
+        query = dict(status_query)
+        if after_id is not None and phase == after_phase:
+            query["_id"] = {"$gt": after_id}
+        wanted = limit + 1 - len(page)
+        docs = await db.group_purchases.find(query).sort("_id", 1).limit(wanted).to_list(wanted)
+        page.extend((phase, doc) for doc in docs)
+        if len(page) > limit:
+            break
+    
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1][0], page[-1][1]["_id"])
+    purchases = []
+    for _, doc in page:
+        doc.pop("_id", None)
+        purchases.append(doc)
+    
+    result = {"purchases": purchases, "next_cursor": next_cursor}
+    if include_total:
+        result["total"] = await cached_count("group_purchases", {})
+    return result
 
 @api_router.post("/admin/purchases/{purchase_id}/approve")
 async def approve_purchase(purchase_id: str, current_user: dict = Depends(get_current_user)):
@@ -1391,17 +3429,20 @@ async def approve_purchase(purchase_id: str, current_user: dict = Depends(get_cu
     if not current_user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    result = await db.group_purchases.update_one(
-        {"id": purchase_id},
+    # Como no reject: solicitação já aprovada não é alterada de novo e responde 404
+    purchase = await db.group_purchases.find_one_and_update(
+        {"id": purchase_id, "status": {"$ne": "approved"}},
         {"$set": {
             "status": "approved",
-            "approved_at": datetime.now(timezone.utc).isoformat(),
+            "approved_at": datetime.now(timezone.utc),
             "approved_by": current_user['id']
-        }}
+        }},
+        projection={"_id": 0, "user_id": 1}
     )
     
-    if result.modified_count == 0:
+    if not purchase:
         raise HTTPException(status_code=404, detail="Solicitação não encontrada")
+    marketplace_access_cache.invalidate(purchase.get('user_id'))
     
     return {"message": "Acesso liberado com sucesso!"}
 
@@ -1411,19 +3452,29 @@ async def reject_purchase(purchase_id: str, current_user: dict = Depends(get_cur
     if not current_user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    result = await db.group_purchases.update_one(
-        {"id": purchase_id},
-        {"$set": {"status": "rejected"}}
+    purchase = await db.group_purchases.find_one_and_update(
+        {"id": purchase_id, "status": {"$ne": "rejected"}},
+        {"$set": {"status": "rejected"}},
+        projection={"_id": 0, "user_id": 1}
     )
     
-    if result.modified_count == 0:
+    if not purchase:
         raise HTTPException(status_code=404, detail="Solicitação não encontrada")
+    marketplace_access_cache.invalidate(purchase.get('user_id'))
     
     return {"message": "Solicitação rejeitada"}
 
+# Store for public groups sync jobs
+active_group_syncs = {}
+
+# Quantas contas do admin são sincronizadas ao mesmo tempo
+PUBLIC_SYNC_CONCURRENCY = int(os.environ.get('PUBLIC_SYNC_CONCURRENCY', '3'))
+# Grupos acumulados antes de cada bulk upsert no marketplace
+PUBLIC_SYNC_BATCH_SIZE = int(os.environ.get('PUBLIC_SYNC_BATCH_SIZE', '100'))
+
 @api_router.post("/admin/sync-public-groups")
 async def sync_public_groups(current_user: dict = Depends(get_current_user)):
-    """Sync admin's groups to public marketplace (admin only)"""
+    """Start syncing admin's groups to public marketplace in background (admin only)"""
     if not current_user.get('is_admin', False):
         raise HTTPException(status_code=403, detail="Acesso negado")
     
@@ -1433,75 +3484,198 @@ async def sync_public_groups(current_user: dict = Depends(get_current_user)):
     if not accounts:
         raise HTTPException(status_code=400, detail="Você não tem contas cadastradas")
     
-    total_synced = 0
+    # Uma sincronização por admin: se já existe uma rodando, devolve a mesma
+    for sync_id, sync in list(active_group_syncs.items()):
+        if sync['user_id'] != current_user['id']:
+            continue
+        if sync['status'] == 'running':
+            return {"sync_id": sync_id, "message": "Sincronização já em andamento...", "total_accounts": sync['accounts_total']}
+        del active_group_syncs[sync_id]
+    
+    sync_id = str(uuid.uuid4())
+    active_group_syncs[sync_id] = {
+        "user_id": current_user['id'],
+        "status": "running",
+        "accounts_total": len(accounts),
+        "accounts_done": 0,
+        "accounts_failed": 0,
+        "current_accounts": [],
+        "groups_found": 0,
+        "duplicates_skipped": 0,  # Grupo já visto por outra conta
+        "groups_synced": 0,
+        "errors": [],
+        "message": None,
+        "started_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    asyncio.create_task(run_public_groups_sync(sync_id, current_user['id'], accounts))
+    
+    return {
+        "sync_id": sync_id,
+        "message": f"Sincronizando grupos de {len(accounts)} contas...",
+        "total_accounts": len(accounts)
+    }
+
+async def run_public_groups_sync(sync_id: str, admin_id: str, accounts: List[dict]):
+    """Background task: sincroniza as contas em paralelo (limitado), sem repetir grupos entre contas"""
+    sync = active_group_syncs[sync_id]
+    semaphore = asyncio.Semaphore(PUBLIC_SYNC_CONCURRENCY)
+    # telegram_id -> já publicado com link? (só entra aqui depois da gravação)
+    published: Dict[int, bool] = {}
+    # telegram_ids num lote ainda não gravado de alguma conta
+    pending: set = set()
+    
+    async def sync_account(account: dict):
+        async with semaphore:
+            await _sync_account_public_groups(sync, admin_id, account, published, pending)
+    
+    try:
+        await asyncio.gather(*(sync_account(account) for account in accounts))
+        sync['status'] = 'completed'
+        sync['message'] = f"Sincronizados {sync['groups_synced']} grupos para o marketplace!"
+        logging.info(f"[PUBLIC SYNC {sync_id}] 🏁 COMPLETO: {sync['groups_synced']} grupos | {sync['duplicates_skipped']} repetidos | {sync['accounts_failed']} contas com erro")
+    except Exception as e:
+        error_msg = str(e)[:100]
+        logging.error(f"[PUBLIC SYNC {sync_id}] ❌ ERRO: {error_msg}")
+        sync['status'] = 'error'
+        sync['error'] = error_msg
+    finally:
+        sync['current_accounts'] = []
+        sync['finished_at'] = datetime.now(timezone.utc).isoformat()
+
+async def _publish_public_batch(sync: dict, admin_id: str, batch: List[dict], invite_links: Dict[int, str],
+                               published: Dict[int, bool], pending: set, mine: set):
+    await upsert_public_groups(admin_id, batch, invite_links)
+    for entry in batch:
+        telegram_id = entry['telegram_id']
+        published[telegram_id] = published.get(telegram_id, False) or telegram_id in invite_links
+        pending.discard(telegram_id)
+        mine.discard(telegram_id)
+    sync['groups_synced'] += len(batch)
+
+async def _sync_account_public_groups(sync: dict, admin_id: str, account: dict,
+                                      published: Dict[int, bool], pending: set):
+    """
+    Lê os diálogos de uma conta e publica, em lotes, os grupos que nenhuma outra conta já publicou.
+    Um grupo só conta como publicado depois que o lote foi gravado; se a conta falhar antes, os
+    grupos reservados por ela voltam a ficar disponíveis, e as contas que os pularam os retomam
+    no fim da própria leitura. Grupo publicado sem link
+    ainda pode receber o link de outra conta que consiga exportá-lo.
+    """
+    phone = account['phone']
+    sync['current_accounts'].append(phone)
+    
+    lease = await account_leases.acquire(phone, LEASE_BACKGROUND, timeout=30, owner="public_sync")
+    if not lease:
+        sync['accounts_failed'] += 1
+        sync['errors'].append({"phone": phone, "error": "Sessão ocupada"})
+        sync['current_accounts'].remove(phone)
+        return
+    
+    client_ref = None
+    client = None
+    mine = set()  # grupos reservados por esta conta e ainda não gravados
+    try:
+        creds = random.choice(DEFAULT_API_CREDENTIALS)
+        client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="public_sync", lease=lease)
+        client = client_ref.client
+        
+        dialogs = await lease.run(client.get_dialogs())
+        
+        batch = []
+        invite_links = {}
+        # Grupos no lote de outra conta: revistos quando a reserva for gravada ou liberada
+        deferred = {}
+        
+        async def publish_batch():
+            nonlocal batch, invite_links
+            if batch:
+                # Fencing: um lease revogado não publica o lote
+                lease.check()
+                await _publish_public_batch(sync, admin_id, batch, invite_links, published, pending, mine)
+                batch, invite_links = [], {}
+        
+        async def consider(entity):
+            # Dedupe antes de qualquer RPC: já publicado com link ou num lote de outra conta
+            if published.get(entity.id):
+                sync['duplicates_skipped'] += 1
+                return
+            if entity.id in pending:
+                deferred[entity.id] = entity
+                return
+            pending.add(entity.id)
+            mine.add(entity.id)
+            
+            # Get invite link if possible
+            try:
+                if hasattr(client, 'export_chat_invite_link'):
+                    result = await client(ExportChatInviteRequest(entity))
+                    if hasattr(result, 'link'):
+                        invite_links[entity.id] = result.link
+            except:
+                pass
+            
+            if entity.id in published and entity.id not in invite_links:
+                # Já publicado sem link e esta conta também não tem link: nada a acrescentar
+                pending.discard(entity.id)
+                mine.discard(entity.id)
+                sync['duplicates_skipped'] += 1
+                return
+            
+            batch.append(_group_entry(entity))
+            if len(batch) >= PUBLIC_SYNC_BATCH_SIZE:
+                await publish_batch()
+        
+        for dialog in dialogs:
+            entity = dialog.entity
+            if not isinstance(entity, (Channel, Chat)):
+                continue
+            
+            lease.heartbeat()
+            sync['groups_found'] += 1
+            await consider(entity)
+        await publish_batch()
+        
+        # Se a conta que reservou um grupo falhar, a reserva é liberada: esta conta o publica.
+        # Sem reservas próprias pendentes aqui, não há espera circular entre contas
+        while deferred:
+            released = [entity for telegram_id, entity in deferred.items() if telegram_id not in pending]
+            if not released:
+                await lease.sleep(1)
+                continue
+            for entity in released:
+                del deferred[entity.id]
+                lease.heartbeat()
+                await consider(entity)
+            await publish_batch()
+        
+        sync['accounts_done'] += 1
+        
+    except Exception as e:
+        logging.error(f"Erro ao sincronizar grupos de {phone}: {e}")
+        sync['accounts_failed'] += 1
+        sync['errors'].append({"phone": phone, "error": str(e)[:100]})
+    finally:
+        # Reservas não gravadas voltam a ficar disponíveis para as outras contas
+        pending.difference_update(mine)
+        await client_manager.release_client(client_ref)
+        account_leases.release(lease)
+        sync['current_accounts'].remove(phone)
+
+@api_router.get("/admin/sync-public-groups/{sync_id}/status")
+async def get_public_groups_sync_status(sync_id: str, current_user: dict = Depends(get_current_user)):
+    """Get status of public groups sync (admin only)"""
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    if sync_id not in active_group_syncs:
+        raise HTTPException(status_code=404, detail="Operação não encontrada")
     
-    for account in accounts:
-        phone = account['phone']
-        
-        lock = await safe_acquire_lock(phone, timeout_seconds=30)
-        if not lock:
-            continue
-        
-        client = None
-        try:
-            creds = random.choice(DEFAULT_API_CREDENTIALS)
-            client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
-            
-            dialogs = await client.get_dialogs()
-            
-            for dialog in dialogs:
-                entity = dialog.entity
-                
-                if isinstance(entity, (Channel, Chat)):
-                    # Get invite link if possible
-                    invite_link = None
-                    username = getattr(entity, 'username', None)
-                    
-                    try:
-                        if hasattr(client, 'export_chat_invite_link'):
-                            invite_link = await client(ExportChatInviteRequest(entity))
-                            if hasattr(invite_link, 'link'):
-                                invite_link = invite_link.link
-                    except:
-                        pass
-                    
-                    # Check if group already exists
-                    existing = await db.public_groups.find_one({"telegram_id": entity.id})
-                    
-                    group_data = {
-                        "telegram_id": entity.id,
-                        "title": entity.title,
-                        "username": username,
-                        "invite_link": invite_link,
-                        "participants_count": getattr(entity, 'participants_count', None),
-                        "is_channel": isinstance(entity, Channel) and not getattr(entity, 'megagroup', False),
-                        "is_megagroup": isinstance(entity, Channel) and getattr(entity, 'megagroup', False),
-                        "added_by_admin": current_user['id'],
-                        "created_at": datetime.now(timezone.utc).isoformat()
-                    }
-                    
-                    if existing:
-                        await db.public_groups.update_one(
-                            {"telegram_id": entity.id},
-                            {"$set": group_data}
-                        )
-                    else:
-                        group_data['id'] = str(uuid.uuid4())
-                        await db.public_groups.insert_one(group_data)
-                    
-                    total_synced += 1
-                    
-        except Exception as e:
-            logging.error(f"Erro ao sincronizar grupos de {phone}: {e}")
-        finally:
-            if client:
-                try:
-                    await client.disconnect()
-                except:
-                    pass
-            release_lock(phone, lock)
+    sync = active_group_syncs[sync_id]
+    if sync['user_id'] != current_user['id']:
+        raise HTTPException(status_code=403, detail="Acesso negado")
     
-    return {"message": f"Sincronizados {total_synced} grupos para o marketplace!"}
+    return sync
 
 # ============== Account Routes ==============
 
@@ -1532,9 +3706,6 @@ async def create_account(input: AccountCreate, current_user: dict = Depends(get_
     
     account = Account(phone=input.phone, user_id=current_user['id'])
     doc = account.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    if doc.get('last_used'):
-        doc['last_used'] = doc['last_used'].isoformat()
     
     await db.accounts.insert_one(doc)
     return account
@@ -1542,11 +3713,6 @@ async def create_account(input: AccountCreate, current_user: dict = Depends(get_
 @api_router.get("/accounts", response_model=List[Account])
 async def get_accounts(current_user: dict = Depends(get_current_user)):
     accounts = await db.accounts.find({"user_id": current_user['id']}, {"_id": 0}).to_list(1000)
-    for acc in accounts:
-        if isinstance(acc.get('created_at'), str):
-            acc['created_at'] = datetime.fromisoformat(acc['created_at'])
-        if acc.get('last_used') and isinstance(acc['last_used'], str):
-            acc['last_used'] = datetime.fromisoformat(acc['last_used'])
     return accounts
 
 @api_router.delete("/accounts/{account_id}")
@@ -1559,29 +3725,22 @@ async def delete_account(account_id: str, current_user: dict = Depends(get_curre
     phone = account.get('phone')
     
     # Disconnect Telegram client if active
-    if phone and phone in active_clients:
+    client = client_manager.peek_client(phone) if phone else None
+    if client:
         try:
-            client = active_clients[phone]
             await client.log_out()
-            await client.disconnect()
-            del active_clients[phone]
             logging.info(f"Cliente Telegram desconectado para {phone}")
         except Exception as e:
             logging.error(f"Erro ao desconectar cliente: {e}")
+        await client_manager.close_client(phone, force=True)
     
-    # Remove session file
+    # Remove stored session
     if phone:
-        session_file = f"sessions/{phone}.session"
         try:
-            if os.path.exists(session_file):
-                os.remove(session_file)
-                logging.info(f"Arquivo de sessão removido: {session_file}")
-            # Also remove journal file if exists
-            journal_file = f"{session_file}-journal"
-            if os.path.exists(journal_file):
-                os.remove(journal_file)
+            await remove_telegram_session(phone)
+            logging.info(f"Sessão removida: {phone}")
         except Exception as e:
-            logging.error(f"Erro ao remover arquivo de sessão: {e}")
+            logging.error(f"Erro ao remover sessão: {e}")
     
     # Delete from database
     result = await db.accounts.delete_one({"id": account_id, "user_id": current_user['id']})
@@ -1590,6 +3749,7 @@ async def delete_account(account_id: str, current_user: dict = Depends(get_curre
     
     # Also delete related groups
     await db.groups.delete_many({"account_id": account_id, "user_id": current_user['id']})
+    group_catalog.invalidate(current_user['id'])
     
     return {"message": "Conta desconectada e excluída com sucesso"}
 
@@ -1617,22 +3777,24 @@ async def send_code(request: AccountCreate, current_user: dict = Depends(get_cur
                 detail=f"❌ Limite de contas atingido ({limits['max_accounts']}). Faça upgrade do seu plano para adicionar mais contas!"
             )
     
-    # Usa o novo sistema de lock seguro
-    lock = await safe_acquire_lock(phone, timeout_seconds=30)
-    if not lock:
+    # Lease exclusivo da conta (fila com prioridade interativa)
+    lease = await account_leases.acquire(phone, LEASE_INTERACTIVE, timeout=30, owner="send_code")
+    if not lease:
         raise HTTPException(
             status_code=503, 
-            detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente."
+            detail=SESSION_BUSY_DETAIL
         )
     
+    client_ref = None
+    client = None
     try:
         creds = random.choice(DEFAULT_API_CREDENTIALS)
-        client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'], check_auth=False)
+        client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], require_auth=False, operation="send_code", lease=lease)
+        client = client_ref.client
         
         result = await client.send_code_request(phone)
         phone_code_hash = result.phone_code_hash
-        
-        active_clients[phone] = client
+        client_manager.mark_pending_auth(phone)
         
         return {
             "phone_code_hash": phone_code_hash,
@@ -1640,19 +3802,22 @@ async def send_code(request: AccountCreate, current_user: dict = Depends(get_cur
         }
     except Exception as e:
         error_msg = str(e)
-        if "database is locked" in error_msg.lower():
-            raise HTTPException(status_code=503, detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente.")
+        if isinstance(e, SessionStoreError):
+            raise HTTPException(status_code=503, detail=SESSION_STORE_DETAIL)
         raise HTTPException(status_code=400, detail=error_msg)
     finally:
-        release_lock(phone, lock)
+        # O cliente continua conectado no pool para o verify_code
+        await client_manager.release_client(client_ref)
+        account_leases.release(lease)
 
 @api_router.post("/auth/verify-code")
 async def verify_code(request: PhoneCodeRequest, current_user: dict = Depends(get_current_user)):
+    # Lease no cliente do send_code: não pode ser despejado durante o sign_in
+    client_ref = client_manager.lease_existing(request.phone)
+    if not client_ref:
+        raise HTTPException(status_code=400, detail="Sessão expirada. Solicite novo código.")
+    client = client_ref.client
     try:
-        client = active_clients.get(request.phone)
-        if not client:
-            raise HTTPException(status_code=400, detail="Sessão expirada. Solicite novo código.")
-        
         # Double check account limit before creating (in case of race condition)
         existing = await db.accounts.find_one({"phone": request.phone, "user_id": current_user['id']})
         if not existing:
@@ -1667,8 +3832,13 @@ async def verify_code(request: PhoneCodeRequest, current_user: dict = Depends(ge
                 )
         
         await client.sign_in(request.phone, request.code, phone_code_hash=request.phone_code_hash)
-        
-        session_file = f"sessions/{request.phone}.session"
+        client_manager.clear_pending_auth(request.phone)
+        # Auth key persistida antes de marcar a conta como autenticada
+        try:
+            await client.session.flush(raise_errors=True)
+        except SessionStoreError as e:
+            logging.error(f"[Sessions] Login de {request.phone} sem sessão gravada: {e}")
+            raise HTTPException(status_code=503, detail="Não foi possível salvar a sessão. Tente novamente.")
         
         account = Account(
             phone=request.phone,
@@ -1679,9 +3849,6 @@ async def verify_code(request: PhoneCodeRequest, current_user: dict = Depends(ge
         )
         
         account_doc = account.model_dump()
-        account_doc['created_at'] = account_doc['created_at'].isoformat()
-        if account_doc.get('last_used'):
-            account_doc['last_used'] = account_doc['last_used'].isoformat()
         
         existing = await db.accounts.find_one({"phone": request.phone, "user_id": current_user['id']})
         if existing:
@@ -1704,6 +3871,109 @@ async def verify_code(request: PhoneCodeRequest, current_user: dict = Depends(ge
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await client_manager.release_client(client_ref)
+
+# ============== Groups Sync ==============
+
+# Campos do grupo vindos do Telegram; uma linha só é reescrita se algum deles mudar
+GROUP_SYNC_FIELDS = ("title", "username", "participants_count", "is_channel", "is_megagroup")
+
+def _group_entry(entity) -> dict:
+    """Extrai os campos sincronizados de um Channel/Chat do Telegram"""
+    return {
+        "telegram_id": entity.id,
+        "title": entity.title,
+        "username": getattr(entity, 'username', None),
+        "participants_count": getattr(entity, 'participants_count', None),
+        "is_channel": isinstance(entity, Channel) and not getattr(entity, 'megagroup', False),
+        "is_megagroup": isinstance(entity, Channel) and getattr(entity, 'megagroup', False),
+    }
+
+async def sync_account_groups(user_id: str, account: dict, entries: List[dict]) -> List[dict]:
+    """
+    Aplica a lista de grupos vinda do Telegram como diff sobre os grupos salvos da conta:
+    novos e alterados viram upserts por (account_id, telegram_id), removidos são apagados,
+    inalterados não são tocados (mantêm id e updated_at). Tudo em um único bulk_write.
+    """
+    account_id = account['id']
+    stored = await db.groups.find({"account_id": account_id, "user_id": user_id}, {"_id": 0}).to_list(None)
+    
+    existing: Dict[int, dict] = {}
+    duplicate_ids = []
+    for doc in stored:
+        if doc.get('telegram_id') in existing:
+            duplicate_ids.append(doc['id'])
+        else:
+            existing[doc.get('telegram_id')] = doc
+    
+    now = datetime.now(timezone.utc)
+    operations = []
+    groups = []
+    seen = set()
+    for entry in entries:
+        telegram_id = entry['telegram_id']
+        if telegram_id in seen:
+            continue
+        seen.add(telegram_id)
+        
+        current = existing.get(telegram_id)
+        changed = {k: entry[k] for k in GROUP_SYNC_FIELDS if current is None or current.get(k) != entry[k]}
+        if current is not None and current.get('account_phone') != account['phone']:
+            changed['account_phone'] = account['phone']
+        
+        if current is not None and not changed:
+            groups.append(current)
+            continue
+        
+        if current is None:
+            group = TelegramGroup(user_id=user_id, account_id=account_id, account_phone=account['phone'], updated_at=now, **entry)
+            doc = group.model_dump()
+            operations.append(UpdateOne(
+                {"account_id": account_id, "telegram_id": telegram_id},
+                {"$set": {k: v for k, v in doc.items() if k != 'id'}, "$setOnInsert": {"id": doc['id']}},
+                upsert=True
+            ))
+            groups.append(doc)
+        else:
+            changed['updated_at'] = now
+            # Pelo id da linha mantida: com duplicatas antigas, (account_id, telegram_id) poderia
+            # casar com a cópia apagada no mesmo bulk_write
+            operations.append(UpdateOne(
+                {"id": current['id']},
+                {"$set": changed}
+            ))
+            groups.append({**current, **changed})
+    
+    removed_ids = duplicate_ids + [doc['id'] for telegram_id, doc in existing.items() if telegram_id not in seen]
+    if removed_ids:
+        operations.append(DeleteMany({"id": {"$in": removed_ids}}))
+    
+    if operations:
+        await db.groups.bulk_write(operations, ordered=False)
+    return groups
+
+async def upsert_public_groups(admin_id: str, entries: List[dict], invite_links: Optional[Dict[int, str]] = None):
+    """Publica grupos no marketplace com um único bulk_write de upserts por telegram_id"""
+    invite_links = invite_links or {}
+    unique_entries = {entry['telegram_id']: entry for entry in entries}
+    operations = []
+    for entry in unique_entries.values():
+        fields = {**entry, "added_by_admin": admin_id}
+        on_insert = {"id": str(uuid.uuid4()), "created_at": datetime.now(timezone.utc)}
+        # Conta sem permissão de exportar não apaga o link que outra conta já publicou
+        if invite_links.get(entry['telegram_id']):
+            fields["invite_link"] = invite_links[entry['telegram_id']]
+        else:
+            on_insert["invite_link"] = None
+        operations.append(UpdateOne(
+            {"telegram_id": entry['telegram_id']},
+            {"$set": fields, "$setOnInsert": on_insert},
+            upsert=True
+        ))
+    if operations:
+        await db.public_groups.bulk_write(operations, ordered=False)
+        marketplace_snapshot.invalidate()
 
 # ============== Groups Routes ==============
 
@@ -1721,126 +3991,87 @@ async def get_account_groups(account_id: str, refresh: bool = False, current_use
     if refresh:
         phone = account['phone']
         
-        # Tenta adquirir o lock com timeout maior e detecção de lock preso
-        lock = await safe_acquire_lock(phone, timeout_seconds=30)
-        if not lock:
+        # Lease exclusivo da conta (fila com prioridade interativa)
+        lease = await account_leases.acquire(phone, LEASE_INTERACTIVE, timeout=30, owner="account_groups")
+        if not lease:
             raise HTTPException(
                 status_code=503, 
-                detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente."
+                detail=SESSION_BUSY_DETAIL
             )
         
+        client_ref = None
         client = None
         try:
             creds = random.choice(DEFAULT_API_CREDENTIALS)
-            client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
+            client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="account_groups", lease=lease)
+            client = client_ref.client
             
             # Get all dialogs (chats, groups, channels)
-            dialogs = await client.get_dialogs()
-            
-            # Delete old groups for this account
-            await db.groups.delete_many({"account_id": account_id, "user_id": current_user['id']})
+            dialogs = await lease.run(client.get_dialogs())
             
-            groups = []
             is_admin = current_user.get('is_admin', False)
+            entries = []
+            invite_links = {}
             
             for dialog in dialogs:
                 entity = dialog.entity
                 
                 # Only include groups and channels (not private chats)
                 if isinstance(entity, (Channel, Chat)):
-                    is_channel = isinstance(entity, Channel) and not getattr(entity, 'megagroup', False)
-                    is_megagroup = isinstance(entity, Channel) and getattr(entity, 'megagroup', False)
+                    lease.heartbeat()
+                    entries.append(_group_entry(entity))
                     
                     # Get invite link for admin
-                    invite_link = None
-                    username = getattr(entity, 'username', None)
-                    
                     if is_admin:
                         try:
                             result = await client(ExportChatInviteRequest(entity))
                             if hasattr(result, 'link'):
-                                invite_link = result.link
+                                invite_links[entity.id] = result.link
                         except:
                             pass
-                    
-                    group = TelegramGroup(
-                        user_id=current_user['id'],
-                        account_id=account_id,
-                        account_phone=account['phone'],
-                        telegram_id=entity.id,
-                        title=entity.title,
-                        username=username,
-                        participants_count=getattr(entity, 'participants_count', None),
-                        is_channel=is_channel,
-                        is_megagroup=is_megagroup
-                    )
-                    
-                    doc = group.model_dump()
-                    doc['updated_at'] = doc['updated_at'].isoformat()
-                    await db.groups.insert_one(doc)
-                    groups.append(group)
-                    
-                    # Se for admin, sincroniza com o marketplace automaticamente
-                    if is_admin:
-                        existing_public = await db.public_groups.find_one({"telegram_id": entity.id})
-                        
-                        public_group_data = {
-                            "telegram_id": entity.id,
-                            "title": entity.title,
-                            "username": username,
-                            "invite_link": invite_link,
-                            "participants_count": getattr(entity, 'participants_count', None),
-                            "is_channel": is_channel,
-                            "is_megagroup": is_megagroup,
-                            "added_by_admin": current_user['id'],
-                            "created_at": datetime.now(timezone.utc).isoformat()
-                        }
-                        
-                        if existing_public:
-                            await db.public_groups.update_one(
-                                {"telegram_id": entity.id},
-                                {"$set": public_group_data}
-                            )
-                        else:
-                            public_group_data['id'] = str(uuid.uuid4())
-                            await db.public_groups.insert_one(public_group_data)
+            
+            # Fencing: um lease revogado não sobrescreve o catálogo da conta
+            lease.check()
+            groups = await sync_account_groups(current_user['id'], account, entries)
+            group_catalog.invalidate(current_user['id'])
+            
+            # Se for admin, sincroniza com o marketplace automaticamente
+            if is_admin:
+                await upsert_public_groups(current_user['id'], entries, invite_links)
             
             # Update account last_used
             await db.accounts.update_one(
                 {"id": account_id},
-                {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
+                {"$set": {"last_used": datetime.now(timezone.utc)}}
             )
             
             return groups
             
         except Exception as e:
             error_msg = str(e)
-            if "database is locked" in error_msg.lower():
-                raise HTTPException(status_code=503, detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente.")
+            if isinstance(e, SessionStoreError):
+                raise HTTPException(status_code=503, detail=SESSION_STORE_DETAIL)
             raise HTTPException(status_code=400, detail=error_msg)
         finally:
-            # Sempre desconecta o cliente e libera o lock
-            if client:
-                try:
-                    await client.disconnect()
-                except:
-                    pass
-            release_lock(phone, lock)
+            # Sempre devolve o cliente ao pool e o lease da conta
+            await client_manager.release_client(client_ref)
+            account_leases.release(lease)
     
     # Return cached groups
-    groups = await db.groups.find({"account_id": account_id, "user_id": current_user['id']}, {"_id": 0}).to_list(1000)
-    for g in groups:
-        if isinstance(g.get('updated_at'), str):
-            g['updated_at'] = datetime.fromisoformat(g['updated_at'])
-    return groups
+    return await group_catalog.list(current_user['id'], account_id=account_id, limit=1000)
 
 @api_router.get("/groups")
-async def get_all_groups(current_user: dict = Depends(get_current_user)):
-    """Get all groups from all accounts"""
-    groups = await db.groups.find({"user_id": current_user['id']}, {"_id": 0}).to_list(10000)
-    for g in groups:
-        if isinstance(g.get('updated_at'), str):
-            g['updated_at'] = datetime.fromisoformat(g['updated_at'])
+async def get_all_groups(
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get all groups from all accounts - paginated by cursor (X-Next-Cursor header)"""
+    after_id = decode_cursor(after)[1] if after else None
+    groups, last_id, total = await group_catalog.page(current_user['id'], after_id, limit)
+    set_page_headers(response, encode_cursor(None, last_id) if last_id else None, total if include_total else None)
     return groups
 
 # ============== Message Templates Routes ==============
@@ -1854,8 +4085,6 @@ async def create_template(input: MessageTemplateCreate, current_user: dict = Dep
     )
     
     doc = template.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     await db.templates.insert_one(doc)
     
     return template
@@ -1863,11 +4092,6 @@ async def create_template(input: MessageTemplateCreate, current_user: dict = Dep
 @api_router.get("/templates", response_model=List[MessageTemplate])
 async def get_templates(current_user: dict = Depends(get_current_user)):
     templates = await db.templates.find({"user_id": current_user['id']}, {"_id": 0}).to_list(1000)
-    for t in templates:
-        if isinstance(t.get('created_at'), str):
-            t['created_at'] = datetime.fromisoformat(t['created_at'])
-        if isinstance(t.get('updated_at'), str):
-            t['updated_at'] = datetime.fromisoformat(t['updated_at'])
     return templates
 
 @api_router.put("/templates/{template_id}", response_model=MessageTemplate)
@@ -1881,15 +4105,11 @@ async def update_template(template_id: str, input: MessageTemplateUpdate, curren
         update_data['name'] = input.name
     if input.content:
         update_data['content'] = input.content
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
     await db.templates.update_one({"id": template_id}, {"$set": update_data})
     
     updated = await db.templates.find_one({"id": template_id}, {"_id": 0})
-    if isinstance(updated.get('created_at'), str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
-    if isinstance(updated.get('updated_at'), str):
-        updated['updated_at'] = datetime.fromisoformat(updated['updated_at'])
     return updated
 
 @api_router.delete("/templates/{template_id}")
@@ -1922,11 +4142,7 @@ async def broadcast_to_groups(request: BroadcastRequest, current_user: dict = De
         raise HTTPException(status_code=400, detail="Nenhuma conta ativa disponível")
     
     # Get groups
-    group_query = {"user_id": user_id}
-    if request.group_ids:
-        group_query["id"] = {"$in": request.group_ids}
-    
-    groups = await db.groups.find(group_query, {"_id": 0}).to_list(10000)
+    groups = await group_catalog.list(user_id, group_ids=request.group_ids, limit=10000)
     if not groups:
         raise HTTPException(status_code=400, detail="Nenhum grupo encontrado. Atualize a lista de grupos primeiro.")
     
@@ -1939,8 +4155,11 @@ async def broadcast_to_groups(request: BroadcastRequest, current_user: dict = De
     
     groups_list = list(unique_groups.values())
     
-    # Update usage
-    await increment_usage(user_id, "broadcast_groups", 1)
+    # Reserva atômica da cota (o check_limit acima é só a verificação local rápida)
+    reservation = await reserve_quota(current_user, "broadcast_groups", 1)
+    if not reservation.granted:
+        raise HTTPException(status_code=403, detail=reservation.message)
+    await reservation.commit(1)
     
     # Create broadcast ID
     broadcast_id = str(uuid.uuid4())
@@ -2081,14 +4300,35 @@ async def account_continuous_worker(broadcast_id: str, user_id: str, account: di
         "data": active_broadcasts[broadcast_id]['accounts'][phone]
     })
     
+    client_ref = None
     client = None
+    
+    async def send_with_lease(group_tid, timeout: Optional[float] = 10.0) -> bool:
+        """
+        Um envio segurando o lease da conta só durante as RPCs: delays e FloodWait ficam sem
+        lease, e operações interativas na mesma conta entram entre um envio e outro.
+        Retorna False se a conta estava ocupada ou o lease foi perdido (grupo fica para a próxima rodada).
+        """
+        lease = await account_leases.acquire(phone, LEASE_BACKGROUND, timeout=CLIENT_POOL_WAIT_SECONDS, owner="broadcast")
+        if lease is None:
+            return False
+        try:
+            entity = await lease.run(asyncio.wait_for(client.get_entity(group_tid), timeout=timeout))
+            await lease.run(asyncio.wait_for(client.send_message(entity, message), timeout=timeout))
+            return True
+        except LeaseLostError:
+            return False
+        finally:
+            account_leases.release(lease)
+    
     try:
         creds = random.choice(DEFAULT_API_CREDENTIALS)
         
         # Usar o ClientManager para obter cliente único
         for attempt in range(3):
             try:
-                client = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'])
+                client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="broadcast", priority=LEASE_BACKGROUND)
+                client = client_ref.client
                 break
             except Exception as e:
                 error_str = str(e).lower()
@@ -2197,15 +4437,10 @@ async def account_continuous_worker(broadcast_id: str, user_id: str, account: di
                     active_broadcasts[broadcast_id]['accounts'][phone]['status'] = 'sending'
                     
                     # Enviar mensagem
-                    entity = await asyncio.wait_for(
-                        client.get_entity(group_tid),
-                        timeout=10.0
-                    )
-                    
-                    await asyncio.wait_for(
-                        client.send_message(entity, message),
-                        timeout=10.0
-                    )
+                    if not await send_with_lease(group_tid):
+                        # Conta ocupada por outra operação: o grupo fica para a próxima rodada
+                        active_broadcasts[broadcast_id]['accounts'][phone]['skipped'] += 1
+                        continue
                     
                     # Sucesso!
                     active_broadcasts[broadcast_id]['accounts'][phone]['sent'] += 1
@@ -2233,7 +4468,7 @@ async def account_continuous_worker(broadcast_id: str, user_id: str, account: di
                         "data": active_broadcasts[broadcast_id]['accounts'][phone]
                     })
                     
-                    # Aguardar o tempo exato do flood
+                    # Aguardar o tempo exato do flood (sem o lease: a conta fica livre para outras operações)
                     await asyncio.sleep(wait_seconds)
                     
                     active_broadcasts[broadcast_id]['accounts'][phone]['flood_wait'] = None
@@ -2242,10 +4477,11 @@ async def account_continuous_worker(broadcast_id: str, user_id: str, account: di
                     
                     # Tentar enviar novamente após flood
                     try:
-                        entity = await client.get_entity(group_tid)
-                        await client.send_message(entity, message)
-                        active_broadcasts[broadcast_id]['accounts'][phone]['sent'] += 1
-                        active_broadcasts[broadcast_id]['sent_count'] += 1
+                        if await send_with_lease(group_tid, timeout=None):
+                            active_broadcasts[broadcast_id]['accounts'][phone]['sent'] += 1
+                            active_broadcasts[broadcast_id]['sent_count'] += 1
+                        else:
+                            active_broadcasts[broadcast_id]['accounts'][phone]['skipped'] += 1
                     except Exception as retry_err:
                         active_broadcasts[broadcast_id]['accounts'][phone]['errors'] += 1
                         active_broadcasts[broadcast_id]['error_count'] += 1
@@ -2391,9 +4627,8 @@ async def account_continuous_worker(broadcast_id: str, user_id: str, account: di
             })
     
     finally:
-        # Liberar cliente no manager (não desconecta, apenas marca como disponível)
-        # O cliente pode ser reutilizado por outras operações
-        await client_manager.release_client(phone, disconnect=False)
+        # Devolve o lease (não desconecta); o cliente pode ser reutilizado por outras operações
+        await client_manager.release_client(client_ref)
 
 @api_router.get("/broadcast/{broadcast_id}/status")
 async def get_broadcast_status(broadcast_id: str, current_user: dict = Depends(get_current_user)):
@@ -2459,6 +4694,43 @@ async def cancel_broadcast(broadcast_id: str, current_user: dict = Depends(get_c
 
 # ============== Extract Members Routes ==============
 
+MEMBER_UPSERT_BATCH_SIZE = int(os.environ.get('MEMBER_UPSERT_BATCH_SIZE', '500'))
+
+async def upsert_members(members: List[Member]) -> tuple:
+    """
+    Grava os membros extraídos por (user_id, user_telegram_id): membros já salvos têm
+    nome, last_seen, extracted_from e extracted_at atualizados em vez de duplicados.
+    Retorna (novos, atualizados).
+    """
+    new_count = updated_count = 0
+    for start in range(0, len(members), MEMBER_UPSERT_BATCH_SIZE):
+        operations = []
+        for member in members[start:start + MEMBER_UPSERT_BATCH_SIZE]:
+            doc = member.model_dump()
+            member_id = doc.pop('id')
+            operations.append(UpdateOne(
+                {"user_id": doc['user_id'], "user_telegram_id": doc['user_telegram_id']},
+                {"$set": doc, "$setOnInsert": {"id": member_id}},
+                upsert=True
+            ))
+        try:
+            result = await db.members.bulk_write(operations, ordered=False)
+            new_count += result.upserted_count
+            updated_count += result.matched_count
+        except BulkWriteError as e:
+            # Upsert concorrente do mesmo membro (outra extração): na segunda tentativa ele já existe.
+            # Só as operações que falharam são refeitas; as demais já contam pelo primeiro resultado
+            write_errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != 11000 for err in write_errors):
+                raise
+            new_count += e.details.get('nUpserted', 0)
+            updated_count += e.details.get('nMatched', 0)
+            retry = [operations[err['index']] for err in write_errors]
+            result = await db.members.bulk_write(retry, ordered=False)
+            new_count += result.upserted_count
+            updated_count += result.matched_count
+    return new_count, updated_count
+
 @api_router.post("/extract")
 async def extract_members(group_username: str, current_user: dict = Depends(get_current_user)):
     # Check plan limits
@@ -2478,25 +4750,32 @@ async def extract_members(group_username: str, current_user: dict = Depends(get_
     limits = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
     max_extract = limits['daily_extract_members']
     
-    # Usa o novo sistema de lock seguro
-    lock = await safe_acquire_lock(phone, timeout_seconds=30)
-    if not lock:
+    # Lease exclusivo da conta (fila com prioridade interativa)
+    lease = await account_leases.acquire(phone, LEASE_INTERACTIVE, timeout=30, owner="extract")
+    if not lease:
         raise HTTPException(
             status_code=503, 
-            detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente."
+            detail=SESSION_BUSY_DETAIL
         )
     
+    client_ref = None
     client = None
     try:
         creds = random.choice(DEFAULT_API_CREDENTIALS)
-        client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
+        client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="extract", lease=lease)
+        client = client_ref.client
         
         group = await client.get_entity(group_username)
-        participants = await client.get_participants(group, limit=None)
+        # Grupos grandes levam vários requests: o lease é renovado a cada participante
+        participants = []
+        async for participant in client.iter_participants(group):
+            participants.append(participant)
+            lease.heartbeat()
         
         active_members = []
         current_time = datetime.now(timezone.utc)
         extracted_count = 0
+        new_count = updated_count = 0
         
         for user in participants:
             # Check if we hit the limit
@@ -2537,17 +4816,28 @@ async def extract_members(group_username: str, current_user: dict = Depends(get_
                 )
                 active_members.append(member)
                 extracted_count += 1
-                
-                doc = member.model_dump()
-                doc['extracted_at'] = doc['extracted_at'].isoformat()
-                await db.members.insert_one(doc)
         
-        # Update usage
-        await increment_usage(current_user['id'], "extract_members", extracted_count)
+        # Reserva atômica da cota para os membros encontrados; concorrentes não ultrapassam o limite
+        if extracted_count:
+            reservation = await reserve_quota(current_user, "extract_members", extracted_count)
+            if not reservation.granted:
+                raise HTTPException(status_code=403, detail=reservation.message)
+            active_members = active_members[:reservation.granted]
+            extracted_count = len(active_members)
+            
+            try:
+                # Fencing: um lease revogado não grava membros
+                lease.check()
+                new_count, updated_count = await upsert_members(active_members)
+            except Exception:
+                await reservation.refund()
+                raise
+            await reservation.commit(extracted_count)
+            remaining = reservation.remaining + extracted_count
         
         await db.accounts.update_one(
             {"phone": phone},
-            {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
+            {"$set": {"last_used": datetime.now(timezone.utc)}}
         )
         
         log = ActionLog(
@@ -2556,45 +4846,143 @@ async def extract_members(group_username: str, current_user: dict = Depends(get_
             account_phone=phone,
             target=group_username,
             status="success",
-            details=f"Extraídos {len(active_members)} membros ativos"
+            details=f"Extraídos {len(active_members)} membros ativos ({new_count} novos, {updated_count} atualizados)"
         )
-        log_doc = log.model_dump()
-        log_doc['created_at'] = log_doc['created_at'].isoformat()
-        await db.action_logs.insert_one(log_doc)
+        action_log_sink.log(log)
         
         limit_msg = ""
         if plan != "premium" and extracted_count >= remaining:
             limit_msg = f" (Limite diário atingido: {max_extract})"
         
         return {
-            "message": f"Extraídos {len(active_members)} membros ativos{limit_msg}",
+            "message": f"Extraídos {len(active_members)} membros ativos ({new_count} novos, {updated_count} atualizados){limit_msg}",
             "count": len(active_members),
+            "new": new_count,
+            "updated": updated_count,
             "remaining": remaining - extracted_count
         }
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = str(e)
-        if "database is locked" in error_msg.lower():
-            raise HTTPException(status_code=503, detail="Sessão sendo preparada. Aguarde 5-10 minutos e tente novamente.")
+        if isinstance(e, SessionStoreError):
+            raise HTTPException(status_code=503, detail=SESSION_STORE_DETAIL)
         raise HTTPException(status_code=400, detail=error_msg)
     finally:
-        # Sempre desconecta o cliente e libera o lock
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
-        release_lock(phone, lock)
+        # Sempre devolve o cliente ao pool e o lease da conta
+        await client_manager.release_client(client_ref)
+        account_leases.release(lease)
 
 # ============== Members Routes ==============
 
 @api_router.get("/members", response_model=List[Member])
-async def get_members(current_user: dict = Depends(get_current_user)):
-    members = await db.members.find({"user_id": current_user['id']}, {"_id": 0}).to_list(10000)
-    for member in members:
-        if isinstance(member.get('extracted_at'), str):
-            member['extracted_at'] = datetime.fromisoformat(member['extracted_at'])
+async def get_members(
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Paginated by cursor: pass the X-Next-Cursor header value as `after` to get the next page"""
+    query = {"user_id": current_user['id']}
+    members, next_cursor = await fetch_page("members", query, after, limit)
+    set_page_headers(response, next_cursor, await cached_count("members", query) if include_total else None)
     return members
 
+MEMBER_EXPORT_FIELDS = ["id", "user_telegram_id", "username", "first_name", "last_name", "phone", "extracted_from", "extracted_at", "last_seen"]
+# Linhas por bloco enviado ao cliente (e tamanho do lote pedido ao Mongo)
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def _iter_member_rows(user_id: str, include_archived: bool = False):
+    """Percorre os membros do usuário pelo cursor do Motor, sem carregar tudo em memória"""
+    projection = {field: 1 for field in MEMBER_EXPORT_FIELDS}
+    projection["_id"] = 0
+    cursor = db.members.find({"user_id": user_id}, projection).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        yield {field: _export_value(doc.get(field)) for field in MEMBER_EXPORT_FIELDS}
+    
+    if include_archived:
+        # Membro extraído de novo depois de arquivado: vale a versão da coleção quente.
+        # A checagem é feita no banco, lote a lote, para a memória não crescer com o export.
+        batch = []
+        async for doc in iter_archived_rows("members", user_id):
+            batch.append(doc)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                for row in await _archived_members_not_hot(user_id, batch):
+                    yield row
+                batch = []
+        if batch:
+            for row in await _archived_members_not_hot(user_id, batch):
+                yield row
+
+async def _archived_members_not_hot(user_id: str, docs: List[dict]) -> List[dict]:
+    """Linhas de export dos membros arquivados que não existem mais na coleção quente"""
+    telegram_ids = list({doc.get("user_telegram_id") for doc in docs})
+    hot = await db.members.find(
+        {"user_id": user_id, "user_telegram_id": {"$in": telegram_ids}},
+        {"_id": 0, "user_telegram_id": 1}
+    ).to_list(None)
+    hot_ids = {doc["user_telegram_id"] for doc in hot}
+    return [
+        {field: _export_value(doc.get(field)) for field in MEMBER_EXPORT_FIELDS}
+        for doc in docs if doc.get("user_telegram_id") not in hot_ids
+    ]
+
+async def _ndjson_stream(rows):
+    chunk = []
+    async for row in rows:
+        chunk.append(json.dumps(row, ensure_ascii=False))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+async def _csv_stream(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=MEMBER_EXPORT_FIELDS)
+    writer.writeheader()
+    # Cabeçalho sai imediatamente - primeiro byte sem esperar o banco
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if count:
+        yield buffer.getvalue()
+
+@api_router.get("/members/export")
+async def export_members(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Exporta todos os membros em streaming (NDJSON ou CSV); include_archived inclui os arquivados em Parquet"""
+    rows = _iter_member_rows(current_user['id'], include_archived)
+    if format == "csv":
+        body, media_type = _csv_stream(rows), "text/csv; charset=utf-8"
+    else:
+        body, media_type = _ndjson_stream(rows), "application/x-ndjson"
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="members.{format}"'}
+    )
+
 @api_router.delete("/members/{member_id}")
 async def delete_member(member_id: str, current_user: dict = Depends(get_current_user)):
     result = await db.members.delete_one({"id": member_id, "user_id": current_user['id']})
@@ -2629,36 +5017,37 @@ async def send_messages(request: MessageRequest, current_user: dict = Depends(ge
             account = accounts[account_index % len(accounts)]
             account_index += 1
             phone = account['phone']
-            lock = get_session_lock(phone)
+            lease = await account_leases.acquire(phone, LEASE_INTERACTIVE, timeout=30, owner="send_messages")
+            if not lease:
+                logging.warning(f"[Messages] Conta {phone} ocupada, pulando {member.get('username', member['user_telegram_id'])}")
+                continue
             
-            async with lock:
-                client = None
-                try:
-                    creds = random.choice(DEFAULT_API_CREDENTIALS)
-                    client = await create_telegram_client(phone, creds['api_id'], creds['api_hash'])
-                    
-                    if member.get('username'):
-                        await client.send_message(member['username'], request.message)
-                    else:
-                        await client.send_message(member['user_telegram_id'], request.message)
-                    
-                    sent_count += 1
-                    
-                    delay = random.randint(request.delay_min, request.delay_max)
-                    await asyncio.sleep(delay)
-                    
-                except FloodWaitError as e:
-                    await asyncio.sleep(e.seconds)
-                    continue
-                except Exception as e:
-                    print(f"Erro ao enviar para {member.get('username', member['user_telegram_id'])}: {str(e)}")
-                    continue
-                finally:
-                    if client:
-                        try:
-                            await client.disconnect()
-                        except:
-                            pass
+            client_ref = None
+            client = None
+            try:
+                creds = random.choice(DEFAULT_API_CREDENTIALS)
+                client_ref = await client_manager.get_client(phone, creds['api_id'], creds['api_hash'], operation="send_messages", lease=lease)
+                client = client_ref.client
+                
+                if member.get('username'):
+                    await client.send_message(member['username'], request.message)
+                else:
+                    await client.send_message(member['user_telegram_id'], request.message)
+                
+                sent_count += 1
+                
+                delay = random.randint(request.delay_min, request.delay_max)
+                await lease.sleep(delay)
+                
+            except FloodWaitError as e:
+                await lease.sleep(e.seconds)
+                continue
+            except Exception as e:
+                print(f"Erro ao enviar para {member.get('username', member['user_telegram_id'])}: {str(e)}")
+                continue
+            finally:
+                await client_manager.release_client(client_ref)
+                account_leases.release(lease)
         
         log = ActionLog(
             user_id=current_user['id'],
@@ -2668,9 +5057,7 @@ async def send_messages(request: MessageRequest, current_user: dict = Depends(ge
             status="success",
             details=f"Enviadas {sent_count}/{len(members)} mensagens"
         )
-        log_doc = log.model_dump()
-        log_doc['created_at'] = log_doc['created_at'].isoformat()
-        await db.action_logs.insert_one(log_doc)
+        action_log_sink.log(log)
         
         return {"message": f"Mensagens enviadas: {sent_count}/{len(members)}"}
     except Exception as e:
@@ -2680,6 +5067,22 @@ async def send_messages(request: MessageRequest, current_user: dict = Depends(ge
 
 @api_router.post("/members/add-to-group")
 async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(get_current_user)):
+    reservation = None
+    added_count = 0
+    active_ref = None
+    active_client = None
+    active_lease = None
+    current_account_phone = None
+    
+    async def release_account():
+        """Devolve ao pool o cliente da conta atual e o lease da conta"""
+        nonlocal active_ref, active_client, active_lease
+        await client_manager.release_client(active_ref)
+        active_ref = None
+        active_client = None
+        account_leases.release(active_lease)
+        active_lease = None
+    
     try:
         # Check plan limits
         plan = current_user.get('plan', 'free')
@@ -2687,8 +5090,11 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
         if not can_do:
             raise HTTPException(status_code=403, detail=message)
         
-        # Limit members to remaining quota
-        member_ids_to_process = request.member_ids[:remaining] if plan != "premium" else request.member_ids
+        # Reserva atômica da cota; processa apenas o que foi concedido
+        reservation = await reserve_quota(current_user, "add_to_group", len(request.member_ids))
+        if not reservation.granted:
+            raise HTTPException(status_code=403, detail=reservation.message)
+        member_ids_to_process = request.member_ids[:reservation.granted]
         
         accounts = await db.accounts.find({
             "user_id": current_user['id'],
@@ -2706,12 +5112,9 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
             raise HTTPException(status_code=400, detail="Nenhum membro encontrado")
         
         results = []
-        added_count = 0
         failed_count = 0
         group_banned = False
         account_index = 0
-        active_client = None
-        current_account_phone = None
         
         for member in members:
             # Alterna entre contas a cada membro
@@ -2723,35 +5126,33 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
             phone_display = account_phone[-4:] if len(account_phone) > 4 else account_phone
             
             try:
-                # Fecha cliente anterior se mudou de conta
-                if active_client and current_account_phone != account_phone:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
-                
-                # Cria novo cliente se necessário
+                # Troca de conta: devolve cliente e lease da anterior e pega os da nova.
+                # O lease fica com a operação durante todo o uso do cliente, não só na conexão
                 if not active_client or current_account_phone != account_phone:
-                    creds = random.choice(DEFAULT_API_CREDENTIALS)
-                    active_client = await create_telegram_client(account_phone, creds['api_id'], creds['api_hash'])
+                    await release_account()
                     current_account_phone = account_phone
+                    active_lease = await account_leases.acquire(account_phone, LEASE_INTERACTIVE, timeout=30, owner="add_to_group")
+                    if not active_lease:
+                        raise Exception(f"Conta {account_phone} ocupada. Tente novamente em instantes.")
+                    creds = random.choice(DEFAULT_API_CREDENTIALS)
+                    active_ref = await client_manager.get_client(account_phone, creds['api_id'], creds['api_hash'], operation="add_to_group", lease=active_lease)
+                    active_client = active_ref.client
                 
-                group = await active_client.get_entity(request.group_username)
-                user = await active_client.get_entity(member['user_telegram_id'])
+                group = await active_lease.run(active_client.get_entity(request.group_username))
+                user = await active_lease.run(active_client.get_entity(member['user_telegram_id']))
                 
                 # Usa método correto dependendo do tipo de grupo
                 if isinstance(group, Channel):
-                    await active_client(InviteToChannelRequest(
+                    await active_lease.run(active_client(InviteToChannelRequest(
                         channel=group,
                         users=[user]
-                    ))
+                    )))
                 else:
-                    await active_client(AddChatUserRequest(
+                    await active_lease.run(active_client(AddChatUserRequest(
                         chat_id=group.id,
                         user_id=user,
                         fwd_limit=0
-                    ))
+                    )))
                 
                 added_count += 1
                 results.append({
@@ -2763,7 +5164,7 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                 
                 # Delay entre adições
                 delay = random.randint(request.delay_min, request.delay_max)
-                await asyncio.sleep(delay)
+                await active_lease.sleep(delay)
                 
             except FloodWaitError as e:
                 results.append({
@@ -2773,13 +5174,8 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                     "account": phone_display
                 })
                 failed_count += 1
-                # Fecha cliente e espera um pouco antes de continuar
-                if active_client:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
+                # Devolve o cliente e espera um pouco antes de continuar
+                await release_account()
                 await asyncio.sleep(min(e.seconds, 10))
                 # Continua para próximo membro com outra conta
                 continue
@@ -2833,12 +5229,7 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                 })
                 failed_count += 1
                 # Não para, continua tentando com outras contas
-                if active_client:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
+                await release_account()
                 continue
                 
             except ChannelPrivateError:
@@ -2851,12 +5242,7 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                 failed_count += 1
                 group_banned = True
                 # Tenta com outra conta antes de desistir
-                if active_client:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
+                await release_account()
                 continue
                 
             except ChatWriteForbiddenError:
@@ -2867,33 +5253,23 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                     "account": phone_display
                 })
                 failed_count += 1
-                if active_client:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
+                await release_account()
                 continue
                 
             except Exception as e:
                 error_str = str(e).lower()
                 error_msg = str(e)[:40]
                 
-                # Trata database locked - fecha cliente e continua
-                if "database is locked" in error_str:
+                # Backend de sessões indisponível - devolve o cliente e continua
+                if isinstance(e, SessionStoreError):
                     results.append({
                         "member": member_name, 
                         "status": "retry", 
-                        "message": f"⚠️ Sessão sendo preparada, pulando (conta ...{phone_display})",
+                        "message": f"⚠️ Armazenamento de sessões indisponível, pulando (conta ...{phone_display})",
                         "account": phone_display
                     })
                     failed_count += 1
-                    if active_client:
-                        try:
-                            await active_client.disconnect()
-                        except:
-                            pass
-                        active_client = None
+                    await release_account()
                     await asyncio.sleep(2)
                     continue
                 
@@ -2914,21 +5290,12 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
                     })
                 failed_count += 1
                 
-                # Fecha cliente em caso de erro
-                if active_client:
-                    try:
-                        await active_client.disconnect()
-                    except:
-                        pass
-                    active_client = None
+                # Devolve o cliente ao pool em caso de erro
+                await release_account()
                 continue
         
-        # Fecha último cliente
-        if active_client:
-            try:
-                await active_client.disconnect()
-            except:
-                pass
+        # Devolve o último cliente ao pool
+        await release_account()
         
         status_msg = "success" if added_count > 0 else "failed"
         if group_banned and added_count == 0:
@@ -2942,13 +5309,10 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
             status=status_msg,
             details=f"Adicionados {added_count}/{len(members)} membros"
         )
-        log_doc = log.model_dump()
-        log_doc['created_at'] = log_doc['created_at'].isoformat()
-        await db.action_logs.insert_one(log_doc)
+        action_log_sink.log(log)
         
-        # Update usage
-        if added_count > 0:
-            await increment_usage(current_user['id'], "add_to_group", added_count)
+        # Confirma só o que foi usado; o restante da reserva volta para a cota
+        await reservation.commit(added_count)
         
         return {
             "message": f"Membros adicionados: {added_count}/{len(members)}",
@@ -2958,20 +5322,646 @@ async def add_to_group(request: AddToGroupRequest, current_user: dict = Depends(
             "results": results
         }
     except HTTPException:
+        # Membros já adicionados continuam contando; só a parte não usada volta para a cota
+        if reservation:
+            await reservation.commit(added_count)
         raise
     except Exception as e:
+        if reservation:
+            await reservation.commit(added_count)
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # Lease pendente se o loop saiu por exceção
+        await release_account()
 
 # ============== Action Logs Routes ==============
 
 @api_router.get("/logs", response_model=List[ActionLog])
 async def get_logs(current_user: dict = Depends(get_current_user)):
     logs = await db.action_logs.find({"user_id": current_user['id']}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for log in logs:
-        if isinstance(log.get('created_at'), str):
-            log['created_at'] = datetime.fromisoformat(log['created_at'])
     return logs
 
+# ============== Arquivo Frio (Parquet) ==============
+
+# Linhas antigas de members/action_logs saem do Mongo para arquivos Parquet comprimidos em
+# disco. Um manifesto em Mongo (archive_manifest) diz quais arquivos têm linhas de cada
+# usuário, para exportar ou consultar o arquivo sob demanda.
+ARCHIVE_DIR = Path(os.environ.get('ARCHIVE_DIR', str(ROOT_DIR / 'archive')))
+ARCHIVE_MEMBERS_AFTER_DAYS = int(os.environ.get('ARCHIVE_MEMBERS_AFTER_DAYS', '90'))
+# Menor que a retenção do TTL de action_logs, senão os logs expiram antes de arquivar
+ARCHIVE_ACTION_LOGS_AFTER_DAYS = int(os.environ.get('ARCHIVE_ACTION_LOGS_AFTER_DAYS', '30'))
+# Linhas por arquivo Parquet (um arquivo por lote lido do cursor)
+ARCHIVE_CHUNK_ROWS = int(os.environ.get('ARCHIVE_CHUNK_ROWS', '50000'))
+ARCHIVE_ROW_GROUP_SIZE = 10000
+# 0 = só pelo endpoint do admin
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', '0'))
+
+# coleção -> (campo de data, idade em dias, colunas gravadas)
+ARCHIVE_SPECS = {
+    "members": ("extracted_at", ARCHIVE_MEMBERS_AFTER_DAYS, ["user_id"] + MEMBER_EXPORT_FIELDS),
+    "action_logs": ("created_at", ARCHIVE_ACTION_LOGS_AFTER_DAYS,
+                    ["id", "user_id", "action_type", "account_phone", "target", "status", "details", "created_at"]),
+}
+
+archive_report: Dict[str, Any] = {"status": "idle"}
+
+def _write_parquet(path: Path, rows: List[dict], columns: List[str]):
+    """Roda em thread: grava o lote ordenado por user_id (row groups com estatísticas úteis para filtro)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frame = pd.DataFrame.from_records(rows, columns=columns).sort_values("user_id", kind="stable")
+    tmp_path = path.with_suffix(".tmp")
+    frame.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False, row_group_size=ARCHIVE_ROW_GROUP_SIZE)
+    os.replace(tmp_path, path)
+
+def _read_parquet_for_user(path: Path, user_id: str, columns: List[str]) -> List[dict]:
+    """Roda em thread: só as linhas do usuário (filtro empurrado para os row groups)"""
+    frame = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=[("user_id", "==", user_id)])
+    frame = frame.astype(object).where(frame.notna(), None)
+    return frame.to_dict("records")
+
+async def _delete_archived_rows(manifest: dict):
+    """Apaga do Mongo as linhas do lote: mesmo intervalo de _id e mesmo corte de data da leitura"""
+    date_field = ARCHIVE_SPECS[manifest["collection"]][0]
+    await db[manifest["collection"]].delete_many({
+        "_id": {"$gte": manifest["first_id"], "$lte": manifest["last_id"]},
+        date_field: {"$lt": manifest["cutoff"]}
+    })
+    await db.archive_manifest.update_one({"id": manifest["id"]}, {"$set": {"status": "complete"}})
+
+async def _archive_chunk(collection: str, rows: List[dict], cutoff: datetime) -> int:
+    date_field, _, columns = ARCHIVE_SPECS[collection]
+    archive_id = str(uuid.uuid4())
+    relative_path = f"{collection}/{cutoff.strftime('%Y%m%d')}-{archive_id}.parquet"
+    records = [{c: row.get(c) for c in columns} for row in rows]
+    
+    # 1) arquivo em disco, 2) manifesto, 3) só então apaga do Mongo
+    await asyncio.to_thread(_write_parquet, ARCHIVE_DIR / relative_path, records, columns)
+    dates = [row[date_field] for row in rows if isinstance(row.get(date_field), datetime)]
+    manifest = {
+        "id": archive_id,
+        "collection": collection,
+        "path": relative_path,
+        "rows": len(rows),
+        "user_ids": sorted({row.get("user_id") for row in rows if row.get("user_id")}),
+        "first_id": rows[0]["_id"],
+        "last_id": rows[-1]["_id"],
+        "cutoff": cutoff,
+        "min_date": min(dates) if dates else None,
+        "max_date": max(dates) if dates else None,
+        "status": "pending",
+        "created_at": datetime.now(timezone.utc)
+    }
+    await db.archive_manifest.insert_one(manifest)
+    await _delete_archived_rows(manifest)
+    return len(rows)
+
+async def archive_collection(collection: str) -> dict:
+    """Move para Parquet as linhas mais antigas que a idade configurada, lendo do cursor em lotes"""
+    date_field, days, columns = ARCHIVE_SPECS[collection]
+    if days <= 0:
+        return {"archived": 0, "files": 0, "skipped": "desativado"}
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    
+    projection = {c: 1 for c in columns}
+    projection[date_field] = 1
+    cursor = db[collection].find({date_field: {"$lt": cutoff}}, projection).sort("_id", 1).batch_size(1000)
+    
+    archived = files = 0
+    rows = []
+    async for doc in cursor:
+        rows.append(doc)
+        if len(rows) >= ARCHIVE_CHUNK_ROWS:
+            archived += await _archive_chunk(collection, rows, cutoff)
+            files += 1
+            rows = []
+    if rows:
+        archived += await _archive_chunk(collection, rows, cutoff)
+        files += 1
+    return {"archived": archived, "files": files, "cutoff": cutoff.isoformat()}
+
+async def run_archive_job():
+    global archive_report
+    if archive_report.get("status") == "running":
+        return
+    archive_report = {"status": "running", "started_at": datetime.now(timezone.utc).isoformat(), "collections": {}}
+    try:
+        # Lotes interrompidos depois do manifesto: termina a remoção do Mongo
+        async for manifest in db.archive_manifest.find({"status": "pending"}, {"_id": 0}):
+            await _delete_archived_rows(manifest)
+        for collection in ARCHIVE_SPECS:
+            archive_report["collections"][collection] = await archive_collection(collection)
+            logging.info(f"[Archive] {collection}: {archive_report['collections'][collection]}")
+        archive_report["status"] = "done"
+    except Exception as e:
+        logging.error(f"[Archive] Erro no arquivamento: {e}")
+        archive_report["status"] = "error"
+        archive_report["error"] = str(e)[:200]
+    finally:
+        archive_report["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+async def archive_scheduler():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+        await run_archive_job()
+
+async def iter_archived_rows(collection: str, user_id: str):
+    """Linhas arquivadas do usuário, arquivo por arquivo (só os arquivos que o manifesto aponta)"""
+    columns = ARCHIVE_SPECS[collection][2]
+    manifests = db.archive_manifest.find(
+        {"collection": collection, "user_ids": user_id}, {"_id": 0, "path": 1}
+    ).sort("created_at", 1)
+    async for manifest in manifests:
+        path = ARCHIVE_DIR / manifest["path"]
+        try:
+            rows = await asyncio.to_thread(_read_parquet_for_user, path, user_id, columns)
+        except FileNotFoundError:
+            logging.error(f"[Archive] Arquivo do manifesto não encontrado: {path}")
+            continue
+        for row in rows:
+            yield row
+
+@api_router.get("/archive/{collection}")
+async def get_archived_rows(
+    collection: str,
+    limit: int = Query(1000, ge=1, le=10000),
+    current_user: dict = Depends(get_current_user)
+):
+    """Consulta sob demanda das linhas arquivadas do usuário (members ou action_logs)"""
+    if collection not in ARCHIVE_SPECS:
+        raise HTTPException(status_code=404, detail="Coleção não arquivada")
+    
+    rows = []
+    async for row in iter_archived_rows(collection, current_user['id']):
+        rows.append({k: _export_value(v) for k, v in row.items()})
+        if len(rows) >= limit:
+            break
+    return rows
+
+@api_router.post("/admin/archive/run")
+async def admin_run_archive(current_user: dict = Depends(get_current_user)):
+    """Dispara o arquivamento em segundo plano (admin only)"""
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso não autorizado")
+    
+    if archive_report.get("status") == "running":
+        return {"message": "Arquivamento já em andamento", "report": archive_report}
+    asyncio.create_task(run_archive_job())
+    return {"message": "Arquivamento iniciado"}
+
+@api_router.get("/admin/archive")
+async def admin_get_archive(current_user: dict = Depends(get_current_user)):
+    """Resumo do manifesto e do último arquivamento (admin only)"""
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso não autorizado")
+    
+    summary = await db.archive_manifest.aggregate([
+        {"$group": {"_id": {"collection": "$collection", "status": "$status"},
+                    "files": {"$sum": 1}, "rows": {"$sum": "$rows"}}}
+    ]).to_list(None)
+    return {
+        "files": [{**item["_id"], "files": item["files"], "rows": item["rows"]} for item in summary],
+        "report": archive_report
+    }
+
+# ============== Invalidação de Caches (Change Streams) ==============
+
+# Com vários workers uvicorn cada processo tem seus caches; o barramento observa os change
+# streams do Mongo e invalida as chaves afetadas em todos eles. Exige replica set - para
+# desenvolvimento basta um nó: mongod --replSet rs0 + rs.initiate() e
+# MONGO_URL=mongodb://localhost:27017/?replicaSet=rs0
+CACHE_INVALIDATION_CHANGE_STREAMS = os.environ.get('CACHE_INVALIDATION_CHANGE_STREAMS', 'false').lower() in ('1', 'true', 'yes')
+# TTL aplicado aos caches enquanto o change stream não está disponível
+CACHE_FALLBACK_TTL_SECONDS = float(os.environ.get('CACHE_FALLBACK_TTL_SECONDS', '5'))
+CACHE_INVALIDATION_RETRY_SECONDS = float(os.environ.get('CACHE_INVALIDATION_RETRY_SECONDS', '30'))
+
+class CacheInvalidationBus:
+    """
+    Observa users, groups, public_groups e group_purchases e invalida os caches do processo.
+    Se o change stream cair (ou o Mongo não for replica set) os caches passam a usar
+    CACHE_FALLBACK_TTL_SECONDS até a reconexão; ao reconectar tudo é limpo, já que
+    eventos podem ter sido perdidos no intervalo.
+    """
+    COLLECTIONS = ("users", "groups", "public_groups", "group_purchases")
+
+    def __init__(self, fallback_ttl: float, retry_seconds: float):
+        self.fallback_ttl = fallback_ttl
+        self.retry_seconds = retry_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+        self._original_ttls: Optional[dict] = None
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+
+    def _ttl_targets(self) -> list:
+        return [user_cache, token_version_cache, marketplace_access_cache, group_catalog, marketplace_snapshot]
+
+    def _use_fallback_ttls(self):
+        if self._original_ttls is None:
+            self._original_ttls = {id(c): c.ttl_seconds for c in self._ttl_targets()}
+            for cache in self._ttl_targets():
+                cache.ttl_seconds = min(cache.ttl_seconds, self.fallback_ttl)
+
+    def _restore_ttls(self):
+        if self._original_ttls is not None:
+            for cache in self._ttl_targets():
+                cache.ttl_seconds = self._original_ttls.get(id(cache), cache.ttl_seconds)
+            self._original_ttls = None
+
+    def clear_all(self):
+        user_cache.clear()
+        token_version_cache.clear()
+        marketplace_access_cache.clear()
+        group_catalog.clear()
+        marketplace_snapshot.invalidate()
+
+    def handle(self, change: dict):
+        self.events += 1
+        collection = change.get("ns", {}).get("coll")
+        document = change.get("fullDocument") or {}
+        object_id = change.get("documentKey", {}).get("_id")
+        
+        if collection == "users":
+            if document.get("id"):
+                user_cache.invalidate(document["id"])
+                token_version_cache.invalidate(document["id"])
+            else:
+                # delete: só temos o _id
+                user_cache.clear()
+                token_version_cache.clear()
+        elif collection == "groups":
+            if document.get("user_id"):
+                group_catalog.invalidate(document["user_id"])
+            elif object_id is not None:
+                group_catalog.invalidate_object_id(object_id)
+        elif collection == "public_groups":
+            marketplace_snapshot.invalidate()
+        elif collection == "group_purchases":
+            if document.get("user_id"):
+                marketplace_access_cache.invalidate(document["user_id"])
+            else:
+                marketplace_access_cache.clear()
+
+    async def _watch(self):
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": list(self.COLLECTIONS)}}},
+            {"$project": {"ns": 1, "documentKey": 1, "operationType": 1,
+                          "fullDocument.id": 1, "fullDocument.user_id": 1}},
+        ]
+        async with db.watch(pipeline, full_document="updateLookup", resume_after=self._resume_token) as stream:
+            # O primeiro try_next abre o cursor: é aqui que falha se o Mongo não for replica set
+            change = await stream.try_next()
+            self.connected = True
+            self.last_error = None
+            # Entradas carregadas antes da conexão podem estar desatualizadas
+            self.clear_all()
+            self._restore_ttls()
+            logging.info("[CacheBus] Change stream conectado")
+            while stream.alive:
+                if change is not None:
+                    self.handle(change)
+                self._resume_token = stream.resume_token
+                change = await stream.try_next()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.connected or self.last_error is None:
+                    logging.warning(f"[CacheBus] Change stream indisponível, usando TTL de {self.fallback_ttl}s: {e}")
+                self.connected = False
+                self.last_error = str(e)[:200]
+                self._use_fallback_ttls()
+                # O token pode não servir mais; sem ele, eventos perdidos exigem limpar tudo
+                self._resume_token = None
+                self.clear_all()
+                self.reconnects += 1
+                await asyncio.sleep(self.retry_seconds)
+
+    def start(self):
+        if self._task is None:
+            # Até conectar, os caches não recebem invalidação de outros workers
+            self._use_fallback_ttls()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self._task is not None,
+            "connected": self.connected,
+            "events": self.events,
+            "reconnects": self.reconnects,
+            "fallback_ttl_active": self._original_ttls is not None,
+            "last_error": self.last_error
+        }
+
+cache_invalidation_bus = CacheInvalidationBus(CACHE_FALLBACK_TTL_SECONDS, CACHE_INVALIDATION_RETRY_SECONDS)
+
+# ============== MongoDB Indexes ==============
+
+# (coleção, nome, chaves, opções) - todos os índices que as rotas assumem existir
+INDEX_SPECS = [
+    ("users", "users_id", [("id", 1)], {"unique": True}),
+    ("users", "users_email", [("email", 1)], {"unique": True}),
+    ("users", "users_plan", [("plan", 1), ("_id", 1)], {}),
+    # Ordenações da listagem do admin: (campo, _id) para o keyset sem sort em memória
+    ("users", "users_created_page", [("created_at", 1), ("_id", 1)], {}),
+    ("users", "users_name_page", [("name", 1), ("_id", 1)], {}),
+    ("users", "users_email_page", [("email", 1), ("_id", 1)], {}),
+    ("accounts", "accounts_id", [("id", 1)], {"unique": True}),
+    ("accounts", "accounts_user_phone", [("user_id", 1), ("phone", 1)], {"unique": True}),
+    ("members", "members_id", [("id", 1)], {"unique": True}),
+    ("members", "members_user_page", [("user_id", 1), ("_id", 1)], {}),
+    ("members", "members_user_telegram", [("user_id", 1), ("user_telegram_id", 1)], {"unique": True}),
+    ("groups", "groups_id", [("id", 1)], {"unique": True}),
+    ("groups", "groups_account_user", [("account_id", 1), ("user_id", 1)], {}),
+    ("groups", "groups_user_page", [("user_id", 1), ("_id", 1)], {}),
+    ("groups", "groups_account_telegram", [("account_id", 1), ("telegram_id", 1)], {"unique": True}),
+    ("action_logs", "action_logs_user_created", [("user_id", 1), ("created_at", -1)], {}),
+    ("action_logs", "action_logs_created_ttl", [("created_at", 1)], {"expireAfterSeconds": ACTION_LOG_RETENTION_DAYS * 86400}),
+    ("public_groups", "public_groups_id", [("id", 1)], {"unique": True}),
+    ("public_groups", "public_groups_telegram_id", [("telegram_id", 1)], {"unique": True}),
+    ("group_purchases", "group_purchases_id", [("id", 1)], {"unique": True}),
+    ("group_purchases", "group_purchases_user_status", [("user_id", 1), ("status", 1)], {}),
+    ("group_purchases", "group_purchases_status_page", [("status", 1), ("_id", 1)], {}),
+    ("daily_usage", "daily_usage_user_date", [("user_id", 1), ("date", 1)], {"unique": True}),
+    ("templates", "templates_id", [("id", 1)], {"unique": True}),
+    ("templates", "templates_user", [("user_id", 1)], {}),
+    ("archive_manifest", "archive_manifest_id", [("id", 1)], {"unique": True}),
+    ("archive_manifest", "archive_manifest_collection_user", [("collection", 1), ("user_ids", 1)], {}),
+    ("members", "members_extracted_at", [("extracted_at", 1)], {}),
+]
+if TELEGRAM_SESSION_BACKEND == "mongo":
+    INDEX_SPECS.append(("telegram_session_entities", "telegram_session_entities_session_id", [("session", 1), ("id", 1)], {"unique": True}))
+# Sem retenção configurada o índice de created_at existe, mas sem expirar documentos
+if ACTION_LOG_RETENTION_DAYS <= 0:
+    INDEX_SPECS = [(c, n, k, {} if n == "action_logs_created_ttl" else o) for c, n, k, o in INDEX_SPECS]
+
+# Índices TTL cuja retenção é ajustada automaticamente (collMod) quando a configuração muda
+INDEX_TTL_ADJUSTABLE = {"action_logs_created_ttl"}
+
+# Resultado do bootstrap executado no startup
+index_bootstrap_report: Dict[str, Any] = {"status": "pending"}
+
+def _index_differences(info: dict, keys: list, options: dict) -> List[str]:
+    """Compara um índice existente (index_information) com a especificação"""
+    differences = []
+    if [tuple(k) for k in info.get('key', [])] != [tuple(k) for k in keys]:
+        differences.append(f"chaves {info.get('key')} != {keys}")
+    if bool(info.get('unique', False)) != bool(options.get('unique', False)):
+        differences.append(f"unique={info.get('unique', False)} (esperado {options.get('unique', False)})")
+    if info.get('expireAfterSeconds') != options.get('expireAfterSeconds'):
+        differences.append(f"expireAfterSeconds={info.get('expireAfterSeconds')} (esperado {options.get('expireAfterSeconds')})")
+    return differences
+
+async def check_indexes() -> dict:
+    """Lista índices ausentes ou criados de forma diferente da especificação"""
+    missing, mismatched, ok = [], [], []
+    existing_by_collection: Dict[str, dict] = {}
+    for collection, name, keys, options in INDEX_SPECS:
+        if collection not in existing_by_collection:
+            existing_by_collection[collection] = await db[collection].index_information()
+        existing = existing_by_collection[collection]
+        
+        info = existing.get(name)
+        if info is None:
+            # Mesmo índice criado manualmente com outro nome?
+            same_keys = [n for n, i in existing.items() if [tuple(k) for k in i.get('key', [])] == [tuple(k) for k in keys]]
+            if same_keys:
+                info = existing[same_keys[0]]
+                differences = [f"criado com o nome '{same_keys[0]}'"] + _index_differences(info, keys, options)
+                mismatched.append({"collection": collection, "name": name, "differences": differences})
+            else:
+                missing.append({"collection": collection, "name": name, "keys": keys})
+            continue
+        
+        differences = _index_differences(info, keys, options)
+        if differences:
+            mismatched.append({"collection": collection, "name": name, "differences": differences,
+                               "ttl_only": differences[0].startswith("expireAfterSeconds") and len(differences) == 1})
+        else:
+            ok.append(f"{collection}.{name}")
+    
+    return {"missing": missing, "mismatched": mismatched, "ok": len(ok)}
+
+async def ensure_indexes() -> dict:
+    """
+    Cria (de forma idempotente) os índices ausentes e registra os divergentes.
+    Índices divergentes não são removidos automaticamente.
+    """
+    before = await check_indexes()
+    created, failed = [], []
+    for item in before["missing"]:
+        spec = next(s for s in INDEX_SPECS if s[0] == item["collection"] and s[1] == item["name"])
+        collection, name, keys, options = spec
+        try:
+            await db[collection].create_index(keys, name=name, **options)
+            created.append(f"{collection}.{name}")
+        except Exception as e:
+            # Ex: índice único com documentos duplicados já existentes
+            failed.append({"collection": collection, "name": name, "error": str(e)[:200]})
+            logging.error(f"[Indexes] Falha ao criar {collection}.{name}: {e}")
+    
+    for item in list(before["mismatched"]):
+        if item.get("ttl_only") and item["name"] in INDEX_TTL_ADJUSTABLE:
+            # Só a retenção mudou: ajusta o TTL no lugar com collMod, sem recriar o índice
+            spec = next(s for s in INDEX_SPECS if s[0] == item["collection"] and s[1] == item["name"])
+            ttl = spec[3].get("expireAfterSeconds")
+            if ttl is not None:
+                try:
+                    await db.command("collMod", item["collection"], index={"name": item["name"], "expireAfterSeconds": ttl})
+                    created.append(f"{item['collection']}.{item['name']} (TTL={ttl}s)")
+                    before["mismatched"].remove(item)
+                    continue
+                except Exception as e:
+                    logging.error(f"[Indexes] Falha ao ajustar TTL de {item['collection']}.{item['name']}: {e}")
+    for item in before["mismatched"]:
+        logging.warning(f"[Indexes] {item['collection']}.{item['name']} diferente do esperado: {'; '.join(item['differences'])}")
+    if created:
+        logging.info(f"[Indexes] Criados {len(created)} índices: {', '.join(created)}")
+    
+    return {
+        "status": "done",
+        "created": created,
+        "failed": failed,
+        "mismatched": before["mismatched"],
+        "finished_at": datetime.now(timezone.utc).isoformat()
+    }
+
+MEMBER_DEDUPE_BATCH_SIZE = 1000
+
+async def _backup_and_delete_members(ids: List[ObjectId], run_id: str) -> int:
+    """Copia os membros para members_dedupe_backup e só então remove do members"""
+    docs = await db.members.find({"_id": {"$in": ids}}).to_list(None)
+    if not docs:
+        return 0
+    removed_at = datetime.now(timezone.utc)
+    for doc in docs:
+        doc["dedupe_run_id"] = run_id
+        doc["dedupe_removed_at"] = removed_at
+    try:
+        await db.members_dedupe_backup.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # _id já copiado numa execução interrompida: o backup existe, pode remover
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    return (await db.members.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})).deleted_count
+
+async def dedupe_members(dry_run: bool = True) -> dict:
+    """
+    Remove membros duplicados por (user_id, user_telegram_id), mantendo o extraído por último.
+    Necessário antes de criar o índice único members_user_telegram sobre dados antigos.
+    Só roda por ação do admin; cada documento removido é copiado antes para
+    members_dedupe_backup (com dedupe_run_id) e pode ser restaurado de lá.
+    """
+    run_id = str(uuid.uuid4())
+    pipeline = [
+        {"$sort": {"extracted_at": -1, "_id": -1}},
+        {"$group": {"_id": {"user_id": "$user_id", "user_telegram_id": "$user_telegram_id"},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    duplicate_ids = []
+    duplicates = removed = 0
+    async for group in db.members.aggregate(pipeline, allowDiskUse=True):
+        duplicates += len(group["ids"]) - 1
+        if dry_run:
+            continue
+        duplicate_ids.extend(group["ids"][1:])
+        if len(duplicate_ids) >= MEMBER_DEDUPE_BATCH_SIZE:
+            removed += await _backup_and_delete_members(duplicate_ids, run_id)
+            duplicate_ids = []
+    if duplicate_ids:
+        removed += await _backup_and_delete_members(duplicate_ids, run_id)
+    if removed:
+        logging.warning(f"[Indexes] {removed} membros duplicados removidos (backup em members_dedupe_backup, run {run_id})")
+    return {"dry_run": dry_run, "duplicates": duplicates, "removed": removed,
+            "run_id": None if dry_run else run_id}
+
+async def bootstrap_indexes():
+    global index_bootstrap_report
+    try:
+        index_bootstrap_report = await ensure_indexes()
+        if any(f["name"] == "members_user_telegram" for f in index_bootstrap_report["failed"]):
+            # Dados antigos com duplicatas: a limpeza é destrutiva e fica a cargo do admin
+            index_bootstrap_report["members_dedupe"] = {
+                "status": "required",
+                "hint": "POST /api/admin/members/dedupe?dry_run=false remove as duplicatas (com backup) e cria o índice"
+            }
+            logging.warning("[Indexes] members_user_telegram não criado: há membros duplicados (ver /admin/members/dedupe)")
+    except Exception as e:
+        logging.error(f"[Indexes] Erro no bootstrap de índices: {e}")
+        index_bootstrap_report = {"status": "error", "error": str(e)}
+
+@api_router.post("/admin/members/dedupe")
+async def admin_dedupe_members(dry_run: bool = True, current_user: dict = Depends(get_current_user)):
+    """
+    Conta (dry_run) ou remove membros duplicados e cria o índice único members_user_telegram (admin only).
+    Os removidos ficam em members_dedupe_backup.
+    """
+    global index_bootstrap_report
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso não autorizado")
+    
+    result = await dedupe_members(dry_run=dry_run)
+    if not dry_run:
+        index_bootstrap_report = await ensure_indexes()
+        index_bootstrap_report["members_dedupe"] = result
+        logging.warning(f"[Indexes] Admin {current_user['email']} removeu {result['removed']} membros duplicados")
+    return result
+
+@api_router.get("/admin/indexes")
+async def admin_get_indexes(current_user: dict = Depends(get_current_user)):
+    """Estado atual dos índices e resultado do bootstrap (admin only)"""
+    if not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Acesso não autorizado")
+    
+    return {
+        "current": await check_indexes(),
+        "bootstrap": index_bootstrap_report
+    }
+
+# ============== Migração de Datas ==============
+
+# Campos que antes eram gravados como string ISO e agora são datas nativas do BSON
+DATE_FIELDS = {
+    "users": ["created_at", "plan_expires_at"],
+    "accounts": ["created_at", "last_used"],
+    "members": ["extracted_at"],
+    "groups": ["updated_at"],
+    "templates": ["created_at", "updated_at"],
+    "action_logs": ["created_at"],
+    "public_groups": ["created_at"],
+    "group_purchases": ["created_at", "approved_at"],
+}
+DATE_MIGRATION_BATCH_SIZE = int(os.environ.get('DATE_MIGRATION_BATCH_SIZE', '500'))
+# Pausa entre lotes para não competir com o tráfego online
+DATE_MIGRATION_PAUSE_SECONDS = float(os.environ.get('DATE_MIGRATION_PAUSE_SECONDS', '0.2'))
+
+date_migration_report: Dict[str, Any] = {"status": "pending", "converted": 0, "skipped": 0}
+
+def _parse_legacy_date(value: str) -> Optional[datetime]:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+async def migrate_string_dates():
+    """
+    Converte, em lotes e com o app no ar, datas gravadas como string para datas nativas.
+    Cada update só é aplicado se o campo ainda tiver o valor lido (não sobrescreve gravações novas).
+    """
+    date_migration_report["status"] = "running"
+    try:
+        for collection, fields in DATE_FIELDS.items():
+            for field in fields:
+                last_id = None
+                while True:
+                    query = {field: {"$type": "string"}}
+                    if last_id is not None:
+                        query["_id"] = {"$gt": last_id}
+                    docs = await db[collection].find(query, {"_id": 1, field: 1}).sort("_id", 1).limit(DATE_MIGRATION_BATCH_SIZE).to_list(DATE_MIGRATION_BATCH_SIZE)
+                    if not docs:
+                        break
+                    last_id = docs[-1]["_id"]
+                    
+                    operations = []
+                    for doc in docs:
+                        parsed = _parse_legacy_date(doc[field])
+                        if parsed is None:
+                            date_migration_report["skipped"] += 1
+                            logging.warning(f"[DateMigration] {collection}.{field} inválido em {doc['_id']}: {doc[field]!r}")
+                            continue
+                        operations.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: parsed}}))
+                    
+                    if operations:
+                        result = await db[collection].bulk_write(operations, ordered=False)
+                        date_migration_report["converted"] += result.modified_count
+                    await asyncio.sleep(DATE_MIGRATION_PAUSE_SECONDS)
+        
+        date_migration_report["status"] = "done"
+        if date_migration_report["converted"]:
+            logging.info(f"[DateMigration] {date_migration_report['converted']} datas convertidas para o formato nativo")
+    except Exception as e:
+        logging.error(f"[DateMigration] Erro na migração de datas: {e}")
+        date_migration_report["status"] = "error"
+        date_migration_report["error"] = str(e)
+
 # ============== WebSocket for Broadcast Monitoring ==============
 
 @app.websocket("/ws/broadcast/{user_id}")
@@ -3001,7 +5991,10 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag"],
 )
+# Expõe a rota atual para o log de consultas lentas
+app.add_middleware(RequestContextMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -3013,8 +6006,27 @@ logger = logging.getLogger(__name__)
 # Create sessions directory
 os.makedirs("sessions", exist_ok=True)
 
+@app.on_event("startup")
+async def start_background_workers():
+    action_log_sink.start()
+    account_leases.start()
+    client_manager.start_maintenance()
+    if CACHE_INVALIDATION_CHANGE_STREAMS:
+        cache_invalidation_bus.start()
+    # Em segundo plano: a construção de índices não deve atrasar o startup
+    asyncio.create_task(bootstrap_indexes())
+    asyncio.create_task(migrate_string_dates())
+    if ARCHIVE_INTERVAL_HOURS > 0:
+        asyncio.create_task(archive_scheduler())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await cache_invalidation_bus.stop()
+    await action_log_sink.stop()
     client.close()
-    for c in active_clients.values():
-        await c.disconnect()
+    client_manager.stop_maintenance()
+    account_leases.stop()
+    await client_manager.disconnect_all()
+    # Depois dos clientes: ao desconectar eles gravam a sessão
+    session_store.close()
+    _password_executor.shutdown(wait=False)
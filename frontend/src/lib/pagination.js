@@ -0,0 +1,26 @@
+import axios from 'axios';
+
+// Busca todas as páginas de uma lista paginada por cursor.
+// Listas comuns devolvem o próximo cursor no header X-Next-Cursor; as que devolvem um
+// objeto (ex: /admin/purchases) informam `key` com o campo da lista e usam `next_cursor`.
+export async function fetchAllPages(url, config = {}, key = null) {
+  const items = [];
+  let after = null;
+  do {
+    const params = { ...(config.params || {}) };
+    if (after) params.after = after;
+    const response = await axios.get(url, { ...config, params });
+    items.push(...(key ? response.data[key] || [] : response.data));
+    after = (key ? response.data.next_cursor : response.headers['x-next-cursor']) || null;
+  } while (after);
+  return items;
+}
+
+// Total de uma lista paginada sem baixar os itens (header X-Total-Count)
+export async function fetchTotal(url, config = {}) {
+  const response = await axios.get(url, {
+    ...config,
+    params: { ...(config.params || {}), limit: 1, include_total: true },
+  });
+  return Number(response.headers['x-total-count'] || response.data.length);
+}
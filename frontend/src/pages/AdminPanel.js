@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { fetchAllPages } from '../lib/pagination';
 import { Users, Crown, Shield, Search, Check, X, Store, RefreshCw, ShoppingCart } from 'lucide-react';
 import { toast } from 'sonner';
 import { Button } from '../components/ui/button';
@@ -32,12 +33,12 @@ const AdminPanel = () => {
       const headers = { Authorization: `Bearer ${token}` };
       
       const [usersRes, purchasesRes] = await Promise.all([
-        axios.get(`${API}/admin/users`, { headers }),
-        axios.get(`${API}/admin/purchases`, { headers })
+        fetchAllPages(`${API}/admin/users`, { headers }),
+        fetchAllPages(`${API}/admin/purchases`, { headers }, 'purchases')
       ]);
       
-      setUsers(usersRes.data);
-      setPurchases(purchasesRes.data.purchases || []);
+      setUsers(usersRes);
+      setPurchases(purchasesRes);
     } catch (error) {
       toast.error('Erro ao carregar dados');
     } finally {
@@ -85,13 +86,42 @@ const AdminPanel = () => {
         headers: { Authorization: `Bearer ${token}` }
       });
       toast.success(res.data.message);
+      pollSyncStatus(res.data.sync_id);
     } catch (error) {
       toast.error(error.response?.data?.detail || 'Erro ao sincronizar grupos');
-    } finally {
       setSyncing(false);
     }
   };
 
+  const pollSyncStatus = (syncId) => {
+    const poll = async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const response = await axios.get(`${API}/admin/sync-public-groups/${syncId}/status`, {
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        
+        if (response.data.status === 'completed') {
+          toast.success(response.data.message);
+          setSyncing(false);
+          return;
+        }
+        if (response.data.status === 'error') {
+          toast.error(response.data.error || 'Erro ao sincronizar grupos');
+          setSyncing(false);
+          return;
+        }
+        
+        setTimeout(poll, 2000);
+      } catch (error) {
+        toast.error(error.response?.data?.detail || 'Erro ao sincronizar grupos');
+        setSyncing(false);
+      }
+    };
+    
+    poll();
+  };
+
   if (!user?.is_admin) {
     return <Navigate to="/" replace />;
   }
@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { toast } from 'sonner';
 import axios from 'axios';
+import { fetchAllPages } from '../lib/pagination';
 import { useAuth } from '../contexts/AuthContext';
 import { 
   Send, RefreshCw, Users, CheckCircle, XCircle, Clock, 
@@ -148,12 +149,12 @@ const BroadcastGroups = () => {
     try {
       const [accountsRes, groupsRes, templatesRes] = await Promise.all([
         axios.get(`${API}/accounts`),
-        axios.get(`${API}/groups`),
+        fetchAllPages(`${API}/groups`),
         axios.get(`${API}/templates`)
       ]);
       
       setAccounts(accountsRes.data);
-      setGroups(groupsRes.data);
+      setGroups(groupsRes);
       setTemplates(templatesRes.data);
       
       // Initialize expanded state
@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { Users, MessageSquare, Activity, TrendingUp, Radio, FileText } from 'lucide-react';
 import { Link } from 'react-router-dom';
 import axios from 'axios';
+import { fetchTotal } from '../lib/pagination';
 import { useAuth } from '../contexts/AuthContext';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
@@ -25,11 +26,11 @@ const Dashboard = () => {
 
   const fetchStats = async () => {
     try {
-      const [accountsRes, membersRes, logsRes, groupsRes, templatesRes] = await Promise.all([
+      const [accountsRes, membersTotal, logsRes, groupsTotal, templatesRes] = await Promise.all([
         axios.get(`${API}/accounts`),
-        axios.get(`${API}/members`),
+        fetchTotal(`${API}/members`),
         axios.get(`${API}/logs`),
-        axios.get(`${API}/groups`),
+        fetchTotal(`${API}/groups`),
         axios.get(`${API}/templates`),
       ]);
 
@@ -38,10 +39,10 @@ const Dashboard = () => {
 
       setStats({
         accounts: accountsRes.data.length,
-        members: membersRes.data.length,
+        members: membersTotal,
         messages: messageLogs.length,
         extractions: extractLogs.length,
-        groups: groupsRes.data.length,
+        groups: groupsTotal,
         templates: templatesRes.data.length,
       });
     } catch (error) {
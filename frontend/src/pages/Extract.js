@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { fetchAllPages } from '../lib/pagination';
 import { Download, Loader2 } from 'lucide-react';
 import { toast } from 'sonner';
 import { Button } from '../components/ui/button';
@@ -20,8 +21,7 @@ const Extract = () => {
 
   const fetchMembers = async () => {
     try {
-      const response = await axios.get(`${API}/members`);
-      setMembers(response.data);
+      setMembers(await fetchAllPages(`${API}/members`));
     } catch (error) {
       toast.error('Erro ao carregar membros');
     } finally {
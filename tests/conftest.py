@@ -0,0 +1,7 @@
+import os
+import sys
+
+# server.py lê a configuração do ambiente no import; os testes não precisam de um MongoDB rodando
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
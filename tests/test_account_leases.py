@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+import server
+from server import AccountLeaseScheduler, LeaseLostError, LEASE_BACKGROUND, LEASE_INTERACTIVE
+
+
+PHONE = "+5511999990000"
+
+
+def test_try_acquire_is_exclusive():
+    scheduler = AccountLeaseScheduler()
+    lease = scheduler.try_acquire(PHONE)
+    assert lease is not None
+    assert scheduler.try_acquire(PHONE) is None
+    scheduler.release(lease)
+    assert scheduler.try_acquire(PHONE) is not None
+
+
+def test_waiters_are_served_fifo_within_priority():
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        holder = scheduler.try_acquire(PHONE)
+        order = []
+
+        async def wait(name, priority):
+            lease = await scheduler.acquire(PHONE, priority, timeout=5, owner=name)
+            order.append(name)
+            scheduler.release(lease)
+
+        tasks = []
+        for name, priority in [("bg1", LEASE_BACKGROUND), ("i1", LEASE_INTERACTIVE),
+                               ("bg2", LEASE_BACKGROUND), ("i2", LEASE_INTERACTIVE)]:
+            tasks.append(asyncio.create_task(wait(name, priority)))
+            await asyncio.sleep(0)
+        scheduler.release(holder)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["i1", "i2", "bg1", "bg2"]
+
+
+def test_background_waiter_ages_into_interactive(monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_LEASE_BACKGROUND_AGING_SECONDS", 0.05)
+
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        holder = scheduler.try_acquire(PHONE)
+        background = asyncio.create_task(scheduler.acquire(PHONE, LEASE_BACKGROUND, timeout=5, owner="bg"))
+        await asyncio.sleep(0.1)
+        interactive = asyncio.create_task(scheduler.acquire(PHONE, LEASE_INTERACTIVE, timeout=5, owner="i"))
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        first = await background
+        assert first.owner == "bg"
+        assert not interactive.done()
+        scheduler.release(first)
+        assert (await interactive).owner == "i"
+
+    asyncio.run(scenario())
+
+
+def test_acquire_times_out_and_leaves_queue():
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        holder = scheduler.try_acquire(PHONE)
+        assert await scheduler.acquire(PHONE, timeout=0.05) is None
+        assert scheduler.status(PHONE)["queue_depth"] == 0
+        scheduler.release(holder)
+        assert scheduler.try_acquire(PHONE) is not None
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_is_fenced_and_handed_off(monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_LEASE_TTL_SECONDS", 0.05)
+
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        stale = scheduler.try_acquire(PHONE, owner="stale")
+        waiter = await scheduler.acquire(PHONE, timeout=1, owner="next")
+        assert waiter is not None and waiter.owner == "next"
+        assert waiter.token > stale.token
+        with pytest.raises(LeaseLostError):
+            stale.check()
+        with pytest.raises(LeaseLostError):
+            stale.heartbeat()
+        # Devolver o lease antigo não solta o dono atual
+        scheduler.release(stale)
+        assert scheduler.is_current(waiter)
+
+    asyncio.run(scenario())
+
+
+def test_revoked_lease_is_fenced():
+    scheduler = AccountLeaseScheduler()
+    lease = scheduler.try_acquire(PHONE)
+    assert scheduler.revoke(PHONE)
+    with pytest.raises(LeaseLostError):
+        lease.check()
+    successor = scheduler.try_acquire(PHONE)
+    assert successor is not None
+    scheduler.release(lease)
+    assert scheduler.is_current(successor)
+
+
+def test_run_keeps_lease_alive_past_ttl(monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_LEASE_TTL_SECONDS", 0.06)
+
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        lease = scheduler.try_acquire(PHONE)
+
+        async def slow():
+            await asyncio.sleep(0.2)
+            return "done"
+
+        assert await lease.run(slow()) == "done"
+        assert scheduler.is_current(lease)
+
+    asyncio.run(scenario())
+
+
+def test_run_cancels_call_when_lease_is_revoked(monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_LEASE_TTL_SECONDS", 0.06)
+
+    async def scenario():
+        scheduler = AccountLeaseScheduler()
+        lease = scheduler.try_acquire(PHONE)
+        cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        task = asyncio.create_task(lease.run(slow()))
+        await asyncio.sleep(0.01)
+        scheduler.revoke(PHONE)
+        with pytest.raises(LeaseLostError):
+            await task
+        assert cancelled.is_set()
+
+    asyncio.run(scenario())
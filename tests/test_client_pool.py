@@ -0,0 +1,201 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import server
+from server import AccountLeaseScheduler, TelegramClientManager as pool
+
+
+class FakeClient:
+    def __init__(self, session, api_id, api_hash, **kwargs):
+        self.session = session
+        self.connected = False
+        self.disconnects = 0
+
+    async def connect(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    async def disconnect(self):
+        self.connected = False
+        self.disconnects += 1
+
+    async def __call__(self, request):
+        return None
+
+
+@pytest.fixture(autouse=True)
+def fresh_pool(monkeypatch):
+    monkeypatch.setattr(pool, "_clients", OrderedDict())
+    monkeypatch.setattr(pool, "_refs", {})
+    monkeypatch.setattr(pool, "_last_used", {})
+    monkeypatch.setattr(pool, "_close_on_release", set())
+    monkeypatch.setattr(pool, "_pending_auth", {})
+    monkeypatch.setattr(pool, "_connecting", 0)
+    monkeypatch.setattr(pool, "_capacity", asyncio.Condition())
+    monkeypatch.setattr(pool, "_stats", {})
+    monkeypatch.setattr(pool, "_pool_stats", dict.fromkeys(pool._pool_stats, 0))
+    monkeypatch.setattr(server, "account_leases", AccountLeaseScheduler())
+    monkeypatch.setattr(server, "TelegramClient", FakeClient)
+
+    async def open_session(phone):
+        return phone
+
+    monkeypatch.setattr(server, "open_telegram_session", open_session)
+
+
+def get(phone, **kwargs):
+    return pool.get_client(phone, 1, "hash", **kwargs)
+
+
+def test_client_is_shared_and_freed_after_last_release():
+    async def scenario():
+        first = await get("a")
+        second = await get("a")
+        assert first is not second
+        assert first.client is second.client
+        assert pool.stats()["leases"] == 2
+
+        await pool.release_client(first)
+        assert pool.is_client_in_use("a")
+        await pool.release_client(second)
+        assert not pool.is_client_in_use("a")
+        # A conexão continua aberta para a próxima operação
+        assert first.client.is_connected()
+
+    asyncio.run(scenario())
+
+
+def test_double_release_does_not_drop_other_holders_reference():
+    async def scenario():
+        mine = await get("a")
+        other = await get("a")
+        await pool.release_client(mine)
+        await pool.release_client(mine)
+        assert pool.is_client_in_use("a")
+        assert pool.stats()["leases"] == 1
+        await pool.release_client(other)
+        assert not pool.is_client_in_use("a")
+
+    asyncio.run(scenario())
+
+
+def test_release_after_forced_close_is_ignored():
+    async def scenario():
+        stale = await get("a")
+        await pool.close_client("a", force=True)
+        fresh = await get("a")
+        await pool.release_client(stale)
+        assert pool.is_client_in_use("a")
+        await pool.release_client(fresh)
+        await pool.release_client(None)
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_on_last_release():
+    async def scenario():
+        first = await get("a")
+        second = await get("a")
+        await pool.release_client(first, disconnect=True)
+        assert "a" in pool._clients
+        await pool.release_client(second)
+        assert "a" not in pool._clients
+        assert first.client.disconnects == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_pool_evicts_least_recently_used_idle_client(monkeypatch):
+    monkeypatch.setattr(server, "MAX_CONNECTED_CLIENTS", 2)
+
+    async def scenario():
+        a = await get("a")
+        b = await get("b")
+        await pool.release_client(a)
+        await pool.release_client(b)
+        # "a" volta a ser usado: "b" passa a ser o LRU
+        await pool.release_client(await get("a"))
+        c = await get("c")
+        assert list(pool._clients) == ["a", "c"]
+        assert b.client.disconnects == 1
+        assert pool.stats()["evicted_lru"] == 1
+        await pool.release_client(c)
+
+    asyncio.run(scenario())
+
+
+def test_full_pool_does_not_evict_clients_in_use(monkeypatch):
+    monkeypatch.setattr(server, "MAX_CONNECTED_CLIENTS", 1)
+    monkeypatch.setattr(server, "CLIENT_POOL_WAIT_SECONDS", 0.05)
+
+    async def scenario():
+        a = await get("a")
+        with pytest.raises(Exception, match="Limite de conexões"):
+            await get("b")
+        assert list(pool._clients) == ["a"]
+        assert pool._connecting == 0
+        await pool.release_client(a)
+
+    asyncio.run(scenario())
+
+
+def test_pending_auth_client_is_not_evicted(monkeypatch):
+    monkeypatch.setattr(server, "MAX_CONNECTED_CLIENTS", 2)
+    monkeypatch.setattr(server, "CLIENT_POOL_WAIT_SECONDS", 0.05)
+
+    async def scenario():
+        login = await get("a", require_auth=False)
+        pool.mark_pending_auth("a")
+        await pool.release_client(login)
+        await pool.release_client(await get("b"))
+        # "a" é o LRU, mas espera o verify_code: o despejado é "b"
+        await pool.release_client(await get("c"))
+        assert set(pool._clients) == {"a", "c"}
+
+        verify = pool.lease_existing("a")
+        assert verify is not None and verify.client is login.client
+        await pool.release_client(verify)
+
+    asyncio.run(scenario())
+
+
+def test_pending_auth_is_skipped_by_maintenance_until_deadline(monkeypatch):
+    monkeypatch.setattr(server, "CLIENT_PENDING_AUTH_SECONDS", 0.05)
+
+    async def scenario():
+        login = await get("a", require_auth=False)
+        pool.mark_pending_auth("a")
+        await pool.release_client(login)
+
+        await pool._check_idle_clients()
+        assert "a" in pool._clients
+
+        await asyncio.sleep(0.06)
+        await pool._check_idle_clients()
+        assert "a" not in pool._clients
+        assert login.client.disconnects == 1
+
+    asyncio.run(scenario())
+
+
+def test_maintenance_evicts_idle_clients(monkeypatch):
+    monkeypatch.setattr(server, "CLIENT_IDLE_TIMEOUT_SECONDS", 0)
+
+    async def scenario():
+        idle = await get("a")
+        busy = await get("b")
+        await pool.release_client(idle)
+        await asyncio.sleep(0.01)
+        await pool._check_idle_clients()
+        assert list(pool._clients) == ["b"]
+        assert pool.stats()["evicted_idle"] == 1
+        await pool.release_client(busy)
+
+    asyncio.run(scenario())
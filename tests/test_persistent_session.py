@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+from telethon.sessions import MemorySession
+from telethon.tl.types import User
+
+import server
+from server import PersistentSession, SessionStoreError
+
+
+PHONE = "+5511999990000"
+
+
+class FakeStore:
+    """Store em memória; `gate` segura o save para simular uma gravação em andamento"""
+
+    def __init__(self):
+        self.saves = []
+        self.deletes = 0
+        self.fail = 0
+        self.gate = None
+        self.saving = asyncio.Event()
+
+    async def save(self, phone, state, entities):
+        self.saving.set()
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("store down")
+        self.saves.append((state, sorted(row[0] for row in entities)))
+
+    async def delete(self, phone):
+        self.deletes += 1
+        self.saves.clear()
+
+
+def user(id):
+    return User(id=id, access_hash=id * 10, username=f"user{id}")
+
+
+@pytest.fixture(autouse=True)
+def short_flush(monkeypatch):
+    monkeypatch.setattr(server, "SESSION_ENTITY_FLUSH_SECONDS", 0.02)
+
+
+def test_new_entities_are_batched_into_one_write():
+    async def scenario():
+        store = FakeStore()
+        session = PersistentSession(store, PHONE)
+        session.process_entities([user(1)])
+        session.process_entities([user(2)])
+        await asyncio.sleep(0.05)
+        assert store.saves == [(None, [1, 2])]
+        assert session.get_entity_rows_by_username("user2") == (2, 20)
+
+    asyncio.run(scenario())
+
+
+def test_close_during_scheduled_flush_writes_once():
+    async def scenario():
+        store = FakeStore()
+        session = PersistentSession(store, PHONE)
+        session.process_entities([user(1)])
+        await session.close()
+        await asyncio.sleep(0.05)
+        assert store.saves == [(None, [1])]
+
+    asyncio.run(scenario())
+
+
+def test_close_during_in_flight_write_keeps_the_batch():
+    async def scenario():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        session = PersistentSession(store, PHONE)
+        session.process_entities([user(1)])
+        await store.saving.wait()
+        # Chegou entidade nova enquanto o lote anterior grava
+        session.process_entities([user(2)])
+        closing = asyncio.create_task(session.close())
+        await asyncio.sleep(0.01)
+        assert not closing.done()
+        store.gate.set()
+        await closing
+        assert store.saves == [(None, [1]), (None, [2])]
+
+    asyncio.run(scenario())
+
+
+def test_delete_waits_for_in_flight_write_and_blocks_later_writes():
+    async def scenario():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        session = PersistentSession(store, PHONE)
+        session.process_entities([user(1)])
+        await store.saving.wait()
+        deleting = asyncio.create_task(session.delete())
+        await asyncio.sleep(0.01)
+        assert store.deletes == 0
+        store.gate.set()
+        await deleting
+        assert store.deletes == 1
+
+        # Nada recria a sessão apagada
+        session.process_entities([user(2)])
+        session.set_dc(2, "1.2.3.4", 443)
+        await session.save()
+        await session.close()
+        await asyncio.sleep(0.05)
+        assert store.saves == []
+
+    asyncio.run(scenario())
+
+
+def test_failed_write_is_requeued():
+    async def scenario():
+        store = FakeStore()
+        store.fail = 1
+        session = PersistentSession(store, PHONE)
+        session.set_dc(2, "1.2.3.4", 443)
+        session.process_entities([user(1)])
+        with pytest.raises(SessionStoreError):
+            await session.flush(raise_errors=True)
+        assert store.saves == []
+        await session.flush()
+        assert store.saves[0][0]["dc_id"] == 2
+        assert store.saves[0][1] == [1]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_write_is_requeued():
+    async def scenario():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        session = PersistentSession(store, PHONE)
+        session.process_entities([user(1)])
+        await store.saving.wait()
+        session._flush_task.cancel()
+        await asyncio.gather(session._flush_task, return_exceptions=True)
+        store.gate.set()
+        await session.flush()
+        assert store.saves == [(None, [1])]
+
+    asyncio.run(scenario())
+
+
+def test_clone_stays_in_memory():
+    async def scenario():
+        store = FakeStore()
+        session = PersistentSession(store, PHONE, {"dc_id": 2, "server_address": "1.2.3.4", "port": 443})
+        copy = session.clone()
+        assert type(copy) is MemorySession
+        assert copy.dc_id == 2
+        copy.process_entities([user(1)])
+        await asyncio.sleep(0.05)
+        assert store.saves == []
+
+    asyncio.run(scenario())